@@ -0,0 +1,203 @@
+"""
+Benchmark of the database hot paths on synthetic histories.
+
+A synthetic database is built in a temporary directory (the configured database is never touched):
+`--users` users with `--messages` messages in total. The messages are spread over the users with a
+Zipf-like distribution, so a few users have very long histories, like in production. Then the
+following operations are timed on randomly sampled users:
+
+    get_messages_by_user, user_exists, insert_message, User.get_user_info, anonymize_user
+
+The result is printed (or written with `--output`) as JSON with latency percentiles in milliseconds,
+the throughput in operations per second, the parameters and the git commit, so runs on different
+commits can be compared. `--compare baseline.json` exits with status 1 if the p50 or p99 latency of
+an operation got more than `--threshold` times slower than in the baseline.
+
+Usage:
+    python benchmarks/bench_database.py --users 10000 --messages 1000000 --output bench.json
+    python benchmarks/bench_database.py --users 10000 --messages 1000000 --compare bench.json
+"""
+import argparse
+import json
+import platform
+import random
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+from pathlib import Path
+from zoneinfo import ZoneInfo
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1] / 'src'))
+
+from verbal_diary_bot import utils
+from verbal_diary_bot import database_operations as db
+from verbal_diary_bot.user import User
+
+REPO_PATH = Path(__file__).resolve().parents[1]
+WORDS = 'today I went to the park and thought about work family the weather and what to do next week'.split()
+START_DATE = datetime(2023, 1, 1, tzinfo=ZoneInfo("Europe/Berlin"))
+
+
+def use_config(db_path: Path, config_dir: Path) -> None:
+    """Point `utils` to a copy of the config that uses the synthetic database."""
+    config = json.loads((REPO_PATH / 'configs.json').read_text())
+    config['save_paths']['db_path'] = str(db_path)
+    config_path = config_dir / 'configs.json'
+    config_path.write_text(json.dumps(config))
+    utils.TOKEN_PATH = str(config_path)
+
+
+def build_database(db_path: Path, n_users: int, n_messages: int, seed: int) -> list:
+    """
+    Create the Users and Messages tables (with the configured fields) and fill them with synthetic data.
+
+    Returns
+    -------
+    list
+        The user ids.
+    """
+    rng = random.Random(seed)
+    db_configs = utils.get_config()['database']
+    conn = sqlite3.connect(db_path)
+    conn.execute(f'CREATE TABLE Users ({", ".join(db_configs["Users_fields"])})')
+    conn.execute(f'CREATE TABLE Messages ({", ".join(db_configs["Messages_fields"])})')
+    user_ids = [100_000 + i for i in range(n_users)]
+    conn.executemany('INSERT INTO Users (user_id, name, notion_token, database_id) VALUES (?, ?, ?, ?)',
+                     ((user_id, f'user {user_id}', f'secret_{user_id}', f'db_{user_id}') for user_id in user_ids))
+    # Zipf-like weights: the i-th user sends ~1/i of the messages of the first one
+    weights = [1 / (i + 1) for i in range(n_users)]
+
+    def messages():
+        senders = rng.choices(user_ids, weights, k=n_messages)
+        for i, user_id in enumerate(senders):
+            word_count = rng.randint(5, 300)
+            date = START_DATE + timedelta(seconds=i * 30)
+            text = ' '.join(rng.choices(WORDS, k=word_count))
+            yield (user_id, date.strftime('%Y-%m-%d %H:%M:%S %z'), text, word_count, 'audio', word_count / 2.5)
+
+    conn.executemany('INSERT INTO Messages (user_id, date, message, word_count, message_type, audio_length) VALUES (?, ?, ?, ?, ?, ?)', messages())
+    conn.commit()
+    conn.close()
+    return user_ids
+
+
+def percentile(sorted_values: list, p: float) -> float:
+    index = min(len(sorted_values) - 1, max(0, round(p / 100 * len(sorted_values)) - 1))
+    return sorted_values[index]
+
+
+def measure(function, args_list: list) -> dict:
+    """Call `function` once for every argument tuple and summarize the latencies."""
+    latencies = []
+    start = time.perf_counter()
+    for args in args_list:
+        call_start = time.perf_counter()
+        function(*args)
+        latencies.append(time.perf_counter() - call_start)
+    total = time.perf_counter() - start
+    latencies.sort()
+    return {
+        'calls': len(latencies),
+        'p50_ms': percentile(latencies, 50) * 1000,
+        'p90_ms': percentile(latencies, 90) * 1000,
+        'p99_ms': percentile(latencies, 99) * 1000,
+        'max_ms': latencies[-1] * 1000,
+        'mean_ms': total / len(latencies) * 1000,
+        'throughput_ops': len(latencies) / total,
+    }
+
+
+def run_benchmarks(user_ids: list, iterations: int, seed: int) -> dict:
+    rng = random.Random(seed + 1)
+    # weighted like the traffic: active users are looked up more often
+    weights = [1 / (i + 1) for i in range(len(user_ids))]
+    sampled = rng.choices(user_ids, weights, k=iterations)
+    date = datetime.now(ZoneInfo("Europe/Berlin"))
+
+    def get_user_info(user_id):
+        User(user_id).get_user_info()
+
+    results = {}
+    results['get_messages_by_user'] = measure(db.get_messages_by_user, [(u,) for u in sampled])
+    # half of the lookups are for unknown users
+    results['user_exists'] = measure(db.user_exists, [(u if i % 2 else -u,) for i, u in enumerate(sampled)])
+    results['insert_message'] = measure(db.insert_message, [(u, date, 'a new message', 3, 'audio', 1.2) for u in sampled])
+    results['User.get_user_info'] = measure(get_user_info, [(u,) for u in sampled])
+    # every user can only be anonymized once
+    anonymized = rng.sample(user_ids, min(iterations, len(user_ids)))
+    results['anonymize_user'] = measure(db.anonymize_user, [(u,) for u in anonymized])
+    return results
+
+
+def get_commit() -> str:
+    try:
+        commit = subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=REPO_PATH, capture_output=True, text=True, check=True).stdout.strip()
+        dirty = subprocess.run(['git', 'status', '--porcelain', '--untracked-files=no'], cwd=REPO_PATH, capture_output=True, text=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+    return commit + ('-dirty' if dirty else '')
+
+
+def compare(results: dict, baseline: dict, threshold: float) -> list:
+    """Return the operations whose p50 or p99 latency regressed by more than `threshold` times."""
+    if baseline['parameters'] != results['parameters']:
+        print("Warning: the baseline was run with different parameters.", file=sys.stderr)
+    regressions = []
+    for name, stats in results['operations'].items():
+        old = baseline['operations'].get(name)
+        if old is None:
+            continue
+        for key in ('p50_ms', 'p99_ms'):
+            if stats[key] > old[key] * threshold:
+                regressions.append(f"{name} {key}: {old[key]:.3f} -> {stats[key]:.3f}")
+    return regressions
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--users', type=int, default=10_000)
+    parser.add_argument('--messages', type=int, default=100_000)
+    parser.add_argument('--iterations', type=int, default=200, help='calls per operation')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', type=Path, help='write the JSON result to this file')
+    parser.add_argument('--compare', type=Path, help='JSON result of an earlier run to compare with')
+    parser.add_argument('--threshold', type=float, default=1.5, help='slowdown factor counted as regression')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        tmp_dir = Path(tmp_dir)
+        db_path = tmp_dir / 'bench.sqlite'
+        use_config(db_path, tmp_dir)
+        start = time.perf_counter()
+        user_ids = build_database(db_path, args.users, args.messages, args.seed)
+        build_seconds = time.perf_counter() - start
+        print(f"Built database with {args.users} users and {args.messages} messages in {build_seconds:.1f}s", file=sys.stderr)
+        operations = run_benchmarks(user_ids, args.iterations, args.seed)
+
+    results = {
+        'commit': get_commit(),
+        'timestamp': datetime.now(ZoneInfo("UTC")).isoformat(),
+        'python': platform.python_version(),
+        'sqlite': sqlite3.sqlite_version,
+        'parameters': {'users': args.users, 'messages': args.messages, 'iterations': args.iterations, 'seed': args.seed},
+        'build_seconds': build_seconds,
+        'operations': operations,
+    }
+    text = json.dumps(results, indent=2)
+    if args.output is not None:
+        args.output.write_text(text)
+    print(text)
+
+    if args.compare is not None:
+        regressions = compare(results, json.loads(args.compare.read_text()), args.threshold)
+        for regression in regressions:
+            print(f"Regression: {regression}", file=sys.stderr)
+        return 1 if regressions else 0
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
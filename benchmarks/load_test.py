@@ -0,0 +1,193 @@
+"""
+End-to-end load test of the bot.
+
+The real `Application` from `main_bot.build_application` is run against local fake servers:
+
+- a fake Telegram Bot API (`getUpdates` long polling, `getFile`, file downloads, `sendMessage`, `editMessageText`)
+- a stub of the OpenAI transcription endpoint
+- the fake Notion API from `tests/fake_notion.py`
+
+Every fake server can be given a latency and an error rate. `--users` simulated users send
+`--messages` voice messages each. A user waits for the transcription reply of a message (plus
+`--think-time`) before sending the next one. Everything runs on a temporary database and a
+temporary config, the real config and database are not touched.
+
+The result is printed as JSON: throughput, p50/p99 latency from sending a voice message to
+receiving its transcription, error rates and the number of requests to each service.
+
+Usage:
+    python benchmarks/load_test.py --users 20 --messages 5 --openai-latency 0.5 --notion-latency 0.2
+"""
+import argparse
+import asyncio
+import json
+import logging
+import random
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+REPO_PATH = Path(__file__).resolve().parents[1]
+sys.path.insert(0, str(REPO_PATH / 'src'))
+sys.path.insert(0, str(REPO_PATH / 'tests'))
+
+from fake_notion import FakeNotionServer
+from fake_openai import FakeOpenAIServer
+from fake_telegram import FakeTelegramServer
+from verbal_diary_bot import utils
+from verbal_diary_bot import database_operations as db
+
+TOKEN = '123456:load-test'
+NOTION_APPENDED = u"✅ Transcription appended to Notion."
+USER_ID_OFFSET = 5_000_000
+
+
+def percentile(sorted_values: list, p: float):
+    if not sorted_values:
+        return None
+    index = min(len(sorted_values) - 1, max(0, round(p / 100 * len(sorted_values)) - 1))
+    return sorted_values[index]
+
+
+def write_config(tmp_dir: Path, telegram, openai_server, notion_server) -> None:
+    """Write a config that points the bot to the fake servers and a temporary database."""
+    config = json.loads((REPO_PATH / 'configs.json').read_text())
+    config['telegram']['token'] = TOKEN
+    config['save_paths'] = {'voice_messages': str(tmp_dir / 'voice_messages'), 'db_path': str(tmp_dir / 'db.sqlite')}
+    config['openai'] = {'token': 'sk-load-test', 'base_url': f'{openai_server.base_url}/v1'}
+    config['notion']['base_url'] = notion_server.base_url
+    config.pop('metrics', None)
+    config_path = tmp_dir / 'configs.json'
+    config_path.write_text(json.dumps(config))
+    utils.TOKEN_PATH = str(config_path)
+    # create the tables in the temporary database
+    db_configs = config['database']
+    conn = db.connect_db()
+    conn.execute(f'CREATE TABLE Users ({", ".join(db_configs["Users_fields"])})')
+    conn.execute(f'CREATE TABLE Messages ({", ".join(db_configs["Messages_fields"])})')
+    conn.commit()
+    conn.close()
+
+
+def drive(telegram: FakeTelegramServer, args) -> dict:
+    """Let every simulated user send its voice messages and wait for the replies."""
+    latencies, errors = [], []
+
+    def run_user(user_index: int) -> None:
+        user_id = USER_ID_OFFSET + user_index
+        for i in range(args.messages):
+            file_id = f'voice-{user_id}-{i}'
+            start_index = len(telegram.replies_in(user_id))
+            start = time.monotonic()
+            telegram.send_voice(user_id, file_id)
+            expected = f'Transcription of {file_id}.ogg'
+            index = telegram.wait_for_reply(user_id, start_index, lambda text: expected in text or 'Error:' in text.split('\n\n', 1)[0], args.timeout)
+            if index is None:
+                errors.append('timeout')
+            else:
+                # not the time of the reply, the status message is edited again later
+                reply_time = time.monotonic()
+                _, text = telegram.replies_in(user_id)[index]
+                if expected in text:
+                    latencies.append(reply_time - start)
+                else:
+                    errors.append('transcription')
+            if args.think_time:
+                time.sleep(random.uniform(0, 2 * args.think_time))
+
+    start = time.monotonic()
+    with ThreadPoolExecutor(max_workers=args.users) as executor:
+        list(executor.map(run_user, range(args.users)))
+    return {'latencies': latencies, 'errors': errors, 'seconds': time.monotonic() - start}
+
+
+async def run(args) -> dict:
+    from verbal_diary_bot import main_bot
+
+    logging.getLogger().setLevel(logging.ERROR if not args.verbose else logging.INFO)
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        telegram = FakeTelegramServer(args.telegram_latency, args.telegram_error_rate).start()
+        openai_server = FakeOpenAIServer(args.openai_latency, args.openai_error_rate).start()
+        notion_server = FakeNotionServer(rate_limit=args.notion_rate_limit, latency=args.notion_latency, error_rate=args.notion_error_rate).start()
+        try:
+            write_config(Path(tmp_dir), telegram, openai_server, notion_server)
+            for user_index in range(args.users):
+                user_id = USER_ID_OFFSET + user_index
+                db.insert_user(user_id, f'load_{user_id}', f'secret_{user_id}', f'database-{user_id}')
+
+            application = main_bot.build_application(TOKEN, base_url=f'{telegram.base_url}/bot', base_file_url=f'{telegram.base_url}/file/bot')
+            await application.initialize()
+            await application.post_init(application)
+            await application.updater.start_polling(poll_interval=0, timeout=1)
+            await application.start()
+            try:
+                result = await asyncio.get_running_loop().run_in_executor(None, drive, telegram, args)
+            finally:
+                await application.updater.stop()
+                await application.stop()
+                await application.post_shutdown(application)
+                await application.shutdown()
+        finally:
+            telegram.stop()
+            openai_server.stop()
+            notion_server.stop()
+
+    confirmed = notion_errors = 0
+    for user_index in range(args.users):
+        for _, text in telegram.replies_in(USER_ID_OFFSET + user_index):
+            confirmed += NOTION_APPENDED in text
+            notion_errors += 'Notion Error' in text
+    latencies = sorted(result['latencies'])
+    sent = args.users * args.messages
+    return {
+        'parameters': vars(args),
+        'sent': sent,
+        'transcribed': len(latencies),
+        'seconds': result['seconds'],
+        'throughput_per_minute': len(latencies) / result['seconds'] * 60,
+        'latency_p50_s': percentile(latencies, 50),
+        'latency_p99_s': percentile(latencies, 99),
+        'latency_max_s': latencies[-1] if latencies else None,
+        'error_rate': len(result['errors']) / sent,
+        'errors': {kind: result['errors'].count(kind) for kind in set(result['errors'])},
+        'notion_confirmations': confirmed,
+        'notion_errors': notion_errors,
+        'requests': {
+            'telegram': dict(telegram.calls),
+            'openai': dict(openai_server.calls),
+            'notion_appends': notion_server.count('PATCH', r'/v1/blocks/.*/children'),
+            'notion_rate_limited': notion_server.rate_limited,
+        },
+    }
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--users', type=int, default=10)
+    parser.add_argument('--messages', type=int, default=5, help='voice messages per user')
+    parser.add_argument('--think-time', type=float, default=0.0, help='mean seconds a user waits between two messages')
+    parser.add_argument('--timeout', type=float, default=120.0, help='seconds to wait for a transcription reply')
+    parser.add_argument('--telegram-latency', type=float, default=0.0)
+    parser.add_argument('--telegram-error-rate', type=float, default=0.0)
+    parser.add_argument('--openai-latency', type=float, default=0.5)
+    parser.add_argument('--openai-error-rate', type=float, default=0.0)
+    parser.add_argument('--notion-latency', type=float, default=0.2)
+    parser.add_argument('--notion-error-rate', type=float, default=0.0)
+    parser.add_argument('--notion-rate-limit', type=float, default=3.0, help='requests per second and token, like the real API')
+    parser.add_argument('--output', type=Path, help='write the JSON result to this file')
+    parser.add_argument('--verbose', action='store_true', help='show the logs of the bot')
+    args = parser.parse_args()
+
+    result = asyncio.run(run(args))
+    result['parameters'] = {key: str(value) if isinstance(value, Path) else value for key, value in result['parameters'].items()}
+    text = json.dumps(result, indent=2)
+    if args.output is not None:
+        args.output.write_text(text)
+    print(text)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
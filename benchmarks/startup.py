@@ -0,0 +1,160 @@
+"""
+Benchmark of the startup time of the bot and of the package.
+
+Two things are timed, each in fresh Python processes so nothing is cached in `sys.modules`:
+
+- the import of the package and of some of its modules (`--modules`), as the median of `--runs`
+  processes, without the startup of the interpreter itself. The heavy third party packages each
+  import pulls in are listed as well, e.g. a CLI tool that only needs `database_operations` should
+  not load openai or telegram.
+- the time to the first handled update: the real bot (`python -m verbal_diary_bot.main_bot`) is
+  started against the fake Telegram Bot API from `tests/fake_telegram.py`, with a /start message
+  already waiting, and the time from starting the process to the reply is measured. Everything runs
+  on a temporary database and config, the real ones are not touched.
+
+The result is printed (or written with `--output`) as JSON with the git commit, so runs on
+different commits can be compared. `--compare baseline.json` exits with status 1 if a time got more
+than `--threshold` times slower than in the baseline.
+
+Usage:
+    python benchmarks/startup.py --output startup.json
+    python benchmarks/startup.py --compare startup.json
+"""
+import argparse
+import json
+import os
+import platform
+import signal
+import sqlite3
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime
+from pathlib import Path
+from zoneinfo import ZoneInfo
+
+REPO_PATH = Path(__file__).resolve().parents[1]
+sys.path.insert(0, str(REPO_PATH / 'tests'))
+sys.path.insert(0, str(REPO_PATH / 'benchmarks'))
+
+from fake_telegram import FakeTelegramServer
+from bench_database import get_commit
+
+TOKEN = '123456:startup-benchmark'
+USER_ID = 999
+MODULES = ['verbal_diary_bot', 'verbal_diary_bot.database_operations', 'verbal_diary_bot.user', 'verbal_diary_bot.main_bot']
+HEAVY_PACKAGES = ['telegram', 'openai', 'notion_client', 'numpy', 'matplotlib', 'httpx', 'psycopg']
+IMPORT_SCRIPT = """
+import json, sys, time
+start = time.perf_counter()
+import {module}
+seconds = time.perf_counter() - start
+print(json.dumps({{'seconds': seconds, 'loaded': [name for name in {heavy!r} if name in sys.modules]}}))
+"""
+
+
+def bot_env() -> dict:
+    return dict(os.environ, PYTHONPATH=str(REPO_PATH / 'src'))
+
+
+def time_import(module: str, runs: int) -> dict:
+    """Import the module in `runs` fresh processes. Returns the median and the heavy packages it loads."""
+    seconds, loaded = [], []
+    for _ in range(runs):
+        output = subprocess.run([sys.executable, '-c', IMPORT_SCRIPT.format(module=module, heavy=HEAVY_PACKAGES)],
+                                env=bot_env(), capture_output=True, text=True, check=True).stdout
+        result = json.loads(output.strip().splitlines()[-1])
+        seconds.append(result['seconds'])
+        loaded = result['loaded']
+    return {'median_ms': statistics.median(seconds) * 1000, 'min_ms': min(seconds) * 1000, 'loads': loaded}
+
+
+def write_config(tmp_dir: Path, telegram: FakeTelegramServer) -> None:
+    """Write a config that points the bot to the fake Telegram server and a temporary database."""
+    config = json.loads((REPO_PATH / 'configs.json').read_text())
+    config['telegram'].update({'token': TOKEN, 'base_url': f'{telegram.base_url}/bot', 'base_file_url': f'{telegram.base_url}/file/bot'})
+    for key in ('webhook', 'workers'):
+        config['telegram'].pop(key, None)
+    config.pop('metrics', None)
+    config.pop('watchdog', None)
+    config['save_paths'] = {'voice_messages': str(tmp_dir / 'voice_messages'), 'db_path': str(tmp_dir / 'db.sqlite')}
+    (tmp_dir / 'configs.json').write_text(json.dumps(config))
+    conn = sqlite3.connect(tmp_dir / 'db.sqlite')
+    conn.execute(f'CREATE TABLE Users ({", ".join(config["database"]["Users_fields"])})')
+    conn.execute(f'CREATE TABLE Messages ({", ".join(config["database"]["Messages_fields"])})')
+    conn.commit()
+    conn.close()
+
+
+def time_first_update(timeout: float) -> float:
+    """Start the bot with a /start message waiting and return the seconds until it replied."""
+    with tempfile.TemporaryDirectory() as tmp_dir, FakeTelegramServer() as telegram:
+        tmp_dir = Path(tmp_dir)
+        write_config(tmp_dir, telegram)
+        telegram.send_text(USER_ID, '/start')
+        with open(tmp_dir / 'bot.log', 'wb') as log:
+            start = time.perf_counter()
+            bot = subprocess.Popen([sys.executable, '-m', 'verbal_diary_bot.main_bot'], cwd=tmp_dir, env=bot_env(), stdout=log, stderr=subprocess.STDOUT)
+            try:
+                replied = telegram.wait_for_reply(USER_ID, 0, lambda text: True, timeout) is not None
+                seconds = time.perf_counter() - start
+            finally:
+                bot.send_signal(signal.SIGTERM)
+                bot.wait(60)
+        if not replied:
+            raise RuntimeError(f"The bot did not reply within {timeout}s:\n{(tmp_dir / 'bot.log').read_text()}")
+    return seconds
+
+
+def compare(results: dict, baseline: dict, threshold: float) -> list:
+    """Return the times that regressed by more than `threshold` times."""
+    regressions = []
+    for module, stats in results['imports'].items():
+        old = baseline['imports'].get(module)
+        # below a few milliseconds the noise is larger than any regression
+        if old is not None and stats['median_ms'] > max(old['median_ms'], 5) * threshold:
+            regressions.append(f"import {module}: {old['median_ms']:.1f}ms -> {stats['median_ms']:.1f}ms")
+    old = baseline.get('first_update_s')
+    if old is not None and results['first_update_s'] > old * threshold:
+        regressions.append(f"first update: {old:.2f}s -> {results['first_update_s']:.2f}s")
+    return regressions
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--modules', nargs='+', default=MODULES, help='modules whose import is timed')
+    parser.add_argument('--runs', type=int, default=5, help='processes per import and bot starts')
+    parser.add_argument('--timeout', type=float, default=60.0, help='seconds to wait for the reply of the bot')
+    parser.add_argument('--output', type=Path, help='write the JSON result to this file')
+    parser.add_argument('--compare', type=Path, help='JSON result of an earlier run to compare with')
+    parser.add_argument('--threshold', type=float, default=1.5, help='slowdown factor counted as regression')
+    args = parser.parse_args()
+
+    imports = {module: time_import(module, args.runs) for module in args.modules}
+    first_updates = [time_first_update(args.timeout) for _ in range(args.runs)]
+    results = {
+        'commit': get_commit(),
+        'timestamp': datetime.now(ZoneInfo("UTC")).isoformat(),
+        'python': platform.python_version(),
+        'parameters': {'runs': args.runs},
+        'imports': imports,
+        'first_update_s': statistics.median(first_updates),
+        'first_update_min_s': min(first_updates),
+    }
+    text = json.dumps(results, indent=2)
+    if args.output is not None:
+        args.output.write_text(text)
+    print(text)
+
+    if args.compare is not None:
+        regressions = compare(results, json.loads(args.compare.read_text()), args.threshold)
+        for regression in regressions:
+            print(f"Regression: {regression}", file=sys.stderr)
+        return 1 if regressions else 0
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
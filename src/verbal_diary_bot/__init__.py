@@ -1,8 +1,46 @@
-from . import convert_audio
-from . import database_operations
-from . import telegram_handlers
-from . import notion
-from . import openai_api
-from . import transcribe
-from . import user
-from . import utils
\ No newline at end of file
+"""
+The submodules are imported on first use (`verbal_diary_bot.user` or `from verbal_diary_bot import user`),
+so `import verbal_diary_bot` stays cheap for CLI tools, tests and workers that only need a few of them.
+"""
+import importlib
+
+__all__ = [
+    'analytics',
+    'audio_store',
+    'broadcast',
+    'convert_audio',
+    'database_operations',
+    'deregistration',
+    'telegram_handlers',
+    'metrics',
+    'notion',
+    'notion_async',
+    'notion_sync',
+    'notion_writer',
+    'openai_api',
+    'profiler',
+    'ratelimit',
+    'reminders',
+    'semantic_search',
+    'sharding',
+    'shutdown',
+    'status_message',
+    'storage',
+    'transcribe',
+    'transcript_archive',
+    'user',
+    'utils',
+    'watchdog',
+    'webhook',
+]
+
+
+def __getattr__(name: str):
+    if name in __all__:
+        # the import sets the attribute, so this only runs once per submodule
+        return importlib.import_module(f'.{name}', __name__)
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
+def __dir__():
+    return sorted(set(globals()) | set(__all__))
@@ -0,0 +1,181 @@
+"""
+This script computes the statistics of a user's diary, shown with the /stats command.
+
+The dates, word counts and audio lengths of a user's messages are loaded into NumPy arrays once, and
+all statistics are computed on the arrays without Python loops:
+
+- daily and weekly series (messages, words, audio) from the first message up to today,
+- the current and the longest streak of days with at least one message,
+- a histogram of the hour of the day the messages were sent,
+- rolling averages of the daily words.
+
+The days and hours are those of the user's local time, as stored with the message. The statistics
+of a user are cached until they send a new message (`invalidate`, called by `User.add_message`) or
+the day changes.
+"""
+import io
+import threading
+from collections import OrderedDict
+from datetime import date, datetime
+from typing import Optional
+
+import numpy as np
+
+from . import database_operations as db
+
+ROLLING_WINDOW = 7  # days of the rolling averages
+MAX_CACHED_USERS = 1000
+EPOCH_MONDAY = 4  # 1970-01-01 was a Thursday, the first Monday is day 4
+
+_cache = OrderedDict()  # user_id -> (day computed, statistics), least recently used first
+_cache_lock = threading.Lock()  # the statistics are computed in threads
+_versions = {}  # user_id -> number of invalidations
+
+
+def load_columns(user_id: int) -> tuple:
+    """Return the local datetimes (datetime64[s]), word counts and audio lengths of a user's messages."""
+    rows = db.get_message_stats_by_user(user_id)
+    # the dates are stored as 'YYYY-MM-DD HH:MM:SS +HHMM', the first part is the local time
+    timestamps = np.array([row[0][:10] + 'T' + row[0][11:19] for row in rows], dtype='datetime64[s]')
+    word_counts = np.array([row[1] or 0 for row in rows], dtype=np.int64)
+    audio_lengths = np.array([row[2] or 0 for row in rows], dtype=np.float64)
+    return timestamps, word_counts, audio_lengths
+
+
+def rolling_mean(values: np.ndarray, window: int) -> np.ndarray:
+    """Mean of the last `window` values at every position (of fewer at the start)."""
+    cumulative = np.concatenate(([0.0], np.cumsum(values, dtype=np.float64)))
+    end = np.arange(1, len(values) + 1)
+    start = np.maximum(0, end - window)
+    return (cumulative[end] - cumulative[start]) / (end - start)
+
+
+def longest_run(active: np.ndarray) -> int:
+    """Length of the longest run of True values."""
+    edges = np.diff(np.concatenate(([0], active.astype(np.int8), [0])))
+    starts, ends = np.flatnonzero(edges == 1), np.flatnonzero(edges == -1)
+    return int((ends - starts).max()) if len(starts) else 0
+
+
+def compute_stats(timestamps: np.ndarray, word_counts: np.ndarray, audio_lengths: np.ndarray, today: date) -> Optional[dict]:
+    """
+    Compute the statistics of a user's messages.
+
+    Returns
+    -------
+    Optional[dict]
+        None without messages. Otherwise the totals, `days` with the `daily_messages`, `daily_words`,
+        `daily_audio` (seconds) and `rolling_words` series, `weeks` (their Mondays) with the
+        `weekly_messages`, `weekly_words` and `weekly_audio` series, the `current_streak` and
+        `longest_streak` in days and the `hourly_messages` histogram (24 values).
+    """
+    if len(timestamps) == 0:
+        return None
+    days = timestamps.astype('datetime64[D]')
+    first_day = days.min()
+    last_day = max(days.max(), np.datetime64(today, 'D'))
+    day_index = (days - first_day).astype(np.int64)
+    n_days = int((last_day - first_day).astype(np.int64)) + 1
+    daily_messages = np.bincount(day_index, minlength=n_days)
+    daily_words = np.bincount(day_index, weights=word_counts, minlength=n_days)
+    daily_audio = np.bincount(day_index, weights=audio_lengths, minlength=n_days)
+
+    # weeks start on Monday
+    all_days = first_day + np.arange(n_days)
+    week_number = (all_days.astype(np.int64) - EPOCH_MONDAY) // 7
+    week_index = week_number - week_number[0]
+    n_weeks = int(week_index[-1]) + 1
+
+    active = daily_messages > 0
+    # the streak is not broken before today is over
+    counted = active if active[-1] else active[:-1]
+    inactive = np.flatnonzero(~counted)
+    current_streak = len(counted) - (inactive[-1] + 1 if len(inactive) else 0)
+
+    hours = ((timestamps - days) // np.timedelta64(1, 'h')).astype(np.int64)
+    return {
+        'messages': len(timestamps),
+        'words': int(word_counts.sum()),
+        'audio': float(audio_lengths.sum()),
+        'active_days': int(active.sum()),
+        'days': all_days,
+        'daily_messages': daily_messages,
+        'daily_words': daily_words,
+        'daily_audio': daily_audio,
+        'rolling_words': rolling_mean(daily_words, ROLLING_WINDOW),
+        'weeks': np.datetime64('1970-01-01') + (week_number[0] + np.arange(n_weeks)) * 7 + EPOCH_MONDAY,
+        'weekly_messages': np.bincount(week_index, weights=daily_messages, minlength=n_weeks).astype(np.int64),
+        'weekly_words': np.bincount(week_index, weights=daily_words, minlength=n_weeks),
+        'weekly_audio': np.bincount(week_index, weights=daily_audio, minlength=n_weeks),
+        'current_streak': int(current_streak),
+        'longest_streak': longest_run(active),
+        'hourly_messages': np.bincount(hours, minlength=24),
+    }
+
+
+def get_stats(user_id: int, today: Optional[date] = None) -> Optional[dict]:
+    """Return the (cached) statistics of a user, see `compute_stats`. It is blocking, run it in a thread."""
+    today = datetime.now().date() if today is None else today
+    with _cache_lock:
+        cached = _cache.get(user_id)
+        if cached is not None and cached[0] == today:
+            _cache.move_to_end(user_id)
+            return cached[1]
+        version = _versions.get(user_id, 0)
+    stats = compute_stats(*load_columns(user_id), today)
+    with _cache_lock:
+        # a message that arrived meanwhile might be missing
+        if _versions.get(user_id, 0) == version:
+            _cache[user_id] = (today, stats)
+            _cache.move_to_end(user_id)
+            if len(_cache) > MAX_CACHED_USERS:
+                _cache.popitem(last=False)
+    return stats
+
+
+def invalidate(user_id: int) -> None:
+    """Drop the cached statistics of a user, e.g. because they sent a new message."""
+    with _cache_lock:
+        _cache.pop(user_id, None)
+        _versions[user_id] = _versions.get(user_id, 0) + 1
+
+
+def format_stats(stats: dict) -> str:
+    """Return the statistics as a message text."""
+    recent_words = stats['daily_words'][-ROLLING_WINDOW:].sum()
+    busiest_hour = int(stats['hourly_messages'].argmax())
+    return "\n".join([
+        " STATS ".center(20, "="),
+        f"Messages: {stats['messages']} on {stats['active_days']} day(s)",
+        f"Words: {stats['words']} ({recent_words:.0f} in the last {ROLLING_WINDOW} days)",
+        f"Audio: {stats['audio'] / 60:.1f}min",
+        f"Average words per day ({ROLLING_WINDOW}-day rolling): {stats['rolling_words'][-1]:.1f}",
+        f"Current streak: {stats['current_streak']} day(s)",
+        f"Longest streak: {stats['longest_streak']} day(s)",
+        f"Most active hour: {busiest_hour:02d}:00-{busiest_hour + 1:02d}:00",
+        "=" * 20,
+    ])
+
+
+def render_chart(stats: dict) -> bytes:
+    """Render the daily words with their rolling average and the hour histogram as a PNG image."""
+    # only needed here, matplotlib takes a while to import
+    from matplotlib.figure import Figure
+
+    # a Figure without pyplot can be rendered in a thread
+    figure = Figure(figsize=(8, 6), dpi=100)
+    daily, hourly = figure.subplots(2, 1)
+    days = stats['days'].astype('datetime64[D]').astype(datetime)
+    daily.bar(days, stats['daily_words'], color='tab:blue', alpha=0.5, label='words per day')
+    daily.plot(days, stats['rolling_words'], color='tab:blue', label=f'{ROLLING_WINDOW}-day average')
+    daily.set_ylabel('words')
+    daily.legend(loc='upper left')
+    figure.autofmt_xdate()
+    hourly.bar(np.arange(24), stats['hourly_messages'], color='tab:orange')
+    hourly.set_xticks(np.arange(0, 24, 3))
+    hourly.set_xlabel('hour of the day')
+    hourly.set_ylabel('messages')
+    figure.tight_layout()
+    buffer = io.BytesIO()
+    figure.savefig(buffer, format='png')
+    return buffer.getvalue()
@@ -0,0 +1,185 @@
+"""
+This script stores the downloaded audio files by their content, and deletes them when they are not needed anymore.
+
+A file is stored under the SHA-256 hash of its content, in two levels of subdirectories
+(`ab/cd/abcd....ogg`), so no directory gets too large and the same audio (e.g. a forwarded voice
+message) is only stored once. Files are downloaded into `tmp/` first and moved into place once they
+are complete, so the store never contains partial files.
+
+The `AudioJanitor` task deletes the files that are not needed anymore. It scans the store in a
+thread, so the handlers are not blocked:
+
+- with `keep_days` 0 (the default), the audio is deleted once the voice message is transcribed,
+- otherwise after `keep_days` days,
+- if the store is larger than `max_bytes`, the oldest files are deleted first.
+
+Files of voice jobs that are still being processed (VoiceJobs table) are never deleted, and neither
+are files added within the last `GRACE_PERIOD` seconds (their voice job is about to be created).
+Audio files from before the store (`<file_id>.ogg`) are cleaned up the same way, their `.txt`
+transcriptions are left for the migration into the transcript archive (see `transcript_archive`).
+
+Configured with `"audio_store": {"keep_days": 0, "max_bytes": 1000000000, "interval": 60}` in
+`configs.json`, the files are stored in `save_paths.voice_messages`.
+"""
+import asyncio
+import hashlib
+import logging
+import os
+import time
+import uuid
+from pathlib import Path
+from typing import List, Optional, Tuple
+
+from . import database_operations as db
+from . import metrics, utils
+
+logger = logging.getLogger(__name__)
+
+CHUNK_SIZE = 1 << 20  # bytes read at a time when hashing
+GRACE_PERIOD = 60  # seconds a new file is kept in any case
+JANITOR_INTERVAL = 60  # seconds between two cleanups
+TMP_MAX_AGE = 60 * 60  # seconds after which a leftover download in tmp/ is deleted
+
+
+def hash_file(path: Path) -> str:
+    """Return the SHA-256 hex digest of a file's content."""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as file:
+        for chunk in iter(lambda: file.read(CHUNK_SIZE), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def describe_retention(keep_days: float) -> str:
+    """Return the sentence of the privacy policy about the audio files."""
+    if keep_days == 0:
+        return "Audio messages are deleted as soon as they are transcribed."
+    return f"Audio messages are deleted after {keep_days:g} days."
+
+
+class AudioStore:
+    """Content-addressed store of audio files in the directory `root`."""
+
+    def __init__(self, root: Path) -> None:
+        self.root = Path(root)
+        self.tmp = self.root / 'tmp'
+
+    def path_for(self, digest: str, suffix: str) -> Path:
+        return self.root / digest[:2] / digest[2:4] / f"{digest}{suffix}"
+
+    def new_temp_path(self, suffix: str) -> Path:
+        """Return a new path in `tmp/` to download a file to, before it is added with `add`."""
+        self.tmp.mkdir(parents=True, exist_ok=True)
+        return self.tmp / f"{uuid.uuid4().hex}{suffix}"
+
+    def add(self, temp_path: Path) -> Path:
+        """
+        Move a downloaded file into the store (it is blocking, run it in a thread).
+        Returns the path of the file in the store, which is the same for the same content.
+        """
+        path = self.path_for(hash_file(temp_path), temp_path.suffix)
+        duplicate = path.exists()
+        path.parent.mkdir(parents=True, exist_ok=True)
+        # replacing a duplicate keeps one copy, but makes it count as a new file for the retention
+        os.replace(temp_path, path)
+        metrics.increment('audio_store_files_total', result='duplicate' if duplicate else 'new')
+        return path
+
+    def files(self) -> List[Tuple[float, int, Path]]:
+        """Return (modification time, size, path) of all stored audio files, oldest first."""
+        files = []
+        for directory, subdirectories, names in os.walk(self.root):
+            if Path(directory) == self.root and 'tmp' in subdirectories:
+                subdirectories.remove('tmp')
+            for name in names:
+                if name.endswith('.txt'):
+                    continue
+                path = Path(directory) / name
+                try:
+                    stat = path.stat()
+                except FileNotFoundError:
+                    continue
+                files.append((stat.st_mtime, stat.st_size, path))
+        return sorted(files)
+
+
+def get_store() -> AudioStore:
+    """Return the audio store in the configured directory."""
+    return AudioStore(utils.get_voice_save_path())
+
+
+class AudioJanitor:
+    """Deletes the files of `store` that are not needed anymore every `interval` seconds, see the module docstring."""
+
+    def __init__(self, store: AudioStore, keep_days: float = 0, max_bytes: Optional[int] = None, interval: float = JANITOR_INTERVAL, grace_period: float = GRACE_PERIOD) -> None:
+        self.store = store
+        self.keep_days = keep_days
+        self.max_bytes = max_bytes
+        self.interval = interval
+        self.grace_period = grace_period
+        self._task = None
+
+    def start(self) -> None:
+        self._task = asyncio.create_task(self._run())
+
+    async def _run(self) -> None:
+        while True:
+            try:
+                await asyncio.to_thread(self.clean)
+            except Exception as e:
+                logger.error(f"Cleaning up the audio store failed: {e!r}")
+            await asyncio.sleep(self.interval)
+
+    def clean(self, now: Optional[float] = None) -> int:
+        """Delete the files that are not needed anymore. Returns the number of deleted files."""
+        now = time.time() if now is None else now
+        in_use = {os.path.abspath(job[5]) for job in db.get_voice_jobs()}
+        deleted = 0
+        remaining = []
+        total = 0
+        for mtime, size, path in self.store.files():
+            if now - mtime < self.grace_period or os.path.abspath(path) in in_use:
+                total += size
+                continue
+            if self.keep_days == 0 or now - mtime > self.keep_days * 24 * 60 * 60:
+                deleted += self._delete(path)
+                continue
+            remaining.append((size, path))
+            total += size
+        # over the size cap, the oldest files go first
+        for size, path in remaining:
+            if self.max_bytes is None or total <= self.max_bytes:
+                break
+            deleted += self._delete(path)
+            total -= size
+        # downloads that were interrupted
+        if self.store.tmp.exists():
+            for path in self.store.tmp.iterdir():
+                try:
+                    if now - path.stat().st_mtime > TMP_MAX_AGE:
+                        deleted += self._delete(path)
+                except FileNotFoundError:
+                    continue
+        if deleted:
+            logger.info(f"Deleted {deleted} file(s) from the audio store, {total / 1e6:.1f} MB are left.")
+        return deleted
+
+    @staticmethod
+    def _delete(path: Path) -> int:
+        try:
+            path.unlink()
+        except FileNotFoundError:
+            return 0
+        metrics.increment('audio_store_deleted_total')
+        return 1
+
+    async def close(self) -> None:
+        if self._task is None:
+            return
+        self._task.cancel()
+        await asyncio.gather(self._task, return_exceptions=True)
+        self._task = None
+
+
+metrics.describe('audio_store_files_total', 'counter', 'Number of audio files added to the store, new or duplicate content.')
+metrics.describe('audio_store_deleted_total', 'counter', 'Number of files deleted from the audio store by the janitor.')
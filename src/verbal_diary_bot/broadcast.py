@@ -0,0 +1,173 @@
+"""
+This script sends a message of an admin to all users (/broadcast).
+
+The user_ids are read from the database one page at a time, so not all users are loaded into memory,
+and the messages are sent through the bot's token bucket (shared with the reminders) below
+Telegram's global limit of about 30 messages per second. Every user gets a single message, so the
+limit of one message per second per chat is only relevant for the admin's progress message, which
+is edited every `PROGRESS_INTERVAL` seconds.
+A `RetryAfter` error pauses all sends of the bot for the requested time.
+
+A broadcast is stored in the Broadcasts table with the last user_id it was sent to and the delivery
+counts, saved after every page. After a crash or restart, `resume_broadcasts` continues the running
+broadcasts from there (at most the users of one page get the message twice after a crash, none after
+a regular shutdown). A broadcast is cancelled by setting its status, which it checks after every page,
+so it also works if another bot worker sends it.
+"""
+import asyncio
+import logging
+import time
+from datetime import datetime
+from typing import Optional
+from zoneinfo import ZoneInfo
+
+from telegram import Bot
+from telegram.error import BadRequest, Forbidden, RetryAfter, TelegramError
+from telegram.ext import Application
+
+from . import database_operations as db
+from . import metrics
+from .ratelimit import TokenBucket, get_telegram_bucket, retry_after_seconds
+
+logger = logging.getLogger(__name__)
+
+PAGE_SIZE = 100  # user_ids read at a time, the progress is stored after each page
+PROGRESS_INTERVAL = 10  # seconds between two updates of the admin's progress message
+MAX_ATTEMPTS = 3  # per user, for network errors and flood limits
+
+
+def format_progress(broadcast_id: int, status: str, total: int, sent: int, failed: int, blocked: int, elapsed: Optional[float] = None) -> str:
+    """Describe the progress of a broadcast for the admin."""
+    done = sent + failed + blocked
+    text = f"Broadcast {broadcast_id} ({status}): {done}/{total} users\nDelivered: {sent}\nBlocked the bot: {blocked}\nFailed: {failed}"
+    if elapsed:
+        text += f"\n{elapsed:.0f}s, {done / elapsed:.1f} messages/s"
+    return text
+
+
+class Broadcast:
+    """
+    Sends a stored broadcast to the users after its `last_user_id`. `run` returns the delivery counts.
+    The messages are sent through `bucket`, by default the one shared by all senders of the bot.
+    """
+
+    def __init__(self, bot: Bot, broadcast_id: int, bucket: Optional[TokenBucket] = None, page_size: int = PAGE_SIZE, progress_interval: float = PROGRESS_INTERVAL) -> None:
+        self.bot = bot
+        self.broadcast_id = broadcast_id
+        self.bucket = bucket or get_telegram_bucket(bot.token)
+        self.page_size = page_size
+        self.progress_interval = progress_interval
+        self.counts = {'sent': 0, 'failed': 0, 'blocked': 0}
+        self.last_user_id = None
+        self.status = 'running'
+        self.started = time.monotonic()
+        self.progress_message = None
+
+    async def deliver(self, user_id: int, text: str) -> str:
+        """Send the message to a user. Returns 'sent', 'blocked' or 'failed'."""
+        for attempt in range(1, MAX_ATTEMPTS + 1):
+            await self.bucket.acquire()
+            try:
+                await self.bot.send_message(chat_id=user_id, text=text)
+                return 'sent'
+            except RetryAfter as e:
+                # the flood limit holds for all chats, not only this one
+                logger.warning(f"Broadcast {self.broadcast_id} is rate limited by Telegram for {retry_after_seconds(e)}s.")
+                self.bucket.block_for(retry_after_seconds(e))
+            except Forbidden:
+                return 'blocked'
+            except BadRequest as e:
+                # e.g. the chat does not exist (anymore)
+                logger.info(f"Broadcast {self.broadcast_id} could not be sent to user {user_id}: {e}")
+                return 'failed'
+            except TelegramError as e:
+                logger.warning(f"Broadcast {self.broadcast_id} to user {user_id} failed (attempt {attempt}/{MAX_ATTEMPTS}): {e!r}")
+        return 'failed'
+
+    def progress(self, total: int) -> str:
+        return format_progress(self.broadcast_id, self.status, total, **self.counts, elapsed=time.monotonic() - self.started)
+
+    async def report(self, admin_chat_id: int, total: int) -> None:
+        """Send or update the progress message in the admin's chat."""
+        try:
+            if self.progress_message is None:
+                self.progress_message = await self.bot.send_message(chat_id=admin_chat_id, text=self.progress(total))
+            else:
+                await self.bot.edit_message_text(chat_id=admin_chat_id, message_id=self.progress_message.message_id, text=self.progress(total))
+        except TelegramError as e:
+            # the broadcast goes on without progress reports
+            logger.warning(f"Could not report the progress of broadcast {self.broadcast_id}: {e!r}")
+
+    async def save(self) -> None:
+        if self.last_user_id is not None:
+            await asyncio.to_thread(db.update_broadcast_progress, self.broadcast_id, self.last_user_id, **self.counts)
+
+    async def run(self) -> dict:
+        """Send the broadcast until all users got it or it is cancelled."""
+        _, text, admin_chat_id, self.status, self.last_user_id, total, sent, failed, blocked, _ = await asyncio.to_thread(db.get_broadcast, self.broadcast_id)
+        self.counts = {'sent': sent, 'failed': failed, 'blocked': blocked}
+        await self.report(admin_chat_id, total)
+        last_report = time.monotonic()
+        try:
+            while self.status == 'running':
+                user_ids = await asyncio.to_thread(db.get_user_ids, self.last_user_id, self.page_size)
+                for user_id in user_ids:
+                    outcome = await self.deliver(user_id, text)
+                    self.counts[outcome] += 1
+                    metrics.increment('broadcast_messages_total', outcome=outcome)
+                    self.last_user_id = user_id
+                    if time.monotonic() - last_report >= self.progress_interval:
+                        await self.report(admin_chat_id, total)
+                        last_report = time.monotonic()
+                await self.save()
+                if len(user_ids) < self.page_size:
+                    self.status = 'done'
+                    await asyncio.to_thread(db.set_broadcast_status, self.broadcast_id, self.status)
+                    break
+                # it might have been cancelled meanwhile
+                self.status = (await asyncio.to_thread(db.get_broadcast, self.broadcast_id))[3]
+        except asyncio.CancelledError:
+            # shutdown, the next start continues with the next user
+            await asyncio.shield(self.save())
+            raise
+        logger.info(f"Broadcast {self.broadcast_id} is {self.status}: {self.counts}")
+        await self.report(admin_chat_id, total)
+        return dict(self.counts)
+
+
+def launch(application: Application, broadcast_id: int) -> asyncio.Task:
+    """Run a stored broadcast in the background."""
+    # not `application.create_task`, the application would wait for it to finish before stopping
+    shard = application.bot_data.get('shard')
+    bucket = get_telegram_bucket(application.bot.token, 1 if shard is None else shard[1])
+    task = asyncio.create_task(Broadcast(application.bot, broadcast_id, bucket).run())
+    tasks = application.bot_data.setdefault('broadcasts', {})
+    tasks[broadcast_id] = task
+    task.add_done_callback(lambda _: tasks.pop(broadcast_id, None))
+    return task
+
+
+async def start_broadcast(application: Application, text: str, admin_chat_id: int) -> int:
+    """Store a new broadcast and start sending it. Returns its broadcast_id."""
+    total = await asyncio.to_thread(db.count_users)
+    broadcast_id = await asyncio.to_thread(db.insert_broadcast, text, admin_chat_id, total, datetime.now(ZoneInfo("Europe/Berlin")))
+    launch(application, broadcast_id)
+    return broadcast_id
+
+
+async def resume_broadcasts(application: Application) -> None:
+    """Continue the broadcasts that were interrupted by the last shutdown."""
+    for broadcast in await asyncio.to_thread(db.get_running_broadcasts):
+        logger.info(f"Resuming broadcast {broadcast[0]} after user {broadcast[4]}.")
+        launch(application, broadcast[0])
+
+
+async def stop_broadcasts(application: Application) -> None:
+    """Interrupt the running broadcasts on shutdown, they are resumed on the next start."""
+    tasks = list(application.bot_data.get('broadcasts', {}).values())
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+
+
+metrics.describe('broadcast_messages_total', 'counter', 'Number of broadcast messages by outcome (sent, blocked, failed).')
@@ -2,11 +2,15 @@
 database_operations.py
 
 This module provides a set of functions to interact with the SQLite database for a Telegram bot application. It includes functionalities to create, read, update, and delete (CRUD) data related to users and messages.
+The user and message operations are passed to the storage backend selected in the config (SQLite or PostgreSQL, see `storage.py`).
 
 Functions:
     connect_db() -> sqlite3.Connection:
         Establishes and returns a connection to the SQLite database.
 
+    get_storage() -> Storage:
+        Returns the storage backend of the users and messages.
+
     insert_user(user_id: int, name: str, notion_token: str) -> None:
         Inserts a new user record into the Users table.
 
@@ -31,135 +35,710 @@ Functions:
     delete_message(message_id: int) -> None:
         Deletes a message's record from the Messages table.
 
+    insert_outbox_entry(user_id: int, database_id: str, title: str, heading: str, message: str) -> int:
+        Inserts a pending Notion write into the NotionOutbox table.
+
 This module is intended to be used as a part of the Telegram bot application, facilitating the management of database operations in a centralized and organized manner.
 """
 
 import sqlite3
+import time
 from datetime import datetime
+from typing import Optional
 from zoneinfo import ZoneInfo
-import random
 
 from verbal_diary_bot import utils
+from verbal_diary_bot.storage import DB_TIMEOUT, get_storage
 
 
 def connect_db():
-    """Create a database connection."""
+    """Create a connection to the SQLite database (the tables besides Users and Messages are always kept there)."""
     db_path = utils.get_db_path()
-    conn = sqlite3.connect(db_path)
+    conn = sqlite3.connect(db_path, timeout=DB_TIMEOUT)
     return conn
 
+def enable_wal() -> None:
+    """
+    Switch the database to write-ahead logging, so several processes can read while one writes.
+    The setting is stored in the database file.
+    """
+    conn = connect_db()
+    conn.execute('PRAGMA journal_mode=WAL')
+    conn.close()
+
+def create_tables() -> None:
+    """Create the Users and Messages tables in the storage backend, if they do not exist yet."""
+    get_storage().create_tables()
+
 def insert_user(user_id: int, name: str, notion_token: str, database_id: str):
     """Insert a new user into the Users table."""
+    get_storage().insert_user(user_id, name, notion_token, database_id)
+
+def get_user(user_id: int):
+    """Retrieve a user's details by user_id."""
+    return get_storage().get_user(user_id)
+
+def get_all_users() -> list:
+    """Retrieve all users from the Users table."""
+    return get_storage().get_all_users()
+
+def get_user_ids(after: Optional[int], limit: int) -> list:
+    """Retrieve a page of up to `limit` user_ids after the user_id `after` (from the start with None), in ascending order."""
+    return get_storage().get_user_ids(after, limit)
+
+def count_users() -> int:
+    """Return the number of users."""
+    return get_storage().count_users()
+
+def update_user(user_id: int, name: str, notion_token: str, database_id: str):
+    """Update a user's information in the Users table."""
+    get_storage().update_user(user_id, name, notion_token, database_id)
+    
+def insert_message(user_id:int, date:datetime, message: str, word_count: str, message_type: str, audio_length: float) -> int:
+    """
+        Insert a new message into the Messages table.
+        Returns the message_id of the newly inserted message.
+    """
+    return get_storage().insert_message(user_id, date, message, word_count, message_type, audio_length)
+    
+def get_message(message_id) -> tuple:
+    """Retrieve a message's details by message_id."""
+    return get_storage().get_message(message_id)
+
+def get_all_messages() -> list:
+    """Retrieve all messages from the Messages table."""
+    return get_storage().get_all_messages()
+
+def get_messages_by_user(user_id: int) -> list:
+    """Retrieve all messages sent by a user."""
+    return get_storage().get_messages_by_user(user_id)
+
+def get_message_stats_by_user(user_id: int) -> list:
+    """Retrieve (date, word_count, audio_length) of all messages sent by a user, without the texts."""
+    return get_storage().get_message_stats_by_user(user_id)
+
+def get_last_message_dates(user_ids: list) -> dict:
+    """Return the date string of the last message of each of the users (those with messages), with one indexed query per 500 users."""
+    return get_storage().get_last_message_dates(user_ids)
+
+def delete_user(user_id: int) -> None:
+    """Delete a user's record from the Users and Messages table."""
+    get_storage().delete_user(user_id)
+
+def anonymize_user(user_id: int):
+    """Anonymize a user's record in the Users and Messages table. Returns their surrogate user_id, or None if they do not exist."""
+    return get_storage().anonymize_user(user_id)
+
+def anonymize_users(user_ids: list) -> dict:
+    """Anonymize several users in one transaction. Returns their surrogate user_ids (the users that exist)."""
+    return get_storage().anonymize_users(user_ids)
+
+
+def user_exists(user_id) -> bool:
+    """Check if a user exists in the database."""
+    return get_storage().user_exists(user_id)
+
+OUTBOX_FIELDS = [
+    'outbox_id INTEGER PRIMARY KEY AUTOINCREMENT',
+    'user_id INTEGER',
+    'database_id TEXT',
+    'title TEXT',
+    'heading TEXT',
+    'message TEXT',
+    'attempts INTEGER DEFAULT 0',
+    'next_attempt REAL DEFAULT 0',
+    'last_error TEXT',
+    'written INTEGER DEFAULT 0',  # blocks of the entry that were appended before a failed request
+]
+
+def create_outbox_table() -> None:
+    """Create the NotionOutbox table (pending Notion writes) if it does not exist yet."""
     conn = connect_db()
     cursor = conn.cursor()
-    cursor.execute('INSERT INTO Users (user_id, name, notion_token, database_id) VALUES (?, ?, ?, ?)', (user_id, name, notion_token, database_id))
+    cursor.execute(f'CREATE TABLE IF NOT EXISTS NotionOutbox ({", ".join(OUTBOX_FIELDS)})')
+    # tables of older versions have no written yet
+    columns = [row[1] for row in cursor.execute('PRAGMA table_info(NotionOutbox)')]
+    if 'written' not in columns:
+        cursor.execute('ALTER TABLE NotionOutbox ADD COLUMN written INTEGER DEFAULT 0')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_notion_outbox_user ON NotionOutbox (user_id)')
     conn.commit()
     conn.close()
 
-def get_user(user_id: int):
-    """Retrieve a user's details by user_id."""
+def insert_outbox_entry(user_id: int, database_id: str, title: str, heading: str, message: str) -> int:
+    """
+        Insert a pending Notion write into the NotionOutbox table.
+        Returns the outbox_id of the new entry.
+    """
+    conn = connect_db()
+    cursor = conn.cursor()
+    cursor.execute('INSERT INTO NotionOutbox (user_id, database_id, title, heading, message) VALUES (?, ?, ?, ?, ?)', (user_id, database_id, title, heading, message))
+    outbox_id = cursor.lastrowid
+    conn.commit()
+    conn.close()
+    return outbox_id
+
+def get_outbox_entries(limit: int = 1000) -> list:
+    """Retrieve the oldest pending Notion writes, in the order they were inserted."""
     conn = connect_db()
     cursor = conn.cursor()
-    cursor.execute('SELECT * FROM Users WHERE user_id = ?', (user_id,))
-    user_data = cursor.fetchone()
+    cursor.execute('SELECT * FROM NotionOutbox ORDER BY outbox_id LIMIT ?', (limit,))
+    entries = cursor.fetchall()
     conn.close()
-    return user_data
+    return entries
 
-def get_all_users() -> list:
-    """Retrieve all users from the Users table."""
+def delete_outbox_entries(outbox_ids: list) -> None:
+    """Delete delivered (or undeliverable) entries from the NotionOutbox table."""
     conn = connect_db()
     cursor = conn.cursor()
-    cursor.execute('SELECT * FROM Users')
-    user_data = cursor.fetchall()
+    cursor.executemany('DELETE FROM NotionOutbox WHERE outbox_id = ?', [(outbox_id,) for outbox_id in outbox_ids])
+    conn.commit()
     conn.close()
-    return user_data
 
-def update_user(user_id: int, name: str, notion_token: str, database_id: str):
-    """Update a user's information in the Users table."""
+def mark_outbox_entries_failed(outbox_ids: list, next_attempt: float, error: str) -> None:
+    """Count a failed delivery attempt and set the time of the next one."""
     conn = connect_db()
     cursor = conn.cursor()
-    cursor.execute('UPDATE Users SET name = ?, notion_token = ?, database_id = ? WHERE user_id = ?', (name, notion_token, database_id, user_id))
+    cursor.executemany(
+        'UPDATE NotionOutbox SET attempts = attempts + 1, next_attempt = ?, last_error = ? WHERE outbox_id = ?',
+        [(next_attempt, error, outbox_id) for outbox_id in outbox_ids]
+    )
     conn.commit()
     conn.close()
-    
-def insert_message(user_id:int, date:datetime, message: str, word_count: str, message_type: str, audio_length: float) -> int:
+
+def set_outbox_entry_written(outbox_id: int, written: int) -> None:
+    """Store how many blocks of an entry are appended already, so a retry only appends the rest."""
+    conn = connect_db()
+    cursor = conn.cursor()
+    cursor.execute('UPDATE NotionOutbox SET written = ? WHERE outbox_id = ?', (written, outbox_id))
+    conn.commit()
+    conn.close()
+
+def get_outbox_status(user_id: int) -> tuple:
+    """Return the number of pending Notion writes of a user and the last error."""
+    conn = connect_db()
+    cursor = conn.cursor()
+    cursor.execute(
+        'SELECT COUNT(*), (SELECT last_error FROM NotionOutbox WHERE user_id = ? AND last_error IS NOT NULL ORDER BY outbox_id DESC LIMIT 1) '
+        'FROM NotionOutbox WHERE user_id = ?', (user_id, user_id)
+    )
+    status = cursor.fetchone()
+    conn.close()
+    return status
+
+def delete_outbox_entries_by_user(user_id: int) -> None:
+    """Delete the pending Notion writes of a user, e.g. when they deregister."""
+    conn = connect_db()
+    cursor = conn.cursor()
+    cursor.execute('DELETE FROM NotionOutbox WHERE user_id = ?', (user_id,))
+    conn.commit()
+    conn.close()
+
+NOTION_PAGES_FIELDS = [
+    'page_id TEXT PRIMARY KEY',
+    'user_id INTEGER',
+    'database_id TEXT',
+    'title TEXT',
+    'content TEXT',
+    'created_time TEXT',
+    'last_edited_time TEXT',
+]
+NOTION_SYNC_FIELDS = [
+    'user_id INTEGER',
+    'database_id TEXT',
+    'last_edited_time TEXT',
+    'PRIMARY KEY (user_id, database_id)',
+]
+
+def create_notion_mirror_tables() -> None:
+    """Create the tables that mirror the users' Notion pages, if they do not exist yet."""
+    conn = connect_db()
+    cursor = conn.cursor()
+    cursor.execute(f'CREATE TABLE IF NOT EXISTS NotionPages ({", ".join(NOTION_PAGES_FIELDS)})')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_notion_pages_user_title ON NotionPages (user_id, title)')
+    cursor.execute(f'CREATE TABLE IF NOT EXISTS NotionSync ({", ".join(NOTION_SYNC_FIELDS)})')
+    conn.commit()
+    conn.close()
+
+def get_notion_pages(user_id: int, page_ids: list) -> dict:
+    """Return the last_edited_time of the given mirrored pages of a user, keyed by page_id."""
+    conn = connect_db()
+    cursor = conn.cursor()
+    edited = {}
+    for page_id in page_ids:
+        cursor.execute('SELECT last_edited_time FROM NotionPages WHERE page_id = ? AND user_id = ?', (page_id, user_id))
+        row = cursor.fetchone()
+        if row is not None:
+            edited[page_id] = row[0]
+    conn.close()
+    return edited
+
+def upsert_notion_pages(pages: list) -> None:
+    """Insert or update mirrored pages, given as (page_id, user_id, database_id, title, content, created_time, last_edited_time) tuples."""
+    conn = connect_db()
+    cursor = conn.cursor()
+    cursor.executemany('INSERT OR REPLACE INTO NotionPages VALUES (?, ?, ?, ?, ?, ?, ?)', pages)
+    conn.commit()
+    conn.close()
+
+def delete_notion_pages(page_ids: list) -> None:
+    """Remove pages from the mirror, e.g. because they were archived."""
+    conn = connect_db()
+    cursor = conn.cursor()
+    cursor.executemany('DELETE FROM NotionPages WHERE page_id = ?', [(page_id,) for page_id in page_ids])
+    conn.commit()
+    conn.close()
+
+def delete_notion_mirror_by_user(user_id: int) -> None:
+    """Delete the mirrored pages and sync cursors of a user, e.g. when they deregister."""
+    conn = connect_db()
+    cursor = conn.cursor()
+    cursor.execute('DELETE FROM NotionPages WHERE user_id = ?', (user_id,))
+    cursor.execute('DELETE FROM NotionSync WHERE user_id = ?', (user_id,))
+    conn.commit()
+    conn.close()
+
+def get_notion_sync_cursor(user_id: int, database_id: str):
+    """Return the last_edited_time up to which a user's Notion database is mirrored, or None."""
+    conn = connect_db()
+    cursor = conn.cursor()
+    cursor.execute('SELECT last_edited_time FROM NotionSync WHERE user_id = ? AND database_id = ?', (user_id, database_id))
+    row = cursor.fetchone()
+    conn.close()
+    return None if row is None else row[0]
+
+def set_notion_sync_cursor(user_id: int, database_id: str, last_edited_time: str) -> None:
+    """Store the last_edited_time up to which a user's Notion database is mirrored."""
+    conn = connect_db()
+    cursor = conn.cursor()
+    cursor.execute('INSERT OR REPLACE INTO NotionSync (user_id, database_id, last_edited_time) VALUES (?, ?, ?)', (user_id, database_id, last_edited_time))
+    conn.commit()
+    conn.close()
+
+def find_notion_page_by_title(user_id: int, database_id: str, title: str):
+    """Return the page_id of the oldest mirrored page with the given title, or None."""
+    conn = connect_db()
+    cursor = conn.cursor()
+    cursor.execute(
+        'SELECT page_id FROM NotionPages WHERE user_id = ? AND database_id = ? AND title = ? ORDER BY created_time LIMIT 1',
+        (user_id, database_id, title)
+    )
+    row = cursor.fetchone()
+    conn.close()
+    return None if row is None else row[0]
+
+def find_duplicate_notion_pages(user_id: int) -> list:
+    """Return (title, number of pages) for all titles that appear on more than one mirrored page of a user."""
+    conn = connect_db()
+    cursor = conn.cursor()
+    cursor.execute('SELECT title, COUNT(*) FROM NotionPages WHERE user_id = ? GROUP BY database_id, title HAVING COUNT(*) > 1', (user_id,))
+    duplicates = cursor.fetchall()
+    conn.close()
+    return duplicates
+
+def search_notion_pages(user_id: int, text: str) -> list:
+    """Return (page_id, title) of the mirrored pages of a user that contain the given text."""
+    conn = connect_db()
+    cursor = conn.cursor()
+    pattern = '%' + text.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_') + '%'
+    cursor.execute(
+        "SELECT page_id, title FROM NotionPages WHERE user_id = ? AND (content LIKE ? ESCAPE '\\' OR title LIKE ? ESCAPE '\\') ORDER BY last_edited_time DESC",
+        (user_id, pattern, pattern)
+    )
+    pages = cursor.fetchall()
+    conn.close()
+    return pages
+
+VOICE_JOBS_FIELDS = [
+    'job_id INTEGER PRIMARY KEY AUTOINCREMENT',
+    'user_id INTEGER',
+    'chat_id INTEGER',
+    'file_id TEXT',
+    'message_type TEXT',
+    'save_path TEXT',
+    'audio_length REAL',
+    'date TEXT',
+    'transcription TEXT',
+]
+PENDING_UPDATES_FIELDS = [
+    'update_id INTEGER PRIMARY KEY',
+    'data TEXT',
+]
+PROCESSED_UPDATES_FIELDS = [
+    'chat_id INTEGER',
+    'message_id INTEGER',
+    'update_id INTEGER',
+    'processed INTEGER',  # seconds since the epoch
+    'PRIMARY KEY (chat_id, message_id)',
+]
+
+def create_checkpoint_tables() -> None:
     """
-        Insert a new message into the Messages table.
-        Returns the message_id of the newly inserted message.
+    Create the tables that keep the work interrupted by a shutdown, if they do not exist yet:
+    VoiceJobs (voice messages being processed), PendingUpdates (updates not handled yet) and
+    ProcessedUpdates (voice messages that were taken on, so they are not processed twice).
+    """
+    conn = connect_db()
+    cursor = conn.cursor()
+    cursor.execute(f'CREATE TABLE IF NOT EXISTS VoiceJobs ({", ".join(VOICE_JOBS_FIELDS)})')
+    cursor.execute(f'CREATE TABLE IF NOT EXISTS PendingUpdates ({", ".join(PENDING_UPDATES_FIELDS)})')
+    # the rows are stored in the primary key index itself, without a separate rowid table
+    cursor.execute(f'CREATE TABLE IF NOT EXISTS ProcessedUpdates ({", ".join(PROCESSED_UPDATES_FIELDS)}) WITHOUT ROWID')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_processed_updates_processed ON ProcessedUpdates (processed)')
+    conn.commit()
+    conn.close()
+
+def insert_voice_job(user_id: int, chat_id: int, file_id: str, message_type: str, save_path: str, audio_length: float, date: datetime, message_id: Optional[int] = None, update_id: Optional[int] = None) -> Optional[int]:
+    """
+        Insert a downloaded voice message that is being processed into the VoiceJobs table.
+        Returns the job_id of the new entry.
+        With the message_id, the message is marked as processed in the same transaction, and if it
+        already was (a duplicate delivery), no job is inserted and None is returned.
     """
     date_str = date.strftime('%Y-%m-%d %H:%M:%S %z')
     conn = connect_db()
     cursor = conn.cursor()
-    cursor.execute('INSERT INTO Messages (user_id, date, message, word_count, message_type, audio_length) VALUES (?, ?, ?, ?, ?, ?)', (user_id, date_str, message, word_count, message_type, audio_length))
-    # get the message_id from the last inserted row
-    message_id = cursor.lastrowid
+    if message_id is not None:
+        cursor.execute(
+            'INSERT OR IGNORE INTO ProcessedUpdates (chat_id, message_id, update_id, processed) VALUES (?, ?, ?, ?)',
+            (chat_id, message_id, update_id, int(time.time()))
+        )
+        if cursor.rowcount == 0:
+            conn.close()
+            return None
+    cursor.execute(
+        'INSERT INTO VoiceJobs (user_id, chat_id, file_id, message_type, save_path, audio_length, date) VALUES (?, ?, ?, ?, ?, ?, ?)',
+        (user_id, chat_id, file_id, message_type, save_path, audio_length, date_str)
+    )
+    job_id = cursor.lastrowid
     conn.commit()
     conn.close()
-    return message_id
-    
-def get_message(message_id) -> tuple:
-    """Retrieve a message's details by message_id."""
+    return job_id
+
+def set_voice_job_transcription(job_id: int, transcription: str) -> None:
+    """Store the transcription of a voice job, so it does not have to be transcribed again."""
     conn = connect_db()
     cursor = conn.cursor()
-    cursor.execute('SELECT * FROM Messages WHERE message_id = ?', (message_id,))
-    message_data = cursor.fetchone()
+    cursor.execute('UPDATE VoiceJobs SET transcription = ? WHERE job_id = ?', (transcription, job_id))
+    conn.commit()
     conn.close()
-    return message_data
 
-def get_all_messages() -> list:
-    """Retrieve all messages from the Messages table."""
+def delete_voice_job(job_id: int) -> None:
+    """Delete a finished voice job."""
     conn = connect_db()
     cursor = conn.cursor()
-    cursor.execute('SELECT * FROM Messages')
-    message_data = cursor.fetchall()
+    cursor.execute('DELETE FROM VoiceJobs WHERE job_id = ?', (job_id,))
+    conn.commit()
     conn.close()
-    return message_data
 
-def get_messages_by_user(user_id: int) -> list:
-    """Retrieve all messages sent by a user."""
+def get_voice_jobs() -> list:
+    """Retrieve the unfinished voice jobs, oldest first."""
     conn = connect_db()
     cursor = conn.cursor()
-    cursor.execute('SELECT * FROM Messages WHERE user_id = ?', (user_id,))
-    message_data = cursor.fetchall()
+    cursor.execute('SELECT * FROM VoiceJobs ORDER BY job_id')
+    jobs = cursor.fetchall()
     conn.close()
-    return message_data
+    return jobs
 
-def delete_user(user_id: int) -> None:
-    """Delete a user's record from the Users and Messages table."""
+def is_message_processed(chat_id: int, message_id: int) -> bool:
+    """Check if a message was taken on already, with a lookup in the primary key of ProcessedUpdates."""
     conn = connect_db()
     cursor = conn.cursor()
-    cursor.execute('DELETE FROM Users WHERE user_id = ?', (user_id,))
-    cursor.execute('DELETE FROM Messages WHERE user_id = ?', (user_id,))
+    cursor.execute('SELECT 1 FROM ProcessedUpdates WHERE chat_id = ? AND message_id = ?', (chat_id, message_id))
+    processed = cursor.fetchone() is not None
+    conn.close()
+    return processed
+
+def expire_processed_updates(before: float) -> int:
+    """Delete the entries of the messages processed before the given time (seconds since the epoch). Returns their number."""
+    conn = connect_db()
+    cursor = conn.cursor()
+    cursor.execute('DELETE FROM ProcessedUpdates WHERE processed < ?', (int(before),))
+    deleted = cursor.rowcount
     conn.commit()
     conn.close()
+    return deleted
 
-def anonymize_user(user_id: int) -> None:
-    """Anonymize a user's record in the Users and Messages table."""
+def delete_voice_jobs_by_user(user_id: int) -> list:
+    """Delete the unfinished voice jobs of a user. Returns the save_paths of their audio files."""
     conn = connect_db()
     cursor = conn.cursor()
-    # cursor.execute('DELETE FROM Users WHERE user_id = ?', (user_id,))
-    # cursor.execute('DELETE FROM Messages WHERE user_id = ?', (user_id,))
-    # delete notion token and database id
-    cursor.execute('UPDATE Users SET name = NULL, notion_token = NULL, database_id = NULL WHERE user_id = ?', (user_id,))
-    # set all entries of message in Message table of the user to NULL
-    cursor.execute('UPDATE Messages SET message = NULL WHERE user_id = ?', (user_id,))
-    
-    random_user_id = int(f"999{random.randint(1000000000, 9999999999)}")
-    # change user_id to a randomly generated number of 10 digits in both tables
-    cursor.execute('UPDATE Users SET user_id = ? WHERE user_id = ?', (random_user_id, user_id))
-    cursor.execute('UPDATE Messages SET user_id = ? WHERE user_id = ?', (random_user_id, user_id))
+    cursor.execute('SELECT save_path FROM VoiceJobs WHERE user_id = ?', (user_id,))
+    save_paths = [row[0] for row in cursor.fetchall()]
+    cursor.execute('DELETE FROM VoiceJobs WHERE user_id = ?', (user_id,))
     conn.commit()
     conn.close()
+    return save_paths
 
+def insert_pending_updates(updates: list) -> None:
+    """Store updates (tuples of update_id and JSON data) that could not be handled before a shutdown."""
+    conn = connect_db()
+    cursor = conn.cursor()
+    cursor.executemany('INSERT OR REPLACE INTO PendingUpdates (update_id, data) VALUES (?, ?)', updates)
+    conn.commit()
+    conn.close()
 
-def user_exists(user_id) -> bool:
-    """Check if a user exists in the database."""
+def get_pending_updates() -> list:
+    """Retrieve the stored updates (update_id, data), in the order of their update_id."""
+    conn = connect_db()
+    cursor = conn.cursor()
+    cursor.execute('SELECT update_id, data FROM PendingUpdates ORDER BY update_id')
+    updates = cursor.fetchall()
+    conn.close()
+    return updates
+
+def delete_pending_updates(update_ids: list) -> None:
+    """Delete stored updates that were queued again."""
+    conn = connect_db()
+    cursor = conn.cursor()
+    cursor.executemany('DELETE FROM PendingUpdates WHERE update_id = ?', [(update_id,) for update_id in update_ids])
+    conn.commit()
+    conn.close()
+
+TRANSCRIPT_INDEX_FIELDS = [
+    'file_id TEXT PRIMARY KEY',
+    'segment TEXT',
+    'offset INTEGER',
+    'length INTEGER',
+    'user_id INTEGER',  # 0 if the user is not known, NULL for entries of older versions
+]
+
+def create_transcript_index_table() -> None:
+    """Create the TranscriptIndex table (where a transcription is in the transcript archive) if it does not exist yet."""
+    conn = connect_db()
+    cursor = conn.cursor()
+    cursor.execute(f'CREATE TABLE IF NOT EXISTS TranscriptIndex ({", ".join(TRANSCRIPT_INDEX_FIELDS)})')
+    # tables of older versions have no user_id yet
+    columns = [row[1] for row in cursor.execute('PRAGMA table_info(TranscriptIndex)')]
+    if 'user_id' not in columns:
+        cursor.execute('ALTER TABLE TranscriptIndex ADD COLUMN user_id INTEGER')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_transcript_index_user ON TranscriptIndex (user_id)')
+    conn.commit()
+    conn.close()
+
+def insert_transcript_index_entries(entries: list) -> None:
+    """Insert or update index entries, given as (file_id, segment, offset, length, user_id) tuples."""
+    conn = connect_db()
+    cursor = conn.cursor()
+    cursor.executemany('INSERT OR REPLACE INTO TranscriptIndex (file_id, segment, offset, length, user_id) VALUES (?, ?, ?, ?, ?)', entries)
+    conn.commit()
+    conn.close()
+
+def get_transcript_index_entries_by_user(user_id) -> list:
+    """Retrieve (file_id, segment, offset, length) of the archived transcriptions of a user, None for the entries without user_id."""
+    conn = connect_db()
+    cursor = conn.cursor()
+    if user_id is None:
+        cursor.execute('SELECT file_id, segment, offset, length FROM TranscriptIndex WHERE user_id IS NULL')
+    else:
+        cursor.execute('SELECT file_id, segment, offset, length FROM TranscriptIndex WHERE user_id = ?', (user_id,))
+    entries = cursor.fetchall()
+    conn.close()
+    return entries
+
+def set_transcript_index_users(user_ids: list) -> None:
+    """Set the user_id of index entries, given as (user_id, file_id) tuples."""
+    conn = connect_db()
+    cursor = conn.cursor()
+    cursor.executemany('UPDATE TranscriptIndex SET user_id = ? WHERE file_id = ?', user_ids)
+    conn.commit()
+    conn.close()
+
+def delete_transcript_index_entries(file_ids: list) -> None:
+    """Delete the index entries of deleted transcriptions."""
+    conn = connect_db()
+    cursor = conn.cursor()
+    cursor.executemany('DELETE FROM TranscriptIndex WHERE file_id = ?', [(file_id,) for file_id in file_ids])
+    conn.commit()
+    conn.close()
+
+def get_transcript_index_entry(file_id: str):
+    """Return (segment, offset, length) of the transcription of a file in the archive, or None."""
+    conn = connect_db()
+    cursor = conn.cursor()
+    cursor.execute('SELECT segment, offset, length FROM TranscriptIndex WHERE file_id = ?', (file_id,))
+    entry = cursor.fetchone()
+    conn.close()
+    return entry
+
+REMINDER_PREFERENCES_FIELDS = [
+    'user_id INTEGER PRIMARY KEY',
+    'enabled INTEGER',
+    'time TEXT',
+    'timezone TEXT',
+    'inactive_days INTEGER',
+    'last_sent REAL',
+]
+
+def create_reminder_table() -> None:
+    """Create the ReminderPreferences table (when to remind a user to write in their diary) if it does not exist yet."""
+    conn = connect_db()
+    cursor = conn.cursor()
+    cursor.execute(f'CREATE TABLE IF NOT EXISTS ReminderPreferences ({", ".join(REMINDER_PREFERENCES_FIELDS)})')
+    conn.commit()
+    conn.close()
+
+def set_reminder_preferences(user_id: int, enabled: bool, time: str, timezone: str, inactive_days: int) -> None:
+    """Insert or update the reminder preferences of a user. The time of the last reminder is kept."""
+    conn = connect_db()
+    cursor = conn.cursor()
+    cursor.execute(
+        'INSERT INTO ReminderPreferences (user_id, enabled, time, timezone, inactive_days) VALUES (?, ?, ?, ?, ?) '
+        'ON CONFLICT (user_id) DO UPDATE SET enabled = excluded.enabled, time = excluded.time, timezone = excluded.timezone, inactive_days = excluded.inactive_days',
+        (user_id, int(enabled), time, timezone, inactive_days)
+    )
+    conn.commit()
+    conn.close()
+
+def get_reminder_preferences(user_id: int):
+    """Return (enabled, time, timezone, inactive_days, last_sent) of a user, or None if they never set them."""
     conn = connect_db()
     cursor = conn.cursor()
-    cursor.execute('SELECT EXISTS(SELECT 1 FROM Users WHERE user_id = ? LIMIT 1)', (user_id,))
-    exists = cursor.fetchone()[0]
+    cursor.execute('SELECT enabled, time, timezone, inactive_days, last_sent FROM ReminderPreferences WHERE user_id = ?', (user_id,))
+    preferences = cursor.fetchone()
+    conn.close()
+    return preferences
+
+def disable_reminders(user_id: int) -> None:
+    """Turn off the reminders of a user, keeping their other preferences."""
+    conn = connect_db()
+    cursor = conn.cursor()
+    cursor.execute('UPDATE ReminderPreferences SET enabled = 0 WHERE user_id = ?', (user_id,))
+    conn.commit()
+    conn.close()
+
+def get_enabled_reminders() -> list:
+    """Retrieve (user_id, time, timezone, inactive_days, last_sent) of all users with enabled reminders."""
+    conn = connect_db()
+    cursor = conn.cursor()
+    cursor.execute('SELECT user_id, time, timezone, inactive_days, last_sent FROM ReminderPreferences WHERE enabled = 1')
+    reminders = cursor.fetchall()
+    conn.close()
+    return reminders
+
+def set_reminders_sent(user_ids: list, sent_at: float) -> None:
+    """Store the time (seconds since the epoch) the users were last reminded."""
+    conn = connect_db()
+    cursor = conn.cursor()
+    cursor.executemany('UPDATE ReminderPreferences SET last_sent = ? WHERE user_id = ?', [(sent_at, user_id) for user_id in user_ids])
+    conn.commit()
+    conn.close()
+
+def delete_reminder_preferences(user_id: int) -> None:
+    """Delete the reminder preferences of a user, e.g. when they deregister."""
+    conn = connect_db()
+    cursor = conn.cursor()
+    cursor.execute('DELETE FROM ReminderPreferences WHERE user_id = ?', (user_id,))
+    conn.commit()
+    conn.close()
+
+BROADCASTS_FIELDS = [
+    'broadcast_id INTEGER PRIMARY KEY AUTOINCREMENT',
+    'text TEXT',
+    'admin_chat_id INTEGER',
+    'status TEXT',
+    'last_user_id INTEGER',
+    'total INTEGER',
+    'sent INTEGER DEFAULT 0',
+    'failed INTEGER DEFAULT 0',
+    'blocked INTEGER DEFAULT 0',
+    'created TEXT',
+]
+
+def create_broadcast_table() -> None:
+    """Create the Broadcasts table (messages to all users and how far they got) if it does not exist yet."""
+    conn = connect_db()
+    cursor = conn.cursor()
+    cursor.execute(f'CREATE TABLE IF NOT EXISTS Broadcasts ({", ".join(BROADCASTS_FIELDS)})')
+    conn.commit()
+    conn.close()
+
+def insert_broadcast(text: str, admin_chat_id: int, total: int, created: datetime) -> int:
+    """Insert a new running broadcast. Returns its broadcast_id."""
+    conn = connect_db()
+    cursor = conn.cursor()
+    cursor.execute(
+        'INSERT INTO Broadcasts (text, admin_chat_id, status, total, created) VALUES (?, ?, ?, ?, ?)',
+        (text, admin_chat_id, 'running', total, created.strftime('%Y-%m-%d %H:%M:%S %z'))
+    )
+    broadcast_id = cursor.lastrowid
+    conn.commit()
+    conn.close()
+    return broadcast_id
+
+def get_broadcast(broadcast_id: int):
+    """Return (broadcast_id, text, admin_chat_id, status, last_user_id, total, sent, failed, blocked, created), or None."""
+    conn = connect_db()
+    cursor = conn.cursor()
+    cursor.execute('SELECT * FROM Broadcasts WHERE broadcast_id = ?', (broadcast_id,))
+    broadcast = cursor.fetchone()
+    conn.close()
+    return broadcast
+
+def get_running_broadcasts() -> list:
+    """Retrieve the broadcasts that are not finished (or cancelled) yet, oldest first."""
+    conn = connect_db()
+    cursor = conn.cursor()
+    cursor.execute("SELECT * FROM Broadcasts WHERE status = 'running' ORDER BY broadcast_id")
+    broadcasts = cursor.fetchall()
+    conn.close()
+    return broadcasts
+
+def update_broadcast_progress(broadcast_id: int, last_user_id: int, sent: int, failed: int, blocked: int) -> None:
+    """Store up to which user_id a broadcast was sent, and its delivery counts."""
+    conn = connect_db()
+    cursor = conn.cursor()
+    cursor.execute(
+        'UPDATE Broadcasts SET last_user_id = ?, sent = ?, failed = ?, blocked = ? WHERE broadcast_id = ?',
+        (last_user_id, sent, failed, blocked, broadcast_id)
+    )
+    conn.commit()
+    conn.close()
+
+def set_broadcast_status(broadcast_id: int, status: str) -> None:
+    """Set the status of a broadcast: 'running', 'done' or 'cancelled'."""
+    conn = connect_db()
+    cursor = conn.cursor()
+    cursor.execute('UPDATE Broadcasts SET status = ? WHERE broadcast_id = ?', (status, broadcast_id))
+    conn.commit()
+    conn.close()
+
+DEREGISTRATIONS_FIELDS = [
+    'user_id INTEGER PRIMARY KEY',
+    'requested TEXT',
+]
+
+def create_deregistration_table() -> None:
+    """Create the Deregistrations table (users waiting to be anonymized) if it does not exist yet."""
+    conn = connect_db()
+    cursor = conn.cursor()
+    cursor.execute(f'CREATE TABLE IF NOT EXISTS Deregistrations ({", ".join(DEREGISTRATIONS_FIELDS)})')
+    conn.commit()
+    conn.close()
+
+def insert_deregistration(user_id: int, requested: datetime) -> None:
+    """Queue a user to be anonymized. A user that is queued already keeps their place."""
+    conn = connect_db()
+    cursor = conn.cursor()
+    cursor.execute('INSERT OR IGNORE INTO Deregistrations (user_id, requested) VALUES (?, ?)', (user_id, requested.strftime('%Y-%m-%d %H:%M:%S %z')))
+    conn.commit()
+    conn.close()
+
+def get_deregistrations() -> list:
+    """Retrieve the user_ids waiting to be anonymized, in the order they were queued."""
+    conn = connect_db()
+    cursor = conn.cursor()
+    cursor.execute('SELECT user_id FROM Deregistrations ORDER BY rowid')
+    user_ids = [row[0] for row in cursor.fetchall()]
+    conn.close()
+    return user_ids
+
+def delete_deregistrations(user_ids: list) -> None:
+    """Remove anonymized users from the queue."""
+    conn = connect_db()
+    cursor = conn.cursor()
+    cursor.executemany('DELETE FROM Deregistrations WHERE user_id = ?', [(user_id,) for user_id in user_ids])
+    conn.commit()
     conn.close()
-    return exists == 1
 
 def get_last_message_of_user(user_id):
     """Retrieve the last message sent by a user."""
@@ -0,0 +1,115 @@
+"""
+This script anonymizes the users who deregister, in the background.
+
+When a user confirms /deregister, they are only queued in the Deregistrations table and get the
+confirmation right away. A background task then anonymizes the queued users in batches of
+`BATCH_SIZE`, each batch in one transaction (`Storage.anonymize_users`): their details and message
+texts are removed, and both are moved to a random user_id that is not taken, so the statistics are
+kept. Then the rest of their data is deleted: reminder preferences, unfinished voice jobs and their
+audio files, pending Notion writes, the mirror of their Notion pages, their transcriptions in the
+transcript archive, their search index and cached statistics. The `.txt` transcriptions of older
+versions (and the archive records migrated from them) did not store the user, so they cannot be
+attributed to anyone and are not deleted; the privacy policy says so.
+
+A user leaves the queue only when all of this is done, so after a crash they are processed again on
+the next start, every step can be repeated. With several bot workers, each one processes its users.
+Stored audio files are shared by content (a forwarded voice message), so those of finished messages
+are not deleted here but by the `AudioJanitor`, after the configured retention.
+"""
+import asyncio
+import logging
+import os
+from datetime import datetime
+from typing import Optional, Tuple
+from zoneinfo import ZoneInfo
+
+from telegram.ext import Application
+
+from . import database_operations as db
+from . import analytics, metrics, semantic_search, transcript_archive
+from .sharding import in_shard
+
+logger = logging.getLogger(__name__)
+
+BATCH_SIZE = 50  # users anonymized in one transaction
+
+
+def delete_user_data(user_id: int) -> None:
+    """Delete the data of a user that is kept outside of the Users and Messages tables. It is blocking, run it in a thread."""
+    db.delete_reminder_preferences(user_id)
+    db.delete_outbox_entries_by_user(user_id)
+    db.delete_notion_mirror_by_user(user_id)
+    save_paths = db.delete_voice_jobs_by_user(user_id)
+    # the same audio might belong to a voice job of another user
+    in_use = {os.path.abspath(job[5]) for job in db.get_voice_jobs()}
+    for save_path in save_paths:
+        if os.path.abspath(save_path) not in in_use:
+            try:
+                os.remove(save_path)
+            except FileNotFoundError:
+                pass
+    transcript_archive.get_archive().purge_user(user_id)
+    semantic_search.delete_user_index(user_id)
+    analytics.invalidate(user_id)
+
+
+def anonymize_users(user_ids: list) -> dict:
+    """
+    Anonymize the users and delete their other data. It is blocking, run it in a thread.
+    Returns the new user_id of each user that existed.
+    """
+    new_user_ids = db.anonymize_users(user_ids)
+    for user_id in user_ids:
+        delete_user_data(user_id)
+    metrics.increment('users_anonymized_total', len(new_user_ids))
+    return new_user_ids
+
+
+def process_queue(shard: Optional[Tuple[int, int]] = None, batch_size: int = BATCH_SIZE) -> int:
+    """Anonymize the queued users (of the `shard`) batch by batch. It is blocking, run it in a thread. Returns the number of users."""
+    processed = 0
+    while True:
+        user_ids = [user_id for user_id in db.get_deregistrations() if in_shard(user_id, shard)][:batch_size]
+        if not user_ids:
+            return processed
+        anonymize_users(user_ids)
+        db.delete_deregistrations(user_ids)
+        processed += len(user_ids)
+        logger.info(f"Anonymized {len(user_ids)} deregistered user(s).")
+
+
+async def run(application: Application) -> None:
+    """Process the queue, one task at a time: a task that waits for the lock finds the users queued meanwhile."""
+    lock = application.bot_data.setdefault('deregistration_lock', asyncio.Lock())
+    async with lock:
+        try:
+            await asyncio.to_thread(process_queue, application.bot_data.get('shard'))
+        except Exception as e:
+            # the users stay queued until the next start
+            logger.error(f"Anonymizing the deregistered users failed: {e!r}")
+
+
+def launch(application: Application) -> asyncio.Task:
+    """Process the queue in the background."""
+    # the application would only wait for tasks of `application.create_task` while it is running
+    task = asyncio.create_task(run(application))
+    tasks = application.bot_data.setdefault('deregistrations', set())
+    tasks.add(task)
+    task.add_done_callback(tasks.discard)
+    return task
+
+
+async def request_deregistration(application: Application, user_id: int) -> None:
+    """Queue a user to be anonymized and start processing the queue."""
+    await asyncio.to_thread(db.insert_deregistration, user_id, datetime.now(ZoneInfo("Europe/Berlin")))
+    if 'reminders' in application.bot_data:
+        application.bot_data['reminders'].remove(user_id)
+    launch(application)
+
+
+async def finish_deregistrations(application: Application) -> None:
+    """Wait for the running anonymizations on shutdown, they are not interrupted halfway."""
+    await asyncio.gather(*application.bot_data.get('deregistrations', set()), return_exceptions=True)
+
+
+metrics.describe('users_anonymized_total', 'counter', 'Number of deregistered users that were anonymized.')
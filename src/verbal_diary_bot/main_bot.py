@@ -1,11 +1,21 @@
+import asyncio
 import logging
+from datetime import datetime
+from typing import Optional
 from telegram import Update
-from telegram.ext import filters, MessageHandler, ApplicationBuilder, ContextTypes, CommandHandler
+from telegram.ext import filters, MessageHandler, Application, ApplicationBuilder, ContextTypes, CommandHandler
 
 
 import verbal_diary_bot as vdb
-from verbal_diary_bot import utils
-from verbal_diary_bot.telegram_handlers import voice, audio, register_handler, deregister_handler, echo
+from verbal_diary_bot import utils, analytics, notion_async, metrics, watchdog, profiler, webhook, sharding, shutdown, storage, audio_store, transcript_archive, reminders, broadcast, semantic_search, deregistration
+from verbal_diary_bot.notion_writer import NotionWriter
+from verbal_diary_bot.notion_sync import NotionSyncer
+from verbal_diary_bot.watchdog import LoopWatchdog
+from verbal_diary_bot.audio_store import AudioJanitor
+from verbal_diary_bot.reminders import ReminderScheduler
+from verbal_diary_bot.webhook import PerChatUpdateProcessor
+from verbal_diary_bot.shutdown import DrainingApplication
+from verbal_diary_bot.telegram_handlers import voice, audio, register_handler, deregister_handler, echo, is_admin, resume_voice_jobs
 
 logging.basicConfig(
     format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
@@ -28,10 +38,235 @@ async def unknown(update: Update, context: ContextTypes.DEFAULT_TYPE):
 async def user_stats(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user = vdb.user.User(update.effective_user.id, update.effective_user.username)
     await context.bot.send_message(chat_id=update.effective_chat.id, text=user.get_user_info())
-
-if __name__ == '__main__':
-    application = ApplicationBuilder().token(utils.get_telegram_token()).build()
     
+async def sync_status(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    pending, last_error = vdb.database_operations.get_outbox_status(update.effective_user.id)
+    if pending == 0:
+        text = u"\u2705 All transcriptions are appended to Notion."
+    else:
+        text = f"{pending} transcription(s) waiting to be appended to Notion."
+        if last_error is not None:
+            text += f"\nLast error: {last_error}"
+    await context.bot.send_message(chat_id=update.effective_chat.id, text=text)
+
+async def stats(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Send the statistics of the user's diary with a chart."""
+    # loading the messages and rendering the chart take a moment, the other updates go on meanwhile
+    result = await asyncio.to_thread(analytics.get_stats, update.effective_user.id)
+    if result is None:
+        await context.bot.send_message(chat_id=update.effective_chat.id, text="No statistics yet, send me a voice message first.")
+        return
+    chart = await asyncio.to_thread(analytics.render_chart, result)
+    await context.bot.send_photo(chat_id=update.effective_chat.id, photo=chart, caption=analytics.format_stats(result))
+
+async def ask(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Answer a question about the user's diary: /ask when did I last talk about my job?"""
+    question = ' '.join(context.args)
+    if not question:
+        await context.bot.send_message(chat_id=update.effective_chat.id, text="Usage: /ask <question>, e.g. /ask when did I last talk about my job?")
+        return
+    try:
+        # the search and the chat model are blocking
+        text = await asyncio.to_thread(semantic_search.answer, update.effective_user.id, question)
+    except Exception as e:
+        logging.error(f"Answering a question failed: {e!r}")
+        try:
+            # the matching entries are still helpful, unless the search itself failed (e.g. the embedder is down)
+            results = await asyncio.to_thread(semantic_search.search, update.effective_user.id, question)
+        except Exception as e:
+            logging.error(f"Searching the diary failed: {e!r}")
+            text = "Sorry, I could not search your diary right now. Please try again later."
+        else:
+            text = "Sorry, I could not answer that right now. These entries match your question:\n\n" + semantic_search.format_results(results)
+    if text is None:
+        text = "I did not find anything about that in your diary."
+    await context.bot.send_message(chat_id=update.effective_chat.id, text=text[:4096])
+
+async def reminder(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Show or change the reminder settings: /reminder, /reminder HH:MM [timezone] [days] or /reminder off."""
+    user_id = update.effective_user.id
+    scheduler = context.bot_data.get('reminders')
+    if not context.args:
+        text = reminders.describe(vdb.database_operations.get_reminder_preferences(user_id))
+    elif context.args[0].lower() == 'off':
+        vdb.database_operations.disable_reminders(user_id)
+        if scheduler is not None:
+            scheduler.remove(user_id)
+        text = "Reminders are off."
+    else:
+        try:
+            time_of_day, timezone, inactive_days = reminders.parse_preferences(context.args)
+        except ValueError as e:
+            await context.bot.send_message(chat_id=update.effective_chat.id, text=f"{e}\n{reminders.USAGE}")
+            return
+        vdb.database_operations.set_reminder_preferences(user_id, True, time_of_day, timezone, inactive_days)
+        if scheduler is not None:
+            scheduler.schedule(user_id, time_of_day, timezone, inactive_days)
+        text = reminders.describe((True, time_of_day, timezone, inactive_days))
+    await context.bot.send_message(chat_id=update.effective_chat.id, text=text)
+
+@is_admin
+async def profile(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Profile the bot for N seconds (/profile N), then send the collapsed stacks and a summary."""
+    try:
+        seconds = float(context.args[0]) if context.args else 30
+    except ValueError:
+        await context.bot.send_message(chat_id=update.effective_chat.id, text="Usage: /profile [seconds]")
+        return
+    if context.bot_data.get('profiling'):
+        await context.bot.send_message(chat_id=update.effective_chat.id, text="A profile is already running.")
+        return
+    seconds = min(max(seconds, 1), profiler.MAX_DURATION)
+    context.bot_data['profiling'] = True
+    await context.bot.send_message(chat_id=update.effective_chat.id, text=f"Profiling for {seconds:.0f}s ...")
+    # updates are handled one after the other, so the profile must not block this handler
+    context.application.create_task(send_profile(seconds, context, update.effective_chat.id))
+
+@is_admin
+async def broadcast_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Send a message to all users: /broadcast <text>. Without text, list the running broadcasts."""
+    # the text after the command, with its line breaks
+    parts = update.message.text.split(maxsplit=1)
+    if len(parts) < 2:
+        running = vdb.database_operations.get_running_broadcasts()
+        text = "Usage: /broadcast <text>, /cancel_broadcast <id>"
+        for broadcast_id, _, _, status, _, total, sent, failed, blocked, _ in running:
+            text += "\n\n" + broadcast.format_progress(broadcast_id, status, total, sent, failed, blocked)
+        await context.bot.send_message(chat_id=update.effective_chat.id, text=text)
+        return
+    await broadcast.start_broadcast(context.application, parts[1], update.effective_chat.id)
+
+@is_admin
+async def cancel_broadcast(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Cancel a running broadcast: /cancel_broadcast <id>. It stops after the current page of users."""
+    try:
+        broadcast_id = int(context.args[0])
+    except (IndexError, ValueError):
+        await context.bot.send_message(chat_id=update.effective_chat.id, text="Usage: /cancel_broadcast <id>")
+        return
+    row = vdb.database_operations.get_broadcast(broadcast_id)
+    if row is None or row[3] != 'running':
+        await context.bot.send_message(chat_id=update.effective_chat.id, text=f"Broadcast {broadcast_id} is not running.")
+        return
+    vdb.database_operations.set_broadcast_status(broadcast_id, 'cancelled')
+    await context.bot.send_message(chat_id=update.effective_chat.id, text=f"Broadcast {broadcast_id} is cancelled.")
+
+async def send_profile(seconds: float, context: ContextTypes.DEFAULT_TYPE, chat_id: int):
+    try:
+        result = await profiler.profile(seconds)
+    finally:
+        context.bot_data['profiling'] = False
+    file_name = f"profile-{datetime.now().strftime('%Y%m%d-%H%M%S')}.collapsed"
+    await context.bot.send_document(chat_id=chat_id, document=result.collapsed().encode(), filename=file_name, caption="Collapsed stacks, e.g. for flamegraph.pl or speedscope.app")
+    await context.bot.send_message(chat_id=chat_id, text=result.summary())
+
+async def post_init(application: Application):
+    # with several workers, this is the (index, count) of this worker's users
+    shard = application.bot_data.get('shard')
+    # expose the latency histograms and counters for Prometheus, if configured
+    metrics_config = utils.get_metrics_config()
+    if metrics_config is not None:
+        # every worker gets its own port after the configured one
+        port = metrics_config['port'] if shard is None else metrics_config['port'] + 1 + shard[0]
+        metrics.start_http_server(port, metrics_config.get('host', '127.0.0.1'))
+    # report callbacks that block the event loop, if configured
+    watchdog_config = utils.get_watchdog_config()
+    if watchdog_config is not None:
+        loop_watchdog = LoopWatchdog(watchdog_config.get('threshold', watchdog.THRESHOLD), watchdog_config.get('interval', watchdog.INTERVAL))
+        loop_watchdog.start()
+        application.bot_data['watchdog'] = loop_watchdog
+    # the Users and Messages tables, e.g. in a new PostgreSQL database
+    vdb.database_operations.create_tables()
+    # the work that was interrupted by the last shutdown is picked up at the end
+    vdb.database_operations.create_checkpoint_tables()
+    # the messages processed long ago are forgotten, with several workers the first one does it
+    if shard is None or shard[0] == 0:
+        await shutdown.expire_processed_updates()
+        if application.job_queue is not None:
+            application.job_queue.run_repeating(shutdown.expire_processed_updates, interval=shutdown.EXPIRY_INTERVAL, first=shutdown.EXPIRY_INTERVAL, name='expire_processed_updates')
+    # transcriptions are written to Notion in batches, through the outbox in the database
+    notion_writer = NotionWriter(shard=shard)
+    notion_writer.start()
+    application.bot_data['notion_writer'] = notion_writer
+    # mirror the users' Notion pages into the local database
+    notion_syncer = NotionSyncer(shard=shard)
+    notion_syncer.start()
+    application.bot_data['notion_syncer'] = notion_syncer
+    # delete the audio files that are not needed anymore, with several workers the first one does it
+    if shard is None or shard[0] == 0:
+        audio_store_config = utils.get_audio_store_config()
+        audio_janitor = AudioJanitor(audio_store.get_store(), audio_store_config.get('keep_days', 0), audio_store_config.get('max_bytes'), audio_store_config.get('interval', audio_store.JANITOR_INTERVAL))
+        audio_janitor.start()
+        application.bot_data['audio_janitor'] = audio_janitor
+    # remind inactive users to write in their diary, on the job queue (needs python-telegram-bot[job-queue])
+    vdb.database_operations.create_reminder_table()
+    if application.job_queue is not None:
+        scheduler = ReminderScheduler(shard=shard)
+        await asyncio.to_thread(scheduler.load)
+        application.job_queue.run_repeating(scheduler.tick, interval=reminders.TICK_INTERVAL, first=reminders.TICK_INTERVAL, name='reminders')
+        application.bot_data['reminders'] = scheduler
+    else:
+        logging.warning("No job queue, reminders are not sent. Install python-telegram-bot[job-queue].")
+    # messages to all users, those interrupted by the last shutdown are continued by the first worker
+    vdb.database_operations.create_broadcast_table()
+    if shard is None or shard[0] == 0:
+        await broadcast.resume_broadcasts(application)
+    # users who deregistered before the last shutdown and are not anonymized yet
+    vdb.database_operations.create_deregistration_table()
+    deregistration.launch(application)
+    # pick up the work that was interrupted by the last shutdown, in the order it was received: the
+    # voice messages that were being processed (they need the notion writer), then the updates that
+    # were waiting behind them. New updates are only fetched after post_init, so they come last.
+    try:
+        await resume_voice_jobs(application, shard)
+    except Exception as e:
+        logging.error(f"Resuming the interrupted voice jobs failed: {e!r}")
+    await shutdown.restore_pending_updates(application, shard)
+
+async def post_shutdown(application: Application):
+    # the broadcasts continue after the next start
+    await broadcast.stop_broadcasts(application)
+    await deregistration.finish_deregistrations(application)
+    # try to deliver the outbox once more, then close the pooled Notion clients
+    await application.bot_data['notion_syncer'].close()
+    await application.bot_data['notion_writer'].close()
+    await notion_async.close_clients()
+    storage.close_storages()
+    transcript_archive.close_archives()
+    if 'audio_janitor' in application.bot_data:
+        await application.bot_data['audio_janitor'].close()
+    if 'watchdog' in application.bot_data:
+        await application.bot_data['watchdog'].close()
+
+def build_application(token: Optional[str] = None, base_url: Optional[str] = None, base_file_url: Optional[str] = None, concurrent_updates: Optional[int] = None) -> Application:
+    """
+    Build the bot application with all handlers.
+
+    Parameters
+    ----------
+    token : Optional[str], optional
+        The Telegram bot token, by default the one in `configs.json`.
+    base_url : Optional[str], optional
+        The Telegram Bot API URL (e.g. of a local test server), by default the one in `configs.json`
+        or else the official one.
+    base_file_url : Optional[str], optional
+        The Telegram URL to download files from, by default the one in `configs.json` or else the
+        official one.
+    concurrent_updates : Optional[int], optional
+        Number of updates handled at the same time (those of one chat are still handled in order),
+        by default one update after the other.
+    """
+    builder = ApplicationBuilder().token(token or utils.get_telegram_token()).application_class(DrainingApplication).post_init(post_init).post_shutdown(post_shutdown)
+    base_url = base_url or utils.get_telegram_base_url()
+    if base_url is not None:
+        builder = builder.base_url(base_url)
+    base_file_url = base_file_url or utils.get_telegram_base_file_url()
+    if base_file_url is not None:
+        builder = builder.base_file_url(base_file_url)
+    if concurrent_updates is not None:
+        builder = builder.concurrent_updates(PerChatUpdateProcessor(concurrent_updates))
+    application = builder.build()
+
     # add user registration handler
     application.add_handler(register_handler)
     # add user deregistration handler
@@ -44,11 +279,36 @@ if __name__ == '__main__':
     application.add_handler(caps_handler)
     user_stats_handler = CommandHandler('user_stats', user_stats)
     application.add_handler(user_stats_handler)
+    sync_status_handler = CommandHandler('sync_status', sync_status)
+    application.add_handler(sync_status_handler)
+    stats_handler = CommandHandler('stats', stats)
+    application.add_handler(stats_handler)
+    ask_handler = CommandHandler('ask', ask)
+    application.add_handler(ask_handler)
+    reminder_handler = CommandHandler('reminder', reminder)
+    application.add_handler(reminder_handler)
+    broadcast_handler = CommandHandler('broadcast', broadcast_command)
+    application.add_handler(broadcast_handler)
+    cancel_broadcast_handler = CommandHandler('cancel_broadcast', cancel_broadcast)
+    application.add_handler(cancel_broadcast_handler)
+    profile_handler = CommandHandler('profile', profile)
+    application.add_handler(profile_handler)
     unknown_handler = MessageHandler(filters.COMMAND, unknown)
     application.add_handler(unknown_handler)
     voice_handler = MessageHandler(filters.VOICE, voice)
     application.add_handler(voice_handler)
     audio_handler = MessageHandler(filters.AUDIO, audio)
-    application.add_handler(audio_handler)   
-    
-    application.run_polling()
\ No newline at end of file
+    application.add_handler(audio_handler)
+    return application
+
+if __name__ == '__main__':
+    webhook_config = utils.get_webhook_config()
+    workers = utils.get_worker_count()
+    if workers > 1:
+        asyncio.run(sharding.serve_sharded(workers, webhook_config))
+    elif webhook_config is None:
+        application = build_application()
+        application.run_polling()
+    else:
+        application = build_application(concurrent_updates=webhook_config.get('max_concurrent_updates', webhook.MAX_CONCURRENT_UPDATES))
+        asyncio.run(webhook.serve_webhook(application, webhook_config))
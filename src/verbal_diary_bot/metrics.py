@@ -0,0 +1,149 @@
+"""
+This script collects latency histograms and counters and exposes them in the Prometheus text format.
+
+Usage:
+    with metrics.timer('transcription'):
+        ...
+    metrics.increment('retries_total', service='notion')
+
+If `metrics` is configured in `configs.json` (e.g. `{"host": "127.0.0.1", "port": 9100}`),
+`start_http_server` serves everything on `http://host:port/metrics`.
+"""
+import logging
+import threading
+import time
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+logger = logging.getLogger(__name__)
+
+PREFIX = 'vdb_'
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0)
+
+_lock = threading.Lock()
+_help = {}  # metric name -> (type, help text)
+_counters = {}  # (name, labels) -> value
+_histograms = {}  # (name, labels) -> [bucket counts..., count, sum]
+
+
+def _labels(labels: dict) -> tuple:
+    return tuple(sorted((key, str(value)) for key, value in labels.items()))
+
+
+def describe(name: str, kind: str, help: str) -> None:
+    """Set the type ('counter' or 'histogram') and help text of a metric."""
+    _help[name] = (kind, help)
+
+
+def increment(name: str, amount: float = 1, **labels) -> None:
+    """Increase a counter."""
+    key = (name, _labels(labels))
+    with _lock:
+        _counters[key] = _counters.get(key, 0) + amount
+
+
+def observe(name: str, value: float, **labels) -> None:
+    """Add an observation (e.g. a duration in seconds) to a histogram."""
+    key = (name, _labels(labels))
+    with _lock:
+        histogram = _histograms.get(key)
+        if histogram is None:
+            histogram = _histograms[key] = [0] * (len(BUCKETS) + 2)
+        for i, bound in enumerate(BUCKETS):
+            if value <= bound:
+                histogram[i] += 1
+        histogram[-2] += 1
+        histogram[-1] += value
+
+
+@contextmanager
+def timer(stage: str, **labels):
+    """Measure the duration of a stage. Exceptions are counted as errors of the stage and re-raised."""
+    start = time.perf_counter()
+    try:
+        yield
+    except Exception as e:
+        increment('stage_errors_total', stage=stage, error=type(e).__name__, **labels)
+        raise
+    finally:
+        observe('stage_duration_seconds', time.perf_counter() - start, stage=stage, **labels)
+
+
+def get_count(name: str, **labels) -> float:
+    """Return the value of a counter, or the number of observations of a histogram."""
+    key = (name, _labels(labels))
+    with _lock:
+        if key in _histograms:
+            return _histograms[key][-2]
+        return _counters.get(key, 0)
+
+
+def reset() -> None:
+    """Remove all collected values."""
+    with _lock:
+        _counters.clear()
+        _histograms.clear()
+
+
+def _format_labels(labels: tuple, extra: tuple = ()) -> str:
+    labels = labels + extra
+    if not labels:
+        return ''
+    escaped = (value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, value in labels)
+    return '{' + ','.join(f'{key}="{value}"' for (key, _), value in zip(labels, escaped)) + '}'
+
+
+def render() -> str:
+    """Return all metrics in the Prometheus text exposition format."""
+    lines = []
+    with _lock:
+        counters = sorted(_counters.items())
+        histograms = sorted(_histograms.items())
+    described = set()
+    for (name, labels), value in counters:
+        if name not in described:
+            described.add(name)
+            lines.append(f'# HELP {PREFIX}{name} {_help.get(name, ("counter", name))[1]}')
+            lines.append(f'# TYPE {PREFIX}{name} counter')
+        lines.append(f'{PREFIX}{name}{_format_labels(labels)} {value}')
+    for (name, labels), histogram in histograms:
+        if name not in described:
+            described.add(name)
+            lines.append(f'# HELP {PREFIX}{name} {_help.get(name, ("histogram", name))[1]}')
+            lines.append(f'# TYPE {PREFIX}{name} histogram')
+        for bound, count in zip(BUCKETS, histogram):
+            lines.append(f'{PREFIX}{name}_bucket{_format_labels(labels, (("le", repr(bound)),))} {count}')
+        lines.append(f'{PREFIX}{name}_bucket{_format_labels(labels, (("le", "+Inf"),))} {histogram[-2]}')
+        lines.append(f'{PREFIX}{name}_count{_format_labels(labels)} {histogram[-2]}')
+        lines.append(f'{PREFIX}{name}_sum{_format_labels(labels)} {histogram[-1]}')
+    return '\n'.join(lines) + '\n'
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split('?')[0] != '/metrics':
+            self.send_error(404)
+            return
+        data = render().encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, *args):
+        pass
+
+
+def start_http_server(port: int, host: str = '127.0.0.1') -> ThreadingHTTPServer:
+    """Serve the metrics on http://host:port/metrics from a background thread."""
+    server = ThreadingHTTPServer((host, port), _MetricsHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name='metrics-server', daemon=True).start()
+    logger.info(f"Serving metrics on http://{host}:{server.server_address[1]}/metrics")
+    return server
+
+
+describe('stage_duration_seconds', 'histogram', 'Duration of the stages of handling a message.')
+describe('stage_errors_total', 'counter', 'Number of stages that raised an exception.')
+describe('retries_total', 'counter', 'Number of retried requests to external services.')
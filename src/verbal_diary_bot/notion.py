@@ -1,13 +1,25 @@
 from datetime import datetime
-from typing import Union, List, Literal
+import json
+import re
+from typing import Union, List, Literal, Optional
 from pprint import pprint
 
-from notion_client import Client
+from notion_client import Client, APIResponseError, APIErrorCode
 
 from . import utils
 
 COLORS = Literal['default', 'gray', 'brown', 'orange', 'yellow', 'green', 'blue', 'purple', 'pink', 'red']
 NOTION_PAR_LIM = 2000  # max number of characters in a Notion paragraph block
+NOTION_RICH_TEXT_LIM = 100  # max number of rich text objects in a block
+NOTION_PAGE_SIZE = 100  # max number of results per database query
+NOTION_CHILDREN_LIM = 100  # max number of blocks appended in one request
+NOTION_PAYLOAD_LIM = 450_000  # max size of the blocks of one request in bytes (Notion allows 500KB per request)
+
+SENTENCE_END = re.compile(r'[.!?\u2026]["\')\]]*\s+')  # end of a sentence, including the following whitespace
+WORD_END = re.compile(r'\s+')
+
+# page_id of each weekly page, keyed by (database_id, title)
+_weekly_page_cache = {}
 
 
 class Notion:
@@ -23,7 +35,13 @@ class Notion:
         self.client = Client(auth=NOTION_TOKEN)
         
     def create_page_in_database(self, database_id: str, title: str):
+        new_page_properties = self.create_page_properties(title)
+        # create new page
+        new_page = self.client.pages.create(parent={"database_id": database_id}, properties=new_page_properties)
         
+        return new_page
+    
+    def create_page_properties(self, title: str) -> dict:
         # New page's properties and content
         new_page_properties = {
             "Title": {
@@ -48,13 +66,37 @@ class Notion:
             }
             # Add other properties as needed
         }
+        return new_page_properties
+    
+    def query_database(self, database_id: str, filter: Optional[dict] = None) -> List[dict]:
+        """
+        Query a database and follow the pagination until all matching pages are fetched.
 
-        # create new page
-        new_page = self.client.pages.create(parent={"database_id": database_id}, properties=new_page_properties)
-        
-        return new_page
+        Parameters
+        ----------
+        database_id : str
+            The ID of the database to query.
+        filter : Optional[dict], optional
+            A Notion filter object, by default None (all pages).
+
+        Returns
+        -------
+        list[dict]
+            The raw page objects returned by the Notion API.
+        """
+        query = {"database_id": database_id, "page_size": NOTION_PAGE_SIZE}
+        if filter is not None:
+            query["filter"] = filter
+        results = []
+        while True:
+            response = self.client.databases.query(**query)
+            results.extend(response["results"])
+            if not response.get("has_more"):
+                break
+            query["start_cursor"] = response["next_cursor"]
+        return results
     
-    def get_pages_from_database(self, database_id: str):
+    def get_pages_from_database(self, database_id: str, title: Optional[str] = None):
         """
         Get all pages from a given database and return the existing page IDs and page names.
 
@@ -62,28 +104,38 @@ class Notion:
         ----------
         database_id : str
             The ID of the database to get pages from.
+        title : Optional[str], optional
+            If given, only pages with exactly this title are returned. The filtering
+            is done by Notion, so only the matching pages are downloaded.
 
         Returns
         -------
         list[dict]
             A list of dictionaries containing the page ID and page name. (keys: "id", "name")
         """
-        # get all pages from database
-        response = self.client.databases.query(database_id=database_id)
+        page_title = self.PAGE_PROPERTIES[0]
+        filter = None
+        if title is not None:
+            filter = {"property": page_title, "title": {"equals": title}}
+        response = self.query_database(database_id, filter)
         
         # extract page names and IDs
-        page_title = self.PAGE_PROPERTIES[0]
-        pages_info = []
-        for page in response["results"]:
-            page_id = page["id"]
-            if page["properties"][page_title]["title"] == []:
-                page_name = ""
-            else:
-                page_name = page["properties"][page_title]["title"][0]["text"]["content"]  # Adjust this based on your database's structure
-            pages_info.append({"id": page_id, "name": page_name})
-                
+        pages_info = [{"id": page["id"], "name": self.get_page_name(page)} for page in response]
         return pages_info
     
+    def get_page_name(self, page: dict) -> str:
+        """Return the title of a page object returned by the Notion API."""
+        page_title = self.PAGE_PROPERTIES[0]
+        if page["properties"][page_title]["title"] == []:
+            return ""
+        return page["properties"][page_title]["title"][0]["text"]["content"]  # Adjust this based on your database's structure
+    
+    def archive_page(self, page_id: str):
+        """Archive (i.e. delete) a page and drop it from the weekly page cache."""
+        response = self.client.pages.update(page_id=page_id, archived=True)
+        invalidate_cached_page(page_id)
+        return response
+    
     def create_block_paragraph(self, text_to_add: str, text_color: COLORS='default'):
         # Corrected content structure with rich_text field
         paragraph_block = {
@@ -132,14 +184,30 @@ class Notion:
         response = self.client.blocks.children.append(block_id=page_id, children=blocks)
         return response
     
+    def create_paragraph_blocks(self, text: str, text_color: COLORS='default') -> List[dict]:
+        """
+        Pack a text of any length into as few paragraph blocks as possible.
+        The text is split into pieces of at most NOTION_PAR_LIM characters at sentence or word
+        boundaries, and each block is filled with up to NOTION_RICH_TEXT_LIM of these pieces
+        (as long as the block still fits into a single request).
+        """
+        blocks, rich_text, size = [], [], 0
+        for segment in split_text(text):
+            item = {"type": "text", "text": {"content": segment}, "annotations": {"color": text_color}}
+            item_size = len(json.dumps(item, ensure_ascii=False).encode()) + 1
+            if rich_text and (len(rich_text) == NOTION_RICH_TEXT_LIM or size + item_size > NOTION_PAYLOAD_LIM - 100):
+                blocks.append({"object": "block", "type": "paragraph", "paragraph": {"rich_text": rich_text}})
+                rich_text, size = [], 0
+            rich_text.append(item)
+            size += item_size
+        blocks.append({"object": "block", "type": "paragraph", "paragraph": {"rich_text": rich_text}})
+        return blocks
+    
     def create_transcription_block(self, header:str, text:str):
         # create the header block
         header_block = self.create_block_header(header, heading='###')
-        # create the paragraph block
-        paragraph_block = self.create_block_paragraph(text)
-        # append the two blocks
-        blocks = [header_block, paragraph_block]
-        return blocks
+        # create the paragraph blocks
+        return [header_block] + self.create_paragraph_blocks(text)
 
 
 def append_transcription(token: str, database_id: str, page_properties: str, transcription: dict):
@@ -165,33 +233,101 @@ def append_transcription(token: str, database_id: str, page_properties: str, tra
     notion = Notion(token, database_id, page_properties)
     
     title = create_page_title()
+    page_id = get_or_create_weekly_page(notion, title)
+    # append the transcription to the new page
+    heading, text = get_transcription_heading(), transcription['text']
+    print(heading, text)
+    blocks = notion.create_transcription_block(heading, text)
+    # append the blocks to the new page, long transcriptions need several requests
+    responses = []
+    for chunk in chunk_blocks(blocks):
+        try:
+            response = notion.add_blocks_to_page(page_id, chunk)
+        except APIResponseError as e:
+            if responses or not is_missing_page_error(e):
+                raise
+            # the cached page was archived in the meantime, look it up (or create it) again
+            invalidate_cached_page(page_id)
+            page_id = get_or_create_weekly_page(notion, title)
+            response = notion.add_blocks_to_page(page_id, chunk)
+        responses.append(response)
+    return responses[-1]
+
+
+def split_text(text: str, limit: int = NOTION_PAR_LIM) -> List[str]:
+    """
+    Split a text into pieces of at most `limit` characters. Pieces end at a sentence boundary if there
+    is one in the second half of the piece, otherwise at a word boundary. Only words longer than
+    `limit` are cut. Joining the pieces gives back the original text.
+    """
+    pieces = []
+    start = 0
+    while len(text) - start > limit:
+        window = text[start:start + limit]
+        cut = 0
+        for match in SENTENCE_END.finditer(window, limit // 2):
+            cut = match.end()
+        if cut == 0:
+            for match in WORD_END.finditer(window, 1):
+                cut = match.end()
+        if cut == 0:
+            cut = limit
+        pieces.append(text[start:start + cut])
+        start += cut
+    pieces.append(text[start:])
+    return pieces
+
+
+def chunk_blocks(blocks: List[dict], max_children: int = NOTION_CHILDREN_LIM, max_bytes: int = NOTION_PAYLOAD_LIM) -> List[List[dict]]:
+    """
+    Split a list of blocks into consecutive chunks that can each be appended with one request,
+    i.e. with at most `max_children` blocks and a JSON body of at most `max_bytes` bytes.
+    """
+    chunks, chunk, chunk_size = [], [], 0
+    for block in blocks:
+        size = len(json.dumps(block, ensure_ascii=False).encode()) + 1  # +1 for the separating comma
+        if chunk and (len(chunk) == max_children or chunk_size + size > max_bytes):
+            chunks.append(chunk)
+            chunk, chunk_size = [], 0
+        chunk.append(block)
+        chunk_size += size
+    if chunk:
+        chunks.append(chunk)
+    return chunks
+
+
+def get_or_create_weekly_page(notion: Notion, title: str) -> str:
+    """
+    Return the ID of the page with the given title, creating the page if it does not exist yet.
+    The page ID is cached, so subsequent calls for the same week do not hit the Notion API.
+    """
     # does a page with the current week number already exist?
     page_id = get_page_from_database_by_title(notion, title)
     if page_id is False:
         page = notion.create_page_in_database(notion.DATABASE_ID, title)
         page_id = page['id']
-    # append the transcription to the new page
-    heading, text = get_transcription_heading(), transcription['text']
-    print(heading, text)
-    blocks = []
-    header_block = notion.create_block_header(heading, heading='###')
-    blocks.append(header_block)
-    # create the paragraph block
-    if len(text) > NOTION_PAR_LIM:
-        for x in range(0, len(text), NOTION_PAR_LIM):
-            block = notion.create_block_paragraph(text[x:x+NOTION_PAR_LIM])
-            blocks.append(block)
-    else:
-        block = notion.create_block_paragraph(text)
-        blocks.append(block)
-    # append the blocks to the new page
-    response = notion.add_blocks_to_page(page_id, blocks)
-    return response
+        _weekly_page_cache[(notion.DATABASE_ID, title)] = page_id
+    return page_id
+
+
+def invalidate_cached_page(page_id: str) -> None:
+    """Remove a page from the weekly page cache, e.g. because it was archived."""
+    for key, cached_id in list(_weekly_page_cache.items()):
+        if cached_id == page_id:
+            del _weekly_page_cache[key]
+
+
+def is_missing_page_error(error: APIResponseError) -> bool:
+    """Check whether a Notion error means that the page is gone (deleted or archived)."""
+    if error.code == APIErrorCode.ObjectNotFound:
+        return True
+    return error.code == APIErrorCode.ValidationError and 'archived' in str(error)
 
 
 def get_page_from_database_by_title(notion:Notion, title:str):
     """
     Check if a page with the given title exists in the database and return the page ID.
+    Found pages are cached per (database, title), so the lookup is only done once per week.
 
     Parameters
     ----------
@@ -205,11 +341,15 @@ def get_page_from_database_by_title(notion:Notion, title:str):
     Union[str, None]
         If the page exists, return the page ID, otherwise return False.
     """
-    # get all pages from database
-    pages = notion.get_pages_from_database(notion.DATABASE_ID)
+    key = (notion.DATABASE_ID, title)
+    if key in _weekly_page_cache:
+        return _weekly_page_cache[key]
+    # only download the pages with a matching title
+    pages = notion.get_pages_from_database(notion.DATABASE_ID, title=title)
     # iterate over pages and return the page ID if the title matches
     for page in pages:
         if page['name'] == title:
+            _weekly_page_cache[key] = page['id']
             return page['id']
     
     return False
@@ -75,24 +75,25 @@ class Notion:
 
         res = requests.patch(url, json=payload, headers=self.headers)
         return res
-    
-    
-NOTION_TOKEN  = "secret_akufRDBcruwCW8E62hTVvrefbJtpEskd9hOdoDJZpAC"
-DATABASE_ID = "3d23e0e454e04767bb4d4b856b613e0c"
-notion  = Notion(NOTION_TOKEN, DATABASE_ID)
-
-random_number = random.randint(0, 100)
-title = "Test title xyz " + str(random_number)
-data = {
-    "Title": {"title": [{"text": {"content": title}}]},
-    "Description": {"rich_text": [{"text": {"content": "Test description"}}]},
-}
-
-# result = notion.create_page(data)
-result = notion.delete_page("a09cfcd3-34ac-4e83-994c-000bd7ecfe2d")
-
-print(result.status_code)
-if result.status_code != 200:
+
+
+if __name__ == "__main__":
+    NOTION_TOKEN  = "secret_akufRDBcruwCW8E62hTVvrefbJtpEskd9hOdoDJZpAC"
+    DATABASE_ID = "3d23e0e454e04767bb4d4b856b613e0c"
+    notion  = Notion(NOTION_TOKEN, DATABASE_ID)
+
+    random_number = random.randint(0, 100)
+    title = "Test title xyz " + str(random_number)
+    data = {
+        "Title": {"title": [{"text": {"content": title}}]},
+        "Description": {"rich_text": [{"text": {"content": "Test description"}}]},
+    }
+
+    # result = notion.create_page(data)
+    result = notion.delete_page("a09cfcd3-34ac-4e83-994c-000bd7ecfe2d")
+
+    print(result.status_code)
+    if result.status_code != 200:
+        print(result.json())
     print(result.json())
-print(result.json())
-    
\ No newline at end of file
+
@@ -0,0 +1,254 @@
+"""
+This script handles the Notion API calls asynchronously, so the bot's event loop is not blocked.
+
+All requests made with the same integration token share one token bucket, which keeps them below
+Notion's rate limit (an average of three requests per second). If Notion still answers with a
+rate limit error, the `Retry-After` header is honored before the request is retried.
+
+Writes that are not idempotent (appending blocks, creating a page) are only retried if Notion
+provably did not apply them: on a rate limit or conflict error, or if the connection could not be
+made. After a timeout or a server error the write may have been applied, so it is not repeated here
+(which could append an entry twice); the error is raised and the outbox of `notion_writer` retries.
+"""
+import asyncio
+import logging
+import random
+from typing import Callable, List, Optional, Union
+
+import httpx
+from notion_client import AsyncClient, APIResponseError
+from notion_client.errors import HTTPResponseError, RequestTimeoutError
+
+from . import utils, ratelimit, metrics
+from .notion import (
+    Notion,
+    NOTION_PAGE_SIZE,
+    _weekly_page_cache,
+    chunk_blocks,
+    create_page_title,
+    get_transcription_heading,
+    invalidate_cached_page,
+    is_missing_page_error,
+)
+
+logger = logging.getLogger(__name__)
+
+NOTION_RATE_LIMIT = 3  # average number of requests per second per integration token
+NOTION_BURST = 3  # number of requests that may be sent at once
+RETRIES = 6
+RETRY_STATUS_CODES = (409, 429, 500, 502, 503, 504)
+WRITE_RETRY_STATUS_CODES = (409, 429)  # the write was not applied
+# the request was not sent (RequestTimeoutError wraps the httpx timeouts)
+UNSENT_ERRORS = (httpx.ConnectError, httpx.ConnectTimeout, httpx.PoolTimeout)
+
+# one client (and thus one connection pool) per (token, base_url)
+_clients = {}
+# one lock per (database_id, title), so concurrent appends do not create the same weekly page twice
+_page_locks = {}
+
+
+def get_client(token: str, base_url: str) -> AsyncClient:
+    """Return the pooled async client for the given token."""
+    key = (token, base_url)
+    if key not in _clients:
+        _clients[key] = AsyncClient(auth=token, base_url=base_url)
+    return _clients[key]
+
+
+async def close_clients() -> None:
+    """Close all pooled clients. Call this on shutdown."""
+    clients = list(_clients.values())
+    _clients.clear()
+    for client in clients:
+        await client.aclose()
+
+
+def get_retry_after(error: HTTPResponseError) -> Optional[float]:
+    """Return the number of seconds the `Retry-After` header asks to wait, or None if there is none."""
+    value = error.headers.get('retry-after')
+    if value is None:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        return None
+
+
+def get_backoff(attempt: int) -> float:
+    """Exponential backoff with jitter, used if Notion does not tell us how long to wait."""
+    return min(30.0, 0.5 * 2 ** (attempt - 1)) * random.uniform(0.5, 1.0)
+
+
+class AsyncNotion(Notion):
+    """
+    Asynchronous version of `notion.Notion`. The block and property helpers are shared, all methods
+    talking to the Notion API are coroutines.
+    """
+    client: AsyncClient
+    limiter: ratelimit.TokenBucket
+
+    def __init__(self, NOTION_TOKEN: str, DATABASE_ID: str, PAGE_PROPERTIES: list, base_url: Optional[str] = None) -> None:
+        self.NOTION_TOKEN = NOTION_TOKEN
+        self.DATABASE_ID = DATABASE_ID
+        self.PAGE_PROPERTIES = PAGE_PROPERTIES
+        if base_url is None:
+            base_url = utils.get_notion_base_url()
+        self.client = get_client(NOTION_TOKEN, base_url)
+        self.limiter = ratelimit.get_bucket(f"notion:{NOTION_TOKEN}", NOTION_RATE_LIMIT, NOTION_BURST)
+
+    async def request(self, endpoint, idempotent: bool = True, **kwargs):
+        """
+        Call a Notion API endpoint (e.g. `self.client.pages.create`) within the rate limit and retry
+        on rate limit errors, server errors and timeouts. Without `idempotent`, only on errors where
+        the request was not applied.
+        """
+        status_codes = RETRY_STATUS_CODES if idempotent else WRITE_RETRY_STATUS_CODES
+        for attempt in range(1, RETRIES + 1):
+            await self.limiter.acquire()
+            try:
+                return await endpoint(**kwargs)
+            except HTTPResponseError as e:
+                if attempt == RETRIES or e.status not in status_codes:
+                    raise
+                retry_after = get_retry_after(e)
+                metrics.increment('retries_total', service='notion', reason=str(e.status))
+                logger.warning(f"Notion request failed with status {e.status} (attempt {attempt}/{RETRIES}), Retry-After: {retry_after}")
+                if retry_after is not None:
+                    # applies to all requests with this token, the next acquire waits for it
+                    self.limiter.block_for(retry_after)
+                else:
+                    await asyncio.sleep(get_backoff(attempt))
+            except (RequestTimeoutError, httpx.TransportError) as e:
+                unsent = isinstance(e, UNSENT_ERRORS) or isinstance(e.__context__, UNSENT_ERRORS)
+                if attempt == RETRIES or not (idempotent or unsent):
+                    raise
+                metrics.increment('retries_total', service='notion', reason=type(e).__name__)
+                logger.warning(f"Notion request failed with {e!r} (attempt {attempt}/{RETRIES})")
+                await asyncio.sleep(get_backoff(attempt))
+
+    async def create_page_in_database(self, database_id: str, title: str):
+        new_page_properties = self.create_page_properties(title)
+        with metrics.timer('notion_create'):
+            return await self.request(self.client.pages.create, idempotent=False, parent={"database_id": database_id}, properties=new_page_properties)
+
+    async def query_database(self, database_id: str, filter: Optional[dict] = None, sorts: Optional[list] = None) -> List[dict]:
+        """Query a database and follow the pagination until all matching pages are fetched."""
+        query = {"database_id": database_id, "page_size": NOTION_PAGE_SIZE}
+        if filter is not None:
+            query["filter"] = filter
+        if sorts is not None:
+            query["sorts"] = sorts
+        results = []
+        while True:
+            response = await self.request(self.client.databases.query, **query)
+            results.extend(response["results"])
+            if not response.get("has_more"):
+                break
+            query["start_cursor"] = response["next_cursor"]
+        return results
+
+    async def get_pages_from_database(self, database_id: str, title: Optional[str] = None):
+        """Get the pages of a database as a list of dicts with the keys "id" and "name"."""
+        filter = None
+        if title is not None:
+            filter = {"property": self.PAGE_PROPERTIES[0], "title": {"equals": title}}
+        response = await self.query_database(database_id, filter)
+        return [{"id": page["id"], "name": self.get_page_name(page)} for page in response]
+
+    async def archive_page(self, page_id: str):
+        """Archive (i.e. delete) a page and drop it from the weekly page cache."""
+        response = await self.request(self.client.pages.update, page_id=page_id, archived=True)
+        invalidate_cached_page(page_id)
+        return response
+
+    async def get_block_children(self, block_id: str) -> List[dict]:
+        """Return all child blocks of a block (or page), following the pagination."""
+        query = {"block_id": block_id, "page_size": NOTION_PAGE_SIZE}
+        results = []
+        while True:
+            response = await self.request(self.client.blocks.children.list, **query)
+            results.extend(response["results"])
+            if not response.get("has_more"):
+                break
+            query["start_cursor"] = response["next_cursor"]
+        return results
+
+    async def add_blocks_to_page(self, page_id: str, blocks: Union[List[dict], dict]):
+        # blocks must always be a list of dicts
+        if isinstance(blocks, dict):
+            blocks = [blocks]
+        with metrics.timer('notion_append'):
+            return await self.request(self.client.blocks.children.append, idempotent=False, block_id=page_id, children=blocks)
+
+
+async def get_page_from_database_by_title(notion: AsyncNotion, title: str):
+    """Return the (cached) ID of the page with the given title, or False if there is none."""
+    key = (notion.DATABASE_ID, title)
+    if key in _weekly_page_cache:
+        return _weekly_page_cache[key]
+    with metrics.timer('notion_lookup'):
+        pages = await notion.get_pages_from_database(notion.DATABASE_ID, title=title)
+    for page in pages:
+        if page['name'] == title:
+            _weekly_page_cache[key] = page['id']
+            return page['id']
+    return False
+
+
+async def get_or_create_weekly_page(notion: AsyncNotion, title: str) -> str:
+    """Return the ID of the page with the given title, creating the page if it does not exist yet."""
+    key = (notion.DATABASE_ID, title)
+    lock = _page_locks.setdefault(key, asyncio.Lock())
+    async with lock:
+        page_id = await get_page_from_database_by_title(notion, title)
+        if page_id is False:
+            page = await notion.create_page_in_database(notion.DATABASE_ID, title)
+            page_id = page['id']
+            _weekly_page_cache[key] = page_id
+    return page_id
+
+
+async def append_blocks_to_weekly_page(notion: AsyncNotion, title: str, blocks: List[dict], on_chunk: Optional[Callable[[int, dict], None]] = None) -> List[dict]:
+    """
+    Append blocks to the page with the given title. The blocks are split into as few requests as
+    Notion's limits allow and are appended in order. `on_chunk` is called with the number of blocks
+    and the response after every request, e.g. to record the progress before the next one fails.
+
+    Returns
+    -------
+    list[dict]
+        The responses from the Notion API, one per request.
+    """
+    page_id = await get_or_create_weekly_page(notion, title)
+    responses = []
+    for chunk in chunk_blocks(blocks):
+        try:
+            response = await notion.add_blocks_to_page(page_id, chunk)
+        except APIResponseError as e:
+            if responses or not is_missing_page_error(e):
+                raise
+            # the cached page was archived in the meantime, look it up (or create it) again
+            invalidate_cached_page(page_id)
+            page_id = await get_or_create_weekly_page(notion, title)
+            response = await notion.add_blocks_to_page(page_id, chunk)
+        responses.append(response)
+        if on_chunk is not None:
+            on_chunk(len(chunk), response)
+    return responses
+
+
+async def append_transcription(token: str, database_id: str, page_properties: list, transcription: dict, base_url: Optional[str] = None):
+    """
+    Append a transcription to this week's page of the user's Notion database.
+    Asynchronous version of `notion.append_transcription`.
+
+    Returns
+    -------
+    response : dict
+        The response from the Notion API for appending the last blocks.
+    """
+    notion = AsyncNotion(token, database_id, page_properties, base_url)
+    heading, text = get_transcription_heading(), transcription['text']
+    blocks = notion.create_transcription_block(heading, text)
+    responses = await append_blocks_to_weekly_page(notion, create_page_title(), blocks)
+    return responses[-1]
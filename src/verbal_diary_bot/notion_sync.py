@@ -0,0 +1,115 @@
+"""
+This script mirrors the users' Notion diary pages into the local database (NotionPages table).
+
+The sync is incremental: the Notion database is queried with a `last_edited_time` filter starting at
+the cursor stored in the NotionSync table, sorted by `last_edited_time` and paginated with
+`next_cursor`. The content of a page is only downloaded if it changed since it was mirrored.
+Lookups, de-duplication and search can then read the local tables instead of calling Notion.
+
+Note: the Notion API does not return archived pages, so a page archived in Notion stays in the
+mirror until it is removed with `database_operations.delete_notion_pages`.
+"""
+import asyncio
+import logging
+from typing import List, Optional, Tuple
+
+from . import database_operations as db
+from . import utils
+from .notion import _weekly_page_cache, create_page_title
+from .notion_async import AsyncNotion
+from .sharding import in_shard
+
+logger = logging.getLogger(__name__)
+
+SYNC_INTERVAL = 15 * 60  # seconds between two syncs of all users
+
+
+def get_plain_text(blocks: List[dict]) -> str:
+    """Return the text of a list of blocks, one line per block."""
+    lines = []
+    for block in blocks:
+        rich_text = block.get(block['type'], {}).get('rich_text', [])
+        lines.append(''.join(item.get('plain_text', item.get('text', {}).get('content', '')) for item in rich_text))
+    return '\n'.join(lines)
+
+
+async def sync_user(user_id: int, token: str, database_id: str, base_url: Optional[str] = None) -> int:
+    """
+    Mirror the pages of a user's Notion database that changed since the last sync.
+
+    Returns
+    -------
+    int
+        The number of pages that were (re-)downloaded.
+    """
+    notion = AsyncNotion(token, database_id, utils.get_notion_page_properties(), base_url)
+    cursor = db.get_notion_sync_cursor(user_id, database_id)
+    filter = None
+    if cursor is not None:
+        # Notion rounds last_edited_time to the minute, so pages edited at the cursor are fetched again
+        filter = {"timestamp": "last_edited_time", "last_edited_time": {"on_or_after": cursor}}
+    sorts = [{"timestamp": "last_edited_time", "direction": "ascending"}]
+    pages = await notion.query_database(database_id, filter, sorts)
+    if not pages:
+        return 0
+
+    mirrored = db.get_notion_pages(user_id, [page['id'] for page in pages])
+    rows, archived = [], []
+    for page in pages:
+        if mirrored.get(page['id']) == page['last_edited_time']:
+            continue
+        if page.get('archived') or page.get('in_trash'):
+            archived.append(page['id'])
+            continue
+        blocks = await notion.get_block_children(page['id'])
+        rows.append((page['id'], user_id, database_id, notion.get_page_name(page), get_plain_text(blocks), page['created_time'], page['last_edited_time']))
+    db.upsert_notion_pages(rows)
+    db.delete_notion_pages(archived)
+    db.set_notion_sync_cursor(user_id, database_id, max(page['last_edited_time'] for page in pages))
+
+    # warm the weekly page cache, so the next append does not need to look the page up
+    title = create_page_title()
+    page_id = db.find_notion_page_by_title(user_id, database_id, title)
+    if page_id is not None:
+        _weekly_page_cache.setdefault((database_id, title), page_id)
+    logger.info(f"Synced Notion database of user {user_id}: {len(rows)} page(s) updated, {len(pages) - len(rows)} unchanged.")
+    return len(rows)
+
+
+class NotionSyncer:
+    """
+    Runs `sync_user` for every user with a Notion database every `interval` seconds.
+    With several bot workers, each one only syncs the users of its `shard` (index, count).
+    """
+
+    def __init__(self, interval: float = SYNC_INTERVAL, base_url: Optional[str] = None, shard: Optional[Tuple[int, int]] = None) -> None:
+        self.interval = interval
+        self.base_url = base_url
+        self.shard = shard
+        self._task = None
+
+    def start(self) -> None:
+        db.create_notion_mirror_tables()
+        self._task = asyncio.create_task(self._run())
+
+    async def _run(self) -> None:
+        while True:
+            await self.sync_all()
+            await asyncio.sleep(self.interval)
+
+    async def sync_all(self) -> None:
+        for user_data in db.get_all_users():
+            user_id, token, database_id = user_data[0], user_data[2], user_data[3]
+            if token is None or database_id is None or not in_shard(user_id, self.shard):
+                continue
+            try:
+                await sync_user(user_id, token, database_id, self.base_url)
+            except Exception as e:
+                logger.error(f"Syncing the Notion database of user {user_id} failed: {e!r}")
+
+    async def close(self) -> None:
+        if self._task is None:
+            return
+        self._task.cancel()
+        await asyncio.gather(self._task, return_exceptions=True)
+        self._task = None
@@ -0,0 +1,187 @@
+"""
+This script delivers transcriptions to Notion in the background.
+
+Transcriptions are first stored in the NotionOutbox table of the database, so they are not lost if
+Notion is slow or down, or if the bot restarts. A background task drains the outbox: the pending
+transcriptions of each weekly page are appended together, in the order they were received, with as
+few requests as possible. Failed deliveries are retried with an exponential backoff. The progress is
+recorded after every request, so a retry only appends what was not written yet and no entry ends
+up twice on the page.
+"""
+import asyncio
+import logging
+import time
+from typing import Optional, Tuple
+
+from . import database_operations as db
+from . import utils
+from .notion import create_page_title, get_transcription_heading
+from .notion_async import AsyncNotion, append_blocks_to_weekly_page
+from .sharding import in_shard
+
+logger = logging.getLogger(__name__)
+
+FLUSH_WINDOW = 2.0  # seconds to wait for further transcriptions before writing to Notion
+POLL_INTERVAL = 30.0  # seconds between two checks of the outbox for due retries
+RETRY_BASE = 10.0  # seconds to wait after the first failed delivery, doubled for every further one
+RETRY_MAX = 3600.0  # longest wait between two delivery attempts
+
+
+class NotionWriter:
+    """
+    Outbox-backed writer for Notion.
+
+    `submit` stores a transcription in the outbox and schedules a flush after a short window, so the
+    transcriptions of a bursty user end up in a single append. Entries of the same page are always
+    delivered in order: if the oldest entry of a page is waiting for a retry, the newer ones wait too.
+    Call `start` once the event loop is running and `close` on shutdown.
+
+    With several bot workers, each one only delivers the entries of its `shard` (index, count) of users.
+    """
+
+    def __init__(self, window: float = FLUSH_WINDOW, poll_interval: float = POLL_INTERVAL, base_url: Optional[str] = None, shard: Optional[Tuple[int, int]] = None) -> None:
+        self.window = window
+        self.poll_interval = poll_interval
+        self.base_url = base_url
+        self.shard = shard
+        self._futures = {}  # outbox_id -> asyncio.Future of transcriptions submitted by this process
+        self._wakeup = None
+        self._timer = None
+        self._task = None
+        self._lock = None
+        self._closing = False
+
+    def start(self) -> None:
+        """Create the outbox table if necessary and start draining it in the background."""
+        db.create_outbox_table()
+        self._wakeup = asyncio.Event()
+        self._lock = asyncio.Lock()
+        self._task = asyncio.create_task(self._run())
+        # deliver whatever was left over from the last run
+        self._wakeup.set()
+
+    def submit(self, user_id: int, database_id: str, transcription: dict) -> asyncio.Future:
+        """
+        Store a transcription in the outbox.
+
+        Returns
+        -------
+        asyncio.Future
+            Resolves to the Notion response once the transcription is written, or to the exception
+            of the first failed attempt. The entry stays in the outbox and is retried in that case.
+        """
+        if self._task is None:
+            raise RuntimeError("NotionWriter is not running.")
+        outbox_id = db.insert_outbox_entry(user_id, database_id, create_page_title(), get_transcription_heading(), transcription['text'])
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self._futures[outbox_id] = future
+        if self._timer is None:
+            self._timer = loop.call_later(self.window, self._wake)
+        return future
+
+    def _wake(self) -> None:
+        self._timer = None
+        self._wakeup.set()
+
+    async def _run(self) -> None:
+        while not self._closing:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), self.poll_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            try:
+                await self.flush()
+            except Exception as e:
+                logger.error(f"Draining the Notion outbox failed: {e!r}")
+
+    async def flush(self, retry_now: bool = False) -> None:
+        """
+        Deliver all due outbox entries. With `retry_now`, entries waiting for a retry are tried as well.
+        """
+        async with self._lock:
+            now = time.time()
+            # group the entries by page, keeping the order in which they were inserted
+            pages = {}
+            for entry in db.get_outbox_entries():
+                outbox_id, user_id, database_id, title = entry[:4]
+                if not in_shard(user_id, self.shard):
+                    continue
+                pages.setdefault((user_id, database_id, title), []).append(entry)
+            for (user_id, database_id, title), entries in pages.items():
+                next_attempt = entries[0][7]
+                if next_attempt > now and not retry_now:
+                    continue
+                await self._deliver(user_id, database_id, title, entries)
+
+    async def _deliver(self, user_id: int, database_id: str, title: str, entries: list) -> None:
+        outbox_ids = [entry[0] for entry in entries]
+        user_data = db.get_user(user_id)
+        if user_data is None or user_data[2] is None:
+            # the user deregistered in the meantime
+            logger.warning(f"Dropping {len(entries)} outbox entries of user {user_id}, there is no Notion token anymore.")
+            db.delete_outbox_entries(outbox_ids)
+            self._resolve(outbox_ids, exception=RuntimeError("There is no Notion token for this user."))
+            return
+        notion = AsyncNotion(user_data[2], database_id, utils.get_notion_page_properties(), self.base_url)
+        blocks = []
+        pending = []  # [outbox_id, blocks written, blocks] of the entries that are not written completely
+        for entry in entries:
+            entry_blocks = notion.create_transcription_block(entry[4], entry[5])
+            # the blocks are the same every time, skip those written by an earlier attempt
+            blocks.extend(entry_blocks[entry[9]:])
+            pending.append([entry[0], entry[9], len(entry_blocks)])
+
+        def on_chunk(count: int, response: dict) -> None:
+            written = []
+            while count > 0:
+                step = min(count, pending[0][2] - pending[0][1])
+                pending[0][1] += step
+                count -= step
+                if pending[0][1] == pending[0][2]:
+                    written.append(pending.pop(0)[0])
+            db.delete_outbox_entries(written)
+            self._resolve(written, result=response)
+            if pending and pending[0][1] > 0:
+                db.set_outbox_entry_written(pending[0][0], pending[0][1])
+
+        try:
+            responses = await append_blocks_to_weekly_page(notion, title, blocks, on_chunk)
+        except Exception as e:
+            failed = [outbox_id for outbox_id, _, _ in pending]
+            attempts = entries[0][6] + 1
+            delay = min(RETRY_MAX, RETRY_BASE * 2 ** (attempts - 1))
+            logger.error(f"Appending {len(failed)} of {len(entries)} transcription(s) to Notion failed (attempt {attempts}), retrying in {delay:.0f}s: {e!r}")
+            db.mark_outbox_entries_failed(failed, time.time() + delay, str(e))
+            self._resolve(failed, exception=e)
+            return
+        logger.info(f"Appended {len(entries)} transcription(s) to Notion with {len(responses)} request(s).")
+
+    def _resolve(self, outbox_ids: list, result=None, exception: Optional[Exception] = None) -> None:
+        for outbox_id in outbox_ids:
+            future = self._futures.pop(outbox_id, None)
+            if future is None or future.done():
+                continue
+            if exception is not None:
+                future.set_exception(exception)
+            else:
+                future.set_result(result)
+
+    async def close(self) -> None:
+        """Stop the background task and make a last attempt to deliver everything in the outbox."""
+        if self._task is None:
+            return
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        # let the background task finish its current flush
+        self._closing = True
+        self._wakeup.set()
+        await self._task
+        self._task = None
+        await self.flush(retry_now=True)
+        # whatever is left stays in the outbox for the next start
+        for future in self._futures.values():
+            future.cancel()
+        self._futures.clear()
@@ -1,7 +1,6 @@
 from pathlib import Path
 import logging
 
-import openai
 from tenacity import (
     retry,
     stop_after_attempt,
@@ -9,16 +8,24 @@ from tenacity import (
 )  # for exponential backoff
 RETRIES = 6
 
-from . import utils
+from . import utils, metrics
 
 logger = logging.getLogger(__name__)
 
+
+def count_retry(retry_state):
+    """Count the retries of OpenAI requests (tenacity `before_sleep` hook)."""
+    metrics.increment('retries_total', service='openai', reason=type(retry_state.outcome.exception()).__name__)
+
 class OpenAiCLient():
     
-    def __init__(self, token) -> None:
-        self.client = openai.OpenAI(api_key=token)
+    def __init__(self, token, base_url=None) -> None:
+        # openai takes half a second to import, only pay for it when a client is needed
+        import openai
+        # base_url=None uses the official API
+        self.client = openai.OpenAI(api_key=token, base_url=base_url)
 
-    @retry(wait=wait_random_exponential(min=1, max=60), stop=stop_after_attempt(RETRIES))
+    @retry(wait=wait_random_exponential(min=1, max=60), stop=stop_after_attempt(RETRIES), before_sleep=count_retry)
     def transcribe(self, file_path: Path, model_name: str="whisper-1"):
         audio_file = open(file_path, "rb")
         print("Sending request to openai")
@@ -31,7 +38,7 @@ class OpenAiCLient():
         return transcript
 
 
-    @retry(wait=wait_random_exponential(min=1, max=60), stop=stop_after_attempt(RETRIES))
+    @retry(wait=wait_random_exponential(min=1, max=60), stop=stop_after_attempt(RETRIES), before_sleep=count_retry)
     def chat_completion(self, user_message: str, model_name: str="gpt-3.5-turbo", context: str="You are a helpful assistant."):
         completion = self.client.chat.completions.create(
         model=model_name,
@@ -42,6 +49,13 @@ class OpenAiCLient():
         )
         return completion.choices[0].message
 
+    @retry(wait=wait_random_exponential(min=1, max=60), stop=stop_after_attempt(RETRIES), before_sleep=count_retry)
+    def embeddings(self, texts: list, model_name: str="text-embedding-3-small", dimensions: int=None) -> list:
+        """Return the embedding vectors of the texts, in their order."""
+        kwargs = {} if dimensions is None else {'dimensions': dimensions}
+        response = self.client.embeddings.create(model=model_name, input=texts, **kwargs)
+        return [item.embedding for item in sorted(response.data, key=lambda item: item.index)]
+
 
 if __name__ == "__main__":
     client = OpenAiCLient(utils.get_openai_token())
@@ -0,0 +1,101 @@
+"""
+This script provides a sampling profiler for the running bot.
+
+While it runs, a background thread takes a snapshot of the stacks of all other threads every
+`interval` seconds with `sys._current_frames()`. Nothing is instrumented, so the overhead is small and
+does not depend on the code that is profiled. The result can be exported in the collapsed stack
+format (one line per stack, `frame;frame;frame count`), which can be turned into a flame graph with
+e.g. `flamegraph.pl` or speedscope, and summarized as the functions with the most samples.
+
+Usage:
+    profiler = await profile(30)
+    profiler.collapsed(), profiler.summary()
+"""
+import asyncio
+import sys
+import threading
+import time
+from collections import Counter
+from pathlib import Path
+
+INTERVAL = 0.005  # seconds between two samples
+MAX_DURATION = 300  # seconds a profile may run at most
+
+
+def format_frame(frame) -> str:
+    return f"{Path(frame.f_code.co_filename).stem}:{frame.f_code.co_name}"
+
+
+class SamplingProfiler:
+    """Samples the stacks of all threads (except its own) until `stop` is called."""
+
+    def __init__(self, interval: float = INTERVAL) -> None:
+        self.interval = interval
+        self.stacks = Counter()  # tuple of frames (outermost first) -> number of samples
+        self.samples = 0
+        self.duration = 0.0
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def start(self) -> None:
+        self._stopped.clear()
+        self._thread = threading.Thread(target=self._sample, name='sampling-profiler', daemon=True)
+        self._thread.start()
+
+    def stop(self) -> None:
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def _sample(self) -> None:
+        own_id = threading.get_ident()
+        names = {}
+        start = time.monotonic()
+        while not self._stopped.wait(self.interval):
+            for thread in threading.enumerate():
+                names.setdefault(thread.ident, thread.name)
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own_id:
+                    continue
+                stack = []
+                while frame is not None:
+                    stack.append(format_frame(frame))
+                    frame = frame.f_back
+                stack.append(names.get(thread_id, str(thread_id)))
+                self.stacks[tuple(reversed(stack))] += 1
+            self.samples += 1
+        self.duration = time.monotonic() - start
+
+    def collapsed(self) -> str:
+        """Return the samples in the collapsed stack format, the input of flame graph tools."""
+        lines = [f"{';'.join(stack)} {count}" for stack, count in self.stacks.most_common()]
+        return '\n'.join(lines) + '\n'
+
+    def summary(self, limit: int = 15) -> str:
+        """
+        Return the functions with the most samples. `self` counts the samples in which the function was
+        running, `total` those in which it was on the stack.
+        """
+        own, total = Counter(), Counter()
+        for stack, count in self.stacks.items():
+            # the first entry is the thread name
+            own[stack[-1]] += count
+            for frame in set(stack[1:]):
+                total[frame] += count
+        sampled = sum(self.stacks.values()) or 1
+        lines = [f"{self.samples} samples in {self.duration:.1f}s", f"{'self':>6} {'total':>6}  function"]
+        for frame, count in own.most_common(limit):
+            lines.append(f"{count / sampled:6.1%} {total[frame] / sampled:6.1%}  {frame}")
+        return '\n'.join(lines)
+
+
+async def profile(seconds: float, interval: float = INTERVAL) -> SamplingProfiler:
+    """Profile the process for `seconds` (at most `MAX_DURATION`) without blocking the event loop."""
+    profiler = SamplingProfiler(interval)
+    profiler.start()
+    try:
+        await asyncio.sleep(min(seconds, MAX_DURATION))
+    finally:
+        profiler.stop()
+    return profiler
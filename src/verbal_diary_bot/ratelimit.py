@@ -0,0 +1,87 @@
+"""This script provides a token bucket rate limiter for asyncio code."""
+import asyncio
+import time
+from datetime import timedelta
+
+
+class TokenBucket:
+    """
+    Token bucket rate limiter. Each `acquire` takes one token, tokens are refilled at `rate` per second
+    up to `capacity`. A server-side back-off (e.g. a `Retry-After` header) can be applied with `block_for`,
+    which makes all callers wait until it has passed.
+    """
+    rate: float
+    capacity: float
+
+    def __init__(self, rate: float, capacity: float = 1) -> None:
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.blocked_until = 0.0
+        self._lock = asyncio.Lock()
+
+    def _refill(self, now: float) -> None:
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    async def acquire(self) -> None:
+        """Wait until a token is available and take it."""
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                if now < self.blocked_until:
+                    await asyncio.sleep(self.blocked_until - now)
+                    continue
+                self._refill(now)
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+    def try_acquire(self) -> bool:
+        """Take a token if one is available right now, without waiting."""
+        now = time.monotonic()
+        if now < self.blocked_until:
+            return False
+        self._refill(now)
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return True
+        return False
+
+    def block_for(self, seconds: float) -> None:
+        """Stop handing out tokens for the given number of seconds."""
+        self.blocked_until = max(self.blocked_until, time.monotonic() + seconds)
+        self.tokens = 0
+        self.updated = self.blocked_until
+
+
+def retry_after_seconds(error) -> float:
+    """The seconds to wait after Telegram's `RetryAfter` error, whose `retry_after` is an int or a timedelta."""
+    retry_after = error.retry_after
+    return retry_after.total_seconds() if isinstance(retry_after, timedelta) else float(retry_after)
+
+
+TELEGRAM_RATE = 25  # messages per second to different chats, below Telegram's limit of about 30 per bot
+
+_buckets = {}
+
+
+def get_bucket(key: str, rate: float, capacity: float = 1) -> TokenBucket:
+    """Return the shared token bucket for the given key (e.g. an API token), creating it if necessary."""
+    bucket = _buckets.get(key)
+    if bucket is None:
+        bucket = TokenBucket(rate, capacity)
+        _buckets[key] = bucket
+    return bucket
+
+
+def get_telegram_bucket(token: str, workers: int = 1) -> TokenBucket:
+    """
+    Return the token bucket shared by everything that sends messages to many chats with the bot
+    (broadcasts, reminders), so they stay below Telegram's limit together and a `RetryAfter` pauses
+    all of them. With several bot workers, each one gets its part of the rate.
+    """
+    rate = TELEGRAM_RATE / max(1, workers)
+    return get_bucket(f"telegram:{token}", rate, rate)
@@ -0,0 +1,228 @@
+"""
+This script reminds users to write in their diary when they have not sent a message for a while.
+
+A user turns the reminders on with `/reminder 20:30 Europe/Berlin 2`: at 20:30 in their timezone,
+they get a reminder if their last message is at least 2 days old (and they were not reminded in
+that time either).
+
+The scheduler keeps a heap of the next due time of every user with reminders, so a check of the
+bot's job queue only looks at the top of the heap, however many users there are. For the due users,
+the dates of their last messages are fetched with a single indexed query (instead of all the
+messages of every user), and the reminders are sent through the bot's token bucket (shared with
+the broadcasts), below Telegram's limit of about 30 messages per second. A check handles at most
+`MAX_BATCH` users, the rest are left for the next one, so a check does not take longer than the
+interval between two checks.
+"""
+import asyncio
+import heapq
+import logging
+import time
+from datetime import datetime, timedelta
+from typing import Optional, Tuple
+from zoneinfo import ZoneInfo, ZoneInfoNotFoundError
+
+from telegram.error import Forbidden, RetryAfter, TelegramError
+from telegram.ext import ContextTypes
+
+from . import database_operations as db
+from . import metrics
+from .ratelimit import TELEGRAM_RATE, TokenBucket, get_telegram_bucket, retry_after_seconds
+from .sharding import in_shard
+from .storage import parse_date
+
+logger = logging.getLogger(__name__)
+
+DAY = 24 * 60 * 60
+TICK_INTERVAL = 30  # seconds between two checks for due reminders
+MAX_BATCH = TELEGRAM_RATE * TICK_INTERVAL  # due users handled by one check
+MISSED_WINDOW = 60 * 60  # after a restart, reminders that were due this many seconds ago are still sent
+REMINDER_SLACK = 12 * 60 * 60  # a reminder this much less than `inactive_days` ago still counts (e.g. sent late)
+DEFAULT_TIMEZONE = 'Europe/Berlin'
+DEFAULT_INACTIVE_DAYS = 1
+USAGE = "Usage: /reminder HH:MM [timezone] [days without message], e.g. /reminder 20:30 Europe/Berlin 1, or /reminder off"
+REMINDER_TEXT = "You have not written in your diary for {days}. How was your day? Just send me a voice message."
+
+
+def parse_time(time_of_day: str) -> Tuple[int, int]:
+    """Return hour and minute of a time like '20:30'."""
+    parsed = datetime.strptime(time_of_day, '%H:%M')
+    return parsed.hour, parsed.minute
+
+
+def parse_preferences(args: list) -> Tuple[str, str, int]:
+    """
+    Parse the arguments of the /reminder command.
+
+    Returns
+    -------
+    Tuple[str, str, int]
+        The time ('HH:MM'), the timezone and the number of days without message.
+
+    Raises
+    ------
+    ValueError
+        With a message for the user if an argument is invalid.
+    """
+    if not 1 <= len(args) <= 3:
+        raise ValueError("Please give the time of the reminder.")
+    try:
+        hour, minute = parse_time(args[0])
+    except ValueError:
+        raise ValueError(f"'{args[0]}' is not a time like 20:30.") from None
+    timezone = args[1] if len(args) > 1 else DEFAULT_TIMEZONE
+    try:
+        ZoneInfo(timezone)
+    except (ZoneInfoNotFoundError, ValueError):
+        raise ValueError(f"Unknown timezone '{timezone}', e.g. Europe/Berlin or America/New_York.") from None
+    try:
+        inactive_days = int(args[2]) if len(args) > 2 else DEFAULT_INACTIVE_DAYS
+    except ValueError:
+        raise ValueError(f"'{args[2]}' is not a number of days.") from None
+    if inactive_days < 1:
+        raise ValueError("The number of days has to be at least 1.")
+    return f"{hour:02d}:{minute:02d}", timezone, inactive_days
+
+
+def describe(preferences: Optional[tuple]) -> str:
+    """Describe the reminder preferences (enabled, time, timezone, inactive_days, ...) for the user."""
+    if preferences is None or not preferences[0]:
+        return f"Reminders are off.\n{USAGE}"
+    days = "a day" if preferences[3] == 1 else f"{preferences[3]} days"
+    return f"You get a reminder at {preferences[1]} ({preferences[2]}) if you have not sent a message for {days}."
+
+
+def next_due(time_of_day: str, timezone: str, after: float) -> float:
+    """Return the first time (seconds since the epoch) after `after` when it is `time_of_day` in the timezone."""
+    tz = ZoneInfo(timezone)
+    hour, minute = parse_time(time_of_day)
+    local = datetime.fromtimestamp(after, tz)
+    due = local.replace(hour=hour, minute=minute, second=0, microsecond=0)
+    if due.timestamp() <= after:
+        due = datetime.combine(local.date() + timedelta(days=1), due.timetz())
+    return due.timestamp()
+
+
+class ReminderScheduler:
+    """
+    Heap of the next due reminder of every user. Call `load` once, then `tick` regularly, e.g. from the
+    job queue. Changed preferences are passed with `schedule` and `remove`, replaced heap entries are
+    skipped when they come up.
+
+    With several bot workers, each one only reminds the users of its `shard` (index, count). The
+    reminders are sent through `bucket`, by default the one shared by all senders of the bot.
+    """
+
+    def __init__(self, shard: Optional[Tuple[int, int]] = None, bucket: Optional[TokenBucket] = None, max_batch: int = MAX_BATCH) -> None:
+        self.shard = shard
+        self.bucket = bucket
+        self.max_batch = max_batch
+        self.heap = []  # (due time, user_id)
+        self.due = {}  # user_id -> due time of their current heap entry
+        self.preferences = {}  # user_id -> (time, timezone, inactive_days)
+        self.last_sent = {}  # user_id -> time of the last reminder
+
+    def __len__(self) -> int:
+        return len(self.due)
+
+    def load(self, now: Optional[float] = None) -> None:
+        """Schedule the users with enabled reminders from the database. It is blocking, run it in a thread."""
+        now = time.time() if now is None else now
+        for user_id, time_of_day, timezone, inactive_days, last_sent in db.get_enabled_reminders():
+            if not in_shard(user_id, self.shard):
+                continue
+            if last_sent is not None:
+                self.last_sent[user_id] = last_sent
+            # reminders missed by a (short) restart are sent, but not twice
+            self.schedule(user_id, time_of_day, timezone, inactive_days, max(now - MISSED_WINDOW, last_sent or 0))
+
+    def schedule(self, user_id: int, time_of_day: str, timezone: str, inactive_days: int, after: Optional[float] = None) -> float:
+        """(Re)schedule the next reminder of a user after the given time, by default now. Returns its due time."""
+        due = next_due(time_of_day, timezone, time.time() if after is None else after)
+        self.preferences[user_id] = (time_of_day, timezone, inactive_days)
+        self.due[user_id] = due
+        heapq.heappush(self.heap, (due, user_id))
+        return due
+
+    def remove(self, user_id: int) -> None:
+        """Stop reminding a user."""
+        self.due.pop(user_id, None)
+        self.preferences.pop(user_id, None)
+        self.last_sent.pop(user_id, None)
+
+    def pop_due(self, now: float) -> list:
+        """Remove and return the (user_id, due time) of at most `max_batch` users whose reminder is due."""
+        due_users = []
+        while self.heap and self.heap[0][0] <= now and len(due_users) < self.max_batch:
+            due, user_id = heapq.heappop(self.heap)
+            # skip entries replaced by `schedule` or `remove`
+            if self.due.get(user_id) == due:
+                due_users.append((user_id, due))
+        return due_users
+
+    def select_inactive(self, due_users: list, last_dates: dict, now: float) -> list:
+        """
+        Reschedule the due users and return (user_id, inactive_days) of those to remind: their last
+        message (from `last_dates`) and their last reminder are at least `inactive_days` old.
+        """
+        inactive = []
+        for user_id, due in due_users:
+            if self.due.get(user_id) != due:
+                # the preferences changed meanwhile
+                continue
+            time_of_day, timezone, inactive_days = self.preferences[user_id]
+            threshold = due - inactive_days * DAY
+            last_date = last_dates.get(user_id)
+            if (last_date is None or parse_date(last_date).timestamp() <= threshold) and self.last_sent.get(user_id, 0) <= threshold + REMINDER_SLACK:
+                inactive.append((user_id, inactive_days))
+            self.schedule(user_id, time_of_day, timezone, inactive_days, max(due, now))
+        return inactive
+
+    async def send(self, bot, user_id: int, inactive_days: int) -> bool:
+        """Send a reminder, respecting the rate limit. Returns whether it was delivered."""
+        days = "a day" if inactive_days == 1 else f"{inactive_days} days"
+        if self.bucket is None:
+            self.bucket = get_telegram_bucket(bot.token, 1 if self.shard is None else self.shard[1])
+        # one retry after Telegram's back-off
+        for _ in range(2):
+            await self.bucket.acquire()
+            try:
+                await bot.send_message(chat_id=user_id, text=REMINDER_TEXT.format(days=days))
+                return True
+            except RetryAfter as e:
+                # Telegram wants all messages to wait, not only this one
+                retry_after = retry_after_seconds(e)
+                logger.warning(f"Reminders are rate limited by Telegram for {retry_after}s.")
+                self.bucket.block_for(retry_after)
+            except Forbidden:
+                # the user blocked the bot
+                logger.info(f"User {user_id} blocked the bot, their reminders are turned off.")
+                self.remove(user_id)
+                await asyncio.to_thread(db.disable_reminders, user_id)
+                return False
+            except TelegramError as e:
+                logger.warning(f"Could not send a reminder to user {user_id}: {e}")
+                return False
+        return False
+
+    async def tick(self, context: ContextTypes.DEFAULT_TYPE, now: Optional[float] = None) -> int:
+        """Send the due reminders. Used as job queue callback. Returns the number of reminders sent."""
+        now = time.time() if now is None else now
+        due_users = self.pop_due(now)
+        if not due_users:
+            return 0
+        last_dates = await asyncio.to_thread(db.get_last_message_dates, [user_id for user_id, _ in due_users])
+        inactive = self.select_inactive(due_users, last_dates, now)
+        sent = []
+        for user_id, inactive_days in inactive:
+            if await self.send(context.bot, user_id, inactive_days):
+                sent.append(user_id)
+        if sent:
+            for user_id in sent:
+                self.last_sent[user_id] = now
+            await asyncio.to_thread(db.set_reminders_sent, sent, now)
+        metrics.increment('reminders_sent_total', len(sent))
+        logger.info(f"Checked {len(due_users)} due reminder(s), sent {len(sent)}.")
+        return len(sent)
+
+
+metrics.describe('reminders_sent_total', 'counter', 'Number of reminders sent to inactive users.')
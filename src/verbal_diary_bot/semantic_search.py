@@ -0,0 +1,305 @@
+"""
+This script searches the diary entries of a user by meaning, and answers questions about them (/ask).
+
+Every message is turned into a vector by an embedder when it is stored:
+
+- `HashingEmbedder` (the default) runs locally: the words, without common stop words and endings,
+  are hashed into a fixed number of dimensions, with sublinear term frequencies. Entries that share
+  words (also e.g. "job" and "jobs") get similar vectors.
+- `OpenAIEmbedder` uses the OpenAI embeddings API, which also matches synonyms.
+
+The vectors of a user are appended to a float32 matrix file (`<user_id>.vec`, with the message_ids
+in `<user_id>.ids`) in a directory per embedder, so a search memory-maps the matrix and computes all
+cosine similarities with one matrix-vector product. The files are only appended to, and deleted when
+the user deregisters.
+
+`answer` passes the best matching entries with the question to `OpenAiCLient.chat_completion`.
+Messages from before the index can be added with `python -m verbal_diary_bot.semantic_search backfill`.
+
+Configured with `"semantic_search": {"embedder": "hashing", "dimension": 512}` or
+`{"embedder": "openai", "model": "text-embedding-3-small", "dimension": 512, "chat_model": "gpt-4o-mini"}`
+in `configs.json`.
+"""
+import argparse
+import logging
+import os
+import re
+import threading
+import zlib
+from abc import ABC, abstractmethod
+from pathlib import Path
+from typing import List, Optional, Tuple
+
+import numpy as np
+
+from . import database_operations as db
+from . import openai_api, utils
+from .storage import parse_date
+
+logger = logging.getLogger(__name__)
+
+HASHING_DIMENSION = 512
+TOP_K = 5  # entries passed to the chat model
+CHAT_MODEL = "gpt-4o-mini"  # answers the questions, unless `chat_model` is configured
+MIN_SCORE = 0.05  # cosine similarity below which an entry is not considered a match
+MAX_ENTRY_CHARS = 2000  # of an entry in the prompt
+BACKFILL_BATCH_SIZE = 100
+ANSWER_CONTEXT = (
+    "You answer questions about the user's diary. Use only the diary entries given with the question, "
+    "mention their dates, and say so if they do not contain the answer."
+)
+SUFFIXES = ('ing', 'ed', 'es', 'en', 'er', 's', 'e', 'n')  # longest first
+STOP_WORDS = frozenset(
+    # English
+    "a about an and are as at be but by did do does for from had has have i if in is it its me my of on or so "
+    "that the their them then there they this to was we were what when where which who why will with you your "
+    # German
+    "aber als am an auch auf aus bei bin bis das dass dem den der des die du ein eine einem einen einer es "
+    "für hat hatte ich ihr im in ist ja mich mir mit nicht noch nur oder sich sie sind so und uns von war "
+    "was wie wir zu zum zur".split()
+)
+
+
+def tokenize(text: str) -> List[str]:
+    """Return the lower-case words of a text, without stop words."""
+    return [word for word in re.findall(r"\w+", text.lower()) if word not in STOP_WORDS]
+
+
+def stem(word: str) -> str:
+    """Strip a common English or German ending, so e.g. 'jobs' and 'job' are the same feature."""
+    for suffix in SUFFIXES:
+        if word.endswith(suffix) and len(word) - len(suffix) >= 3:
+            return word[:-len(suffix)]
+    return word
+
+
+class Embedder(ABC):
+    """Turns texts into vectors of length `dimension`."""
+    name: str
+    dimension: int
+
+    @abstractmethod
+    def embed(self, texts: List[str]) -> np.ndarray:
+        """Return the float32 vectors of the texts as rows of a matrix, with unit length (or zero)."""
+
+
+def normalize(vectors: np.ndarray) -> np.ndarray:
+    """Scale the rows to unit length, so dot products are cosine similarities."""
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    return (vectors / np.where(norms == 0, 1, norms)).astype(np.float32)
+
+
+class HashingEmbedder(Embedder):
+    """Local embedder hashing the stemmed words, see the module docstring."""
+
+    def __init__(self, dimension: int = HASHING_DIMENSION) -> None:
+        self.dimension = dimension
+        self.name = f'hashing-{dimension}'
+
+    def features(self, text: str) -> List[str]:
+        return [stem(word) for word in tokenize(text)]
+
+    def embed(self, texts: List[str]) -> np.ndarray:
+        vectors = np.zeros((len(texts), self.dimension), dtype=np.float64)
+        for row, text in enumerate(texts):
+            for feature in self.features(text):
+                # crc32 is stable across processes, unlike hash()
+                h = zlib.crc32(feature.encode())
+                # the sign keeps collisions from adding up
+                vectors[row, h % self.dimension] += 1 if (h // self.dimension) % 2 else -1
+        # sublinear term frequency, so a word repeated in a long entry does not dominate it
+        vectors = np.sign(vectors) * np.log1p(np.abs(vectors))
+        return normalize(vectors)
+
+
+class OpenAIEmbedder(Embedder):
+    """Embedder using the OpenAI embeddings API."""
+
+    def __init__(self, model: str = "text-embedding-3-small", dimension: int = 512) -> None:
+        self.model = model
+        self.dimension = dimension
+        self.name = f'openai-{model}-{dimension}'
+        self.client = openai_api.OpenAiCLient(utils.get_openai_token(), utils.get_openai_base_url())
+
+    def embed(self, texts: List[str]) -> np.ndarray:
+        # the API rejects empty input
+        vectors = self.client.embeddings([text if text.strip() else ' ' for text in texts], self.model, self.dimension)
+        return normalize(np.array(vectors, dtype=np.float32).reshape(len(texts), self.dimension))
+
+
+class VectorIndex:
+    """
+    Append-only vectors of the messages of every user, in `root/<embedder name>/`. Rows of the matrix
+    file and entries of the ids file correspond; a row without id (e.g. after a crash) is ignored.
+    """
+
+    def __init__(self, root: Path, embedder: Embedder) -> None:
+        self.path = Path(root) / embedder.name
+        self.path.mkdir(parents=True, exist_ok=True)
+        self.embedder = embedder
+        self._lock = threading.Lock()
+
+    def files(self, user_id: int) -> Tuple[Path, Path]:
+        return self.path / f'{user_id}.vec', self.path / f'{user_id}.ids'
+
+    def add(self, user_id: int, message_ids: List[int], texts: List[str]) -> None:
+        """Embed the messages of a user and append them to their index."""
+        if not message_ids:
+            return
+        vectors = self.embedder.embed(texts)
+        vectors_path, ids_path = self.files(user_id)
+        with self._lock:
+            self._truncate(vectors_path, ids_path)
+            # the vectors first, so every id has its row
+            with open(vectors_path, 'ab') as file:
+                file.write(np.ascontiguousarray(vectors, dtype=np.float32).tobytes())
+            with open(ids_path, 'ab') as file:
+                file.write(np.asarray(message_ids, dtype=np.int64).tobytes())
+
+    def _truncate(self, vectors_path: Path, ids_path: Path) -> None:
+        """Cut off what an interrupted append left behind, so the next rows and ids line up again."""
+        row_size = 4 * self.embedder.dimension
+        vectors_size = vectors_path.stat().st_size if vectors_path.exists() else 0
+        ids_size = ids_path.stat().st_size if ids_path.exists() else 0
+        rows = min(vectors_size // row_size, ids_size // 8)
+        if vectors_size != rows * row_size:
+            os.truncate(vectors_path, rows * row_size)
+        if ids_size != rows * 8:
+            os.truncate(ids_path, rows * 8)
+
+    def load(self, user_id: int) -> Tuple[np.ndarray, np.ndarray]:
+        """Return the message_ids and the memory-mapped matrix of their vectors (empty without index)."""
+        vectors_path, ids_path = self.files(user_id)
+        if not ids_path.exists() or ids_path.stat().st_size == 0:
+            return np.zeros(0, dtype=np.int64), np.zeros((0, self.embedder.dimension), dtype=np.float32)
+        message_ids = np.fromfile(ids_path, dtype=np.int64, count=ids_path.stat().st_size // 8)
+        rows = min(len(message_ids), vectors_path.stat().st_size // (4 * self.embedder.dimension))
+        if rows == 0:
+            return np.zeros(0, dtype=np.int64), np.zeros((0, self.embedder.dimension), dtype=np.float32)
+        vectors = np.memmap(vectors_path, dtype=np.float32, mode='r', shape=(rows, self.embedder.dimension))
+        return message_ids[:rows], vectors
+
+    def search(self, user_id: int, query: str, k: int = TOP_K) -> List[Tuple[int, float]]:
+        """Return (message_id, cosine similarity) of the `k` messages of a user most similar to the query, best first."""
+        message_ids, vectors = self.load(user_id)
+        if len(message_ids) == 0:
+            return []
+        scores = vectors @ self.embedder.embed([query])[0]
+        k = min(k, len(scores))
+        best = np.argpartition(-scores, k - 1)[:k]
+        best = best[np.argsort(-scores[best])]
+        return [(int(message_ids[i]), float(scores[i])) for i in best if scores[i] >= MIN_SCORE]
+
+    def delete(self, user_id: int) -> None:
+        """Delete the index of a user."""
+        with self._lock:
+            for path in self.files(user_id):
+                path.unlink(missing_ok=True)
+
+    def indexed_ids(self, user_id: int) -> set:
+        return set(self.load(user_id)[0].tolist())
+
+
+def create_embedder(config: dict) -> Embedder:
+    """Create the embedder of a config as returned by `utils.get_semantic_search_config`."""
+    embedder = config.get('embedder', 'hashing')
+    if embedder == 'hashing':
+        return HashingEmbedder(config.get('dimension', HASHING_DIMENSION))
+    if embedder == 'openai':
+        return OpenAIEmbedder(config.get('model', "text-embedding-3-small"), config.get('dimension', 512))
+    raise ValueError(f"Unknown embedder: {embedder}")
+
+
+_indexes = {}  # config -> VectorIndex
+
+
+def get_index() -> VectorIndex:
+    """Return the vector index of the configured embedder."""
+    config = utils.get_semantic_search_config()
+    key = (config['path'], config.get('embedder', 'hashing'), config.get('model'), config.get('dimension'))
+    if key not in _indexes:
+        _indexes[key] = VectorIndex(Path(config['path']), create_embedder(config))
+    return _indexes[key]
+
+
+def index_message(user_id: int, message_id: int, text: str) -> None:
+    """Add a new message to the index. It is blocking (the OpenAI embedder sends a request), run it in a thread."""
+    get_index().add(user_id, [message_id], [text])
+
+
+def delete_user_index(user_id: int) -> None:
+    """Delete the vectors of a user, e.g. when they deregister."""
+    get_index().delete(user_id)
+
+
+def search(user_id: int, query: str, k: int = TOP_K) -> List[Tuple[float, tuple]]:
+    """Return (score, message) of the messages of a user most similar to the query, best first."""
+    results = []
+    for message_id, score in get_index().search(user_id, query, k):
+        message = db.get_message(message_id)
+        # anonymized messages have no text anymore
+        if message is not None and message[1] == user_id and message[3]:
+            results.append((score, message))
+    return results
+
+
+def build_prompt(question: str, results: List[Tuple[float, tuple]]) -> str:
+    """Return the question with the matching diary entries, in chronological order."""
+    entries = sorted((message for _, message in results), key=lambda message: parse_date(message[2]))
+    lines = ["Diary entries:"]
+    for message in entries:
+        lines.append(f"[{parse_date(message[2]).strftime('%Y-%m-%d %H:%M')}] {message[3][:MAX_ENTRY_CHARS]}")
+    lines.append(f"\nQuestion: {question}")
+    return "\n".join(lines)
+
+
+def answer(user_id: int, question: str) -> Optional[str]:
+    """
+    Answer a question about the diary of a user from the best matching entries, or return None if no
+    entry matches. It is blocking, run it in a thread.
+    """
+    results = search(user_id, question)
+    if not results:
+        return None
+    config = utils.get_semantic_search_config()
+    client = openai_api.OpenAiCLient(utils.get_openai_token(), utils.get_openai_base_url())
+    prompt = build_prompt(question, results)
+    return client.chat_completion(prompt, config.get('chat_model', CHAT_MODEL), ANSWER_CONTEXT).content
+
+
+def format_results(results: List[Tuple[float, tuple]]) -> str:
+    """Return the matching entries as a message text, e.g. if the chat model is not reachable."""
+    return "\n\n".join(f"{parse_date(message[2]).strftime('%Y-%m-%d %H:%M')} ({score:.2f}): {message[3][:300]}" for score, message in results)
+
+
+def backfill(batch_size: int = BACKFILL_BATCH_SIZE) -> int:
+    """Add the messages that are not in the index yet (e.g. from before it existed). Returns their number."""
+    index = get_index()
+    added = 0
+    after = None
+    while True:
+        user_ids = db.get_user_ids(after, 1000)
+        for user_id in user_ids:
+            indexed = index.indexed_ids(user_id)
+            missing = [message for message in db.get_messages_by_user(user_id) if message[0] not in indexed and message[3]]
+            for start in range(0, len(missing), batch_size):
+                batch = missing[start:start + batch_size]
+                index.add(user_id, [message[0] for message in batch], [message[3] for message in batch])
+            added += len(missing)
+        if len(user_ids) < 1000:
+            return added
+        after = user_ids[-1]
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Semantic search over the diary entries.")
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    subparsers.add_parser('backfill', help="Add the stored messages that are not in the vector index yet.")
+    search_parser = subparsers.add_parser('search', help="Print the entries of a user most similar to a query.")
+    search_parser.add_argument('user_id', type=int)
+    search_parser.add_argument('query')
+    args = parser.parse_args()
+    if args.command == 'backfill':
+        print(f"Added {backfill()} message(s) to the index.")
+    else:
+        print(format_results(search(args.user_id, args.query)))
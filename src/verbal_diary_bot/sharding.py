@@ -0,0 +1,201 @@
+"""
+This script runs the bot in several worker processes, sharded by user.
+
+One ingress process receives the updates (by polling `getUpdates` or with the webhook) and sends
+each one to worker `user_id % workers`. Every worker runs the full `Application` with its own
+update queue. So all updates of a user are handled by the same worker, in the order they arrived,
+and the in-memory `ConversationHandler` state of a user (e.g. the registration) stays on that worker.
+The background tasks of a worker (Notion outbox, Notion sync) only handle the users of its shard.
+The workers share the SQLite database, which is switched to WAL mode for concurrent access.
+
+Enabled with `"workers": 4` in the telegram config.
+"""
+import asyncio
+import logging
+import multiprocessing
+import signal
+from typing import Callable, Optional, Tuple
+
+from telegram import Bot, Update
+from telegram.error import NetworkError, TimedOut
+
+from . import utils
+from . import database_operations as db
+
+logger = logging.getLogger(__name__)
+
+POLL_TIMEOUT = 10  # seconds of a getUpdates long poll
+SHUTDOWN_TIMEOUT = 60  # seconds to wait for a worker to finish its updates
+
+
+def get_user_id(update: dict) -> Optional[int]:
+    """Return the id of the user (or else the chat) an update belongs to."""
+    for value in update.values():
+        if not isinstance(value, dict):
+            continue
+        if isinstance(value.get('from'), dict):
+            return value['from']['id']
+        if isinstance(value.get('chat'), dict):
+            return value['chat']['id']
+        if isinstance(value.get('user'), dict):
+            return value['user']['id']
+    return None
+
+
+def get_shard_index(user_id: Optional[int], count: int) -> int:
+    """Return the worker that handles a user. Updates without a user go to the first worker."""
+    return 0 if user_id is None else user_id % count
+
+
+def in_shard(user_id: int, shard: Optional[Tuple[int, int]]) -> bool:
+    """Whether a user belongs to the shard `(index, count)`. Without shard, every user does."""
+    return shard is None or get_shard_index(user_id, shard[1]) == shard[0]
+
+
+def run_worker(index: int, count: int, updates: multiprocessing.Queue, config_path: str, build_application: Optional[Callable], build_kwargs: dict) -> None:
+    """Entry point of a worker process."""
+    # Ctrl+C reaches the whole process group, the ingress stops the workers in order
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    utils.TOKEN_PATH = config_path
+    if build_application is None:
+        from .main_bot import build_application
+    asyncio.run(serve_worker(build_application(**build_kwargs), index, count, updates))
+
+
+async def serve_worker(application, index: int, count: int, updates: multiprocessing.Queue) -> None:
+    application.bot_data['shard'] = (index, count)
+    await application.initialize()
+    if application.post_init is not None:
+        await application.post_init(application)
+    await application.start()
+    logger.info(f"Worker {index + 1}/{count} is running.")
+    loop = asyncio.get_running_loop()
+    try:
+        while True:
+            data = await loop.run_in_executor(None, updates.get)
+            if data is None:
+                break
+            try:
+                update = Update.de_json(data, application.bot)
+            except (ValueError, TypeError, KeyError, AttributeError) as e:
+                # e.g. a webhook body that is an object, but not an update
+                logger.error(f"Worker {index + 1}/{count} received an invalid update: {e!r}")
+                continue
+            await application.update_queue.put(update)
+    finally:
+        # the updates that are already queued are still handled
+        await application.stop()
+        if application.post_shutdown is not None:
+            await application.post_shutdown(application)
+        await application.shutdown()
+
+
+class Ingress:
+    """Starts the workers and routes the updates to them."""
+
+    def __init__(self, workers: int, build_application: Optional[Callable] = None, build_kwargs: Optional[dict] = None) -> None:
+        self.count = workers
+        self.build_application = build_application
+        self.build_kwargs = build_kwargs or {}
+        self._context = multiprocessing.get_context('spawn')
+        self.queues = [self._context.Queue() for _ in range(workers)]
+        self.processes = [None] * workers
+
+    def start(self) -> None:
+        # several processes write to the database
+        db.enable_wal()
+        for index in range(self.count):
+            self._start_worker(index)
+
+    def _start_worker(self, index: int) -> None:
+        process = self._context.Process(
+            target=run_worker, name=f'bot-worker-{index}',
+            args=(index, self.count, self.queues[index], utils.TOKEN_PATH, self.build_application, self.build_kwargs),
+        )
+        process.start()
+        self.processes[index] = process
+
+    def route(self, update: dict) -> int:
+        """Send an update to the worker of its user. Returns the index of the worker."""
+        index = get_shard_index(get_user_id(update), self.count)
+        if not self.processes[index].is_alive():
+            logger.error(f"Worker {index} died (exit code {self.processes[index].exitcode}), restarting it.")
+            self._start_worker(index)
+        self.queues[index].put(update)
+        return index
+
+    def stop(self) -> None:
+        for queue in self.queues:
+            queue.put(None)
+        for index, process in enumerate(self.processes):
+            process.join(SHUTDOWN_TIMEOUT)
+            if process.is_alive():
+                logger.error(f"Worker {index} did not stop in time, terminating it.")
+                process.terminate()
+                process.join()
+
+
+async def poll_updates(bot: Bot, ingress: Ingress, stop: asyncio.Event) -> None:
+    """Long poll `getUpdates` and route the updates until `stop` is set."""
+    offset = None
+    while not stop.is_set():
+        try:
+            updates = await bot.get_updates(offset=offset, timeout=POLL_TIMEOUT, allowed_updates=Update.ALL_TYPES)
+        except (NetworkError, TimedOut) as e:
+            logger.warning(f"Polling updates failed: {e!r}")
+            await asyncio.sleep(1)
+            continue
+        for update in updates:
+            ingress.route(update.to_dict())
+            offset = update.update_id + 1
+
+
+async def serve_sharded(workers: int, webhook_config: Optional[dict] = None, build_application: Optional[Callable] = None, build_kwargs: Optional[dict] = None, stop: Optional[asyncio.Event] = None) -> None:
+    """
+    Run the bot with `workers` worker processes until `stop` is set (or SIGINT/SIGTERM are received).
+
+    Parameters
+    ----------
+    workers : int
+        Number of worker processes.
+    webhook_config : Optional[dict], optional
+        The webhook config, by default the updates are polled.
+    build_application : Optional[Callable], optional
+        Function that builds the application of a worker, by default `main_bot.build_application`.
+        It is called in the worker process, so it has to be importable (a module-level function).
+    build_kwargs : Optional[dict], optional
+        Keyword arguments of `build_application` (token, base_url, ...).
+    stop : Optional[asyncio.Event], optional
+        Event to stop the bot, by default a new event that is set by SIGINT and SIGTERM.
+    """
+    from .webhook import WebhookServer, set_webhook, start_signal_handlers
+
+    if webhook_config is not None and not webhook_config.get('secret_token'):
+        raise ValueError("The webhook needs a secret_token.")
+    if stop is None:
+        stop = asyncio.Event()
+        start_signal_handlers(stop)
+    build_kwargs = build_kwargs or {}
+    bot = Bot(build_kwargs.get('token') or utils.get_telegram_token(), base_url=build_kwargs.get('base_url') or 'https://api.telegram.org/bot')
+    ingress = Ingress(workers, build_application, build_kwargs)
+    ingress.start()
+    await bot.initialize()
+    try:
+        if webhook_config is None:
+            await bot.delete_webhook()
+            polling = asyncio.create_task(poll_updates(bot, ingress, stop))
+            await stop.wait()
+            polling.cancel()
+            await asyncio.gather(polling, return_exceptions=True)
+        else:
+            async def route(data: dict) -> None:
+                ingress.route(data)
+
+            server = WebhookServer.from_config(route, webhook_config)
+            await set_webhook(bot, webhook_config)
+            await server.start()
+            await stop.wait()
+            await server.stop()
+    finally:
+        await bot.shutdown()
+        await asyncio.get_running_loop().run_in_executor(None, ingress.stop)
@@ -0,0 +1,143 @@
+"""
+This script makes the shutdown of the bot graceful.
+
+When the bot is stopped (SIGTERM/SIGINT during a deploy), `DrainingApplication.stop` is called after
+no more updates are fetched from Telegram. Before the application stops, it waits up to
+`deadline` seconds for:
+
+- the voice messages that are being processed (tracked with `jobs.track()` in the handlers),
+- the updates that were already fetched but not handled yet.
+
+Whatever is not done by then is checkpointed instead of lost: the running voice jobs are cancelled,
+their progress (downloaded file, transcription if it was already paid for) is in the VoiceJobs table,
+and the queued updates are stored in the PendingUpdates table. Both are picked up again by
+`restore_pending_updates` and `telegram_handlers.resume_voice_jobs` on the next start. The Notion
+outbox is flushed and the pooled clients are closed afterwards, in `post_shutdown`.
+
+After a restart or a polling retry, Telegram may deliver an update that was handled already. A voice
+message is marked as processed in the ProcessedUpdates table (by chat and message_id) in the same
+transaction that creates its voice job, and the handler checks it first, so a duplicate costs one
+lookup in the primary key instead of a transcription and a Notion entry. Telegram keeps undelivered
+updates for at most a day, so the entries are deleted after `PROCESSED_UPDATES_TTL`.
+
+The deadline is set with `"shutdown": {"deadline": 20}` in `configs.json`.
+"""
+import asyncio
+import json
+import logging
+import time
+from contextlib import contextmanager
+from typing import Optional, Tuple
+
+from telegram import Update
+from telegram.ext import Application
+
+from . import metrics, utils
+from . import database_operations as db
+from .sharding import get_user_id, in_shard
+
+logger = logging.getLogger(__name__)
+
+PROCESSED_UPDATES_TTL = 2 * 24 * 60 * 60  # seconds a processed message is remembered
+EXPIRY_INTERVAL = 60 * 60  # seconds between two deletions of the expired entries
+
+
+class JobTracker:
+    """Keeps track of the asyncio tasks that are processing a voice message."""
+
+    def __init__(self) -> None:
+        self._tasks = set()
+
+    @contextmanager
+    def track(self):
+        """Mark the current task as in-flight job while the block runs."""
+        task = asyncio.current_task()
+        self._tasks.add(task)
+        try:
+            yield
+        finally:
+            self._tasks.discard(task)
+
+    def pending(self) -> set:
+        return {task for task in self._tasks if not task.done() and task is not asyncio.current_task()}
+
+    async def cancel(self) -> int:
+        """Cancel the jobs that are still running. Returns their number."""
+        tasks = self.pending()
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        return len(tasks)
+
+
+jobs = JobTracker()
+
+
+async def drain(application: Application, deadline: float) -> Tuple[int, int]:
+    """
+    Wait up to `deadline` seconds for the in-flight jobs and the queued updates, then checkpoint the rest.
+
+    Returns
+    -------
+    Tuple[int, int]
+        The number of cancelled jobs and of stored updates.
+    """
+    end = time.monotonic() + deadline
+    if jobs.pending() or not application.update_queue.empty():
+        logger.info(f"Waiting up to {deadline:g}s for {len(jobs.pending())} voice job(s) and {application.update_queue.qsize()} queued update(s).")
+    while (jobs.pending() or not application.update_queue.empty()) and time.monotonic() < end:
+        await asyncio.sleep(0.05)
+    # the queue first: in sequential mode a voice job runs in the task fetching the updates, which drops
+    # the queued updates when it is cancelled
+    stored = checkpoint_update_queue(application.update_queue)
+    cancelled = await jobs.cancel()
+    if cancelled or stored:
+        logger.warning(f"Shutdown deadline reached: checkpointed {cancelled} voice job(s) and {stored} update(s), they are resumed on the next start.")
+    return cancelled, stored
+
+
+def checkpoint_update_queue(update_queue: asyncio.Queue) -> int:
+    """Move the updates that were not handled yet from the queue into the PendingUpdates table."""
+    updates = []
+    while not update_queue.empty():
+        update = update_queue.get_nowait()
+        update_queue.task_done()
+        if isinstance(update, Update):
+            updates.append((update.update_id, json.dumps(update.to_dict())))
+    db.insert_pending_updates(updates)
+    return len(updates)
+
+
+async def restore_pending_updates(application: Application, shard: Optional[Tuple[int, int]] = None) -> int:
+    """Queue the updates stored by the last shutdown again (only those of the `shard`, with several workers)."""
+    restored = []
+    for update_id, data in db.get_pending_updates():
+        data = json.loads(data)
+        if not in_shard(get_user_id(data), shard):
+            continue
+        await application.update_queue.put(Update.de_json(data, application.bot))
+        restored.append(update_id)
+    db.delete_pending_updates(restored)
+    if restored:
+        logger.info(f"Restored {len(restored)} update(s) from the last shutdown.")
+    return len(restored)
+
+
+class DrainingApplication(Application):
+    """Application that drains (or checkpoints) the in-flight work before it stops."""
+
+    async def stop(self) -> None:
+        if self.running:
+            await drain(self, utils.get_shutdown_deadline())
+        await super().stop()
+
+
+async def expire_processed_updates(context=None) -> int:
+    """Delete the expired entries of the ProcessedUpdates table. Used as job queue callback. Returns their number."""
+    deleted = await asyncio.to_thread(db.expire_processed_updates, time.time() - PROCESSED_UPDATES_TTL)
+    if deleted:
+        logger.info(f"Forgot {deleted} processed message(s).")
+    return deleted
+
+
+metrics.describe('duplicate_updates_total', 'counter', 'Number of voice messages that were delivered again and skipped.')
@@ -0,0 +1,130 @@
+"""
+This script keeps a user informed about their voice message with a single message that is edited in place.
+
+Instead of one reply per pipeline stage (received, transcript, Notion, statistics), a `StatusMessage`
+is posted once and then edited as the stages finish. Updates are coalesced: the message is sent or
+edited at most once every `MIN_INTERVAL` seconds (counted from the arrival of the voice message), and
+only the latest state is sent, so e.g. a quick transcription replaces the "received" note before
+anything was posted. Telegram allows about one message per second and chat, edits included.
+
+A transcript that does not fit into a message is sent as a text file (one request instead of one per
+4096 characters), the status message shows its beginning.
+"""
+import asyncio
+import logging
+import time
+from datetime import datetime
+from typing import Optional
+
+from telegram import Bot
+from telegram.error import BadRequest, TelegramError
+
+from . import metrics
+
+logger = logging.getLogger(__name__)
+
+MIN_INTERVAL = 1.0  # seconds between two requests for the same status message
+MAX_MESSAGE_LENGTH = 4096  # characters, Telegram's limit
+TRANSCRIPT_PREVIEW = 1000  # characters of a long transcript shown in the status message
+
+
+class StatusMessage:
+    """
+    A message in `chat_id` showing the transcript of a voice message, the current stage and notes
+    (e.g. the user's statistics). `set_transcript`, `set_stage` and `add_note` schedule an update,
+    `wait` waits until the latest state is sent.
+    """
+
+    def __init__(self, bot: Bot, chat_id: int, min_interval: float = MIN_INTERVAL, started: Optional[float] = None) -> None:
+        self.bot = bot
+        self.chat_id = chat_id
+        self.min_interval = min_interval
+        self.transcript = None
+        self.stage = None
+        self.notes = []
+        self.message_id = None
+        self.sent_text = None
+        # the first request is delayed as well, by default from now on
+        self.last_request = time.monotonic() if started is None else started
+        self._flush_task = None
+        self._lock = asyncio.Lock()
+
+    def render(self) -> str:
+        parts = [part for part in (self.transcript, self.stage) if part]
+        return "\n\n".join(parts + self.notes)
+
+    def set_stage(self, text: str) -> None:
+        """Show the current stage, e.g. "Appending to Notion", below the transcript."""
+        self.stage = text
+        self._schedule()
+
+    def add_note(self, text: str) -> bool:
+        """Add a note at the end, if the message stays short enough. Returns whether it was added."""
+        if len(self.render()) + len(text) + 2 > MAX_MESSAGE_LENGTH:
+            return False
+        self.notes.append(text)
+        self._schedule()
+        return True
+
+    async def set_transcript(self, text: str, date: Optional[datetime] = None) -> None:
+        """Show the transcript. If it is too long for the message, it is sent as a file right away."""
+        if not text.strip():
+            text = "(No speech recognized.)"
+        if len(text) + len(self.stage or '') + 2 > MAX_MESSAGE_LENGTH:
+            date = date or datetime.now()
+            file_name = f"transcript-{date.strftime('%Y-%m-%d-%H%M%S')}.txt"
+            try:
+                await self.bot.send_document(chat_id=self.chat_id, document=text.encode(), filename=file_name)
+                metrics.increment('status_requests_total', method='sendDocument')
+                text = f"{text[:TRANSCRIPT_PREVIEW]} …\n\n\U0001F4C4 The full transcript ({len(text)} characters) is in {file_name}."
+            except TelegramError as e:
+                logger.warning(f"Could not send the transcript as a file: {e!r}")
+                text = f"{text[:TRANSCRIPT_PREVIEW]} …"
+        self.transcript = text
+        self._schedule()
+
+    def _schedule(self) -> None:
+        if self._flush_task is None or self._flush_task.done():
+            self._flush_task = asyncio.create_task(self._flush_later())
+
+    async def _flush_later(self) -> None:
+        delay = self.last_request + self.min_interval - time.monotonic()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        await self.flush()
+
+    async def flush(self) -> None:
+        """Send or edit the message now, if its text changed."""
+        async with self._lock:
+            text = self.render()
+            if not text or text == self.sent_text:
+                return
+            try:
+                if self.message_id is None:
+                    message = await self.bot.send_message(chat_id=self.chat_id, text=text)
+                    self.message_id = message.message_id
+                    metrics.increment('status_requests_total', method='sendMessage')
+                else:
+                    await self.bot.edit_message_text(chat_id=self.chat_id, message_id=self.message_id, text=text)
+                    metrics.increment('status_requests_total', method='editMessageText')
+                self.sent_text = text
+            except BadRequest as e:
+                if 'not modified' in str(e).lower():
+                    self.sent_text = text
+                else:
+                    logger.warning(f"Could not update the status message in chat {self.chat_id}: {e!r}")
+            except TelegramError as e:
+                # the next update tries again
+                logger.warning(f"Could not update the status message in chat {self.chat_id}: {e!r}")
+            finally:
+                self.last_request = time.monotonic()
+
+    async def wait(self) -> None:
+        """Wait until the latest state is sent (respecting the minimum interval)."""
+        while self._flush_task is not None and not self._flush_task.done():
+            await self._flush_task
+        if self.render() != self.sent_text:
+            await self._flush_later()
+
+
+metrics.describe('status_requests_total', 'counter', 'Number of Bot API requests for the status messages of voice messages, by method.')
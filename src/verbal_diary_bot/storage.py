@@ -0,0 +1,444 @@
+"""
+This script provides the storage backends of the users and their messages.
+
+`database_operations` passes the user and message operations to the backend selected in the
+`database` section of `configs.json`:
+
+    "database": {"backend": "sqlite", ...}  # the default, the file at save_paths.db_path
+    "database": {"backend": "postgres", "postgres": {"dsn": "postgresql://bot@localhost/diary", "min_size": 1, "max_size": 10}, ...}
+
+SQLite keeps everything in a single file that only one connection can write at a time, which becomes
+the bottleneck with several bot workers (see `sharding`). PostgreSQL handles concurrent writers, and
+its connections are kept in a pool, so a query does not pay for opening a new connection.
+Both backends return the rows as tuples in the same column order and pass the same tests
+(`tests/test_storage.py`). The other tables (Notion outbox and mirror, shutdown checkpoints) are
+still kept in SQLite.
+"""
+import random
+import sqlite3
+from abc import ABC, abstractmethod
+from datetime import datetime
+from typing import Optional
+from zoneinfo import ZoneInfo
+
+from . import utils
+
+DB_TIMEOUT = 30  # seconds to wait for a lock held by another connection (e.g. another bot worker)
+DATE_FORMAT = '%Y-%m-%d %H:%M:%S %z'
+DEFAULT_TIMEZONE = 'Europe/Berlin'  # of the dates stored without offset
+QUERY_CHUNK_SIZE = 500  # ids per query, SQLite limits the number of parameters
+
+POSTGRES_USERS_FIELDS = [
+    'user_id BIGINT PRIMARY KEY',
+    'name TEXT',
+    'notion_token TEXT',
+    'database_id TEXT',
+]
+POSTGRES_MESSAGES_FIELDS = [
+    'message_id BIGSERIAL PRIMARY KEY',
+    'user_id BIGINT',
+    'date TEXT',
+    'message TEXT',
+    'word_count INTEGER',
+    'message_type TEXT',
+    'audio_length DOUBLE PRECISION',
+]
+
+
+def random_user_id() -> int:
+    """
+    Return a random user_id for an anonymized user. It is larger than 2^52, so it can never be the id
+    of a Telegram user, the caller makes sure it is not taken by another anonymized user.
+    """
+    return int(f"999{random.randint(10 ** 12, 10 ** 13 - 1)}")
+
+
+def parse_date(date: str) -> datetime:
+    """Parse a stored message date. Dates that were stored without offset are in the default timezone."""
+    date = date.strip()
+    if len(date) > 19:
+        return datetime.strptime(date, DATE_FORMAT)
+    return datetime.strptime(date, '%Y-%m-%d %H:%M:%S').replace(tzinfo=ZoneInfo(DEFAULT_TIMEZONE))
+
+
+class Storage(ABC):
+    """Storage of the users and their messages. Rows are returned as tuples in the column order of the tables."""
+
+    @abstractmethod
+    def create_tables(self) -> None:
+        """Create the Users and Messages tables if they do not exist yet."""
+
+    @abstractmethod
+    def insert_user(self, user_id: int, name: str, notion_token: str, database_id: str) -> None:
+        """Insert a new user into the Users table."""
+
+    @abstractmethod
+    def get_user(self, user_id: int) -> Optional[tuple]:
+        """Retrieve a user's details by user_id, or None."""
+
+    @abstractmethod
+    def get_all_users(self) -> list:
+        """Retrieve all users, ordered by user_id."""
+
+    @abstractmethod
+    def get_user_ids(self, after: Optional[int], limit: int) -> list:
+        """Retrieve up to `limit` user_ids greater than `after` (all with None), ordered by user_id."""
+
+    @abstractmethod
+    def count_users(self) -> int:
+        """Return the number of users."""
+
+    @abstractmethod
+    def update_user(self, user_id: int, name: str, notion_token: str, database_id: str) -> None:
+        """Update a user's information in the Users table."""
+
+    @abstractmethod
+    def delete_user(self, user_id: int) -> None:
+        """Delete a user and their messages."""
+
+    @abstractmethod
+    def anonymize_users(self, user_ids: list) -> dict:
+        """
+        Remove the details and message texts of the users, and move both to a random user_id that is
+        not taken yet, all in one transaction. Returns the new user_id of each user that exists.
+        """
+
+    def anonymize_user(self, user_id: int) -> Optional[int]:
+        """Anonymize a single user (see `anonymize_users`). Returns their new user_id, or None if they do not exist."""
+        return self.anonymize_users([user_id]).get(user_id)
+
+    @abstractmethod
+    def user_exists(self, user_id: int) -> bool:
+        """Check if a user exists."""
+
+    @abstractmethod
+    def insert_message(self, user_id: int, date: datetime, message: str, word_count: int, message_type: str, audio_length: float) -> int:
+        """Insert a new message into the Messages table. Returns its message_id."""
+
+    @abstractmethod
+    def get_message(self, message_id: int) -> Optional[tuple]:
+        """Retrieve a message's details by message_id, or None."""
+
+    @abstractmethod
+    def get_all_messages(self) -> list:
+        """Retrieve all messages, ordered by message_id."""
+
+    @abstractmethod
+    def get_messages_by_user(self, user_id: int) -> list:
+        """Retrieve all messages sent by a user, ordered by message_id."""
+
+    @abstractmethod
+    def get_message_stats_by_user(self, user_id: int) -> list:
+        """Retrieve (date, word_count, audio_length) of all messages sent by a user, ordered by message_id."""
+
+    @abstractmethod
+    def get_last_message_dates(self, user_ids: list) -> dict:
+        """Return the date of the last message (highest message_id) of each user, users without messages are left out."""
+
+    def close(self) -> None:
+        """Release the connections of the backend."""
+
+
+class SQLiteStorage(Storage):
+    """Storage in a SQLite file. Every operation opens its own connection, which is cheap for SQLite."""
+
+    def __init__(self, path: str) -> None:
+        self.path = path
+
+    def connect(self) -> sqlite3.Connection:
+        return sqlite3.connect(self.path, timeout=DB_TIMEOUT)
+
+    def create_tables(self) -> None:
+        db_configs = utils.get_config()['database']
+        conn = self.connect()
+        cursor = conn.cursor()
+        cursor.execute(f'CREATE TABLE IF NOT EXISTS Users ({", ".join(db_configs["Users_fields"])})')
+        cursor.execute(f'CREATE TABLE IF NOT EXISTS Messages ({", ".join(db_configs["Messages_fields"])})')
+        # the last message of a user is found without reading their other messages
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_messages_user_message ON Messages (user_id, message_id)')
+        conn.commit()
+        conn.close()
+
+    def insert_user(self, user_id: int, name: str, notion_token: str, database_id: str) -> None:
+        conn = self.connect()
+        cursor = conn.cursor()
+        cursor.execute('INSERT INTO Users (user_id, name, notion_token, database_id) VALUES (?, ?, ?, ?)', (user_id, name, notion_token, database_id))
+        conn.commit()
+        conn.close()
+
+    def get_user(self, user_id: int) -> Optional[tuple]:
+        conn = self.connect()
+        cursor = conn.cursor()
+        cursor.execute('SELECT * FROM Users WHERE user_id = ?', (user_id,))
+        user_data = cursor.fetchone()
+        conn.close()
+        return user_data
+
+    def get_all_users(self) -> list:
+        conn = self.connect()
+        cursor = conn.cursor()
+        cursor.execute('SELECT * FROM Users ORDER BY user_id')
+        user_data = cursor.fetchall()
+        conn.close()
+        return user_data
+
+    def get_user_ids(self, after: Optional[int], limit: int) -> list:
+        conn = self.connect()
+        cursor = conn.cursor()
+        if after is None:
+            cursor.execute('SELECT user_id FROM Users ORDER BY user_id LIMIT ?', (limit,))
+        else:
+            cursor.execute('SELECT user_id FROM Users WHERE user_id > ? ORDER BY user_id LIMIT ?', (after, limit))
+        user_ids = [row[0] for row in cursor.fetchall()]
+        conn.close()
+        return user_ids
+
+    def count_users(self) -> int:
+        conn = self.connect()
+        cursor = conn.cursor()
+        cursor.execute('SELECT COUNT(*) FROM Users')
+        count = cursor.fetchone()[0]
+        conn.close()
+        return count
+
+    def update_user(self, user_id: int, name: str, notion_token: str, database_id: str) -> None:
+        conn = self.connect()
+        cursor = conn.cursor()
+        cursor.execute('UPDATE Users SET name = ?, notion_token = ?, database_id = ? WHERE user_id = ?', (name, notion_token, database_id, user_id))
+        conn.commit()
+        conn.close()
+
+    def delete_user(self, user_id: int) -> None:
+        conn = self.connect()
+        cursor = conn.cursor()
+        cursor.execute('DELETE FROM Users WHERE user_id = ?', (user_id,))
+        cursor.execute('DELETE FROM Messages WHERE user_id = ?', (user_id,))
+        conn.commit()
+        conn.close()
+
+    def anonymize_users(self, user_ids: list) -> dict:
+        conn = self.connect()
+        cursor = conn.cursor()
+        try:
+            # no other connection can take the new user_ids before the commit
+            cursor.execute('BEGIN IMMEDIATE')
+            new_user_ids = {}
+            for user_id in user_ids:
+                if cursor.execute('SELECT 1 FROM Users WHERE user_id = ?', (user_id,)).fetchone() is None:
+                    continue
+                new_user_id = random_user_id()
+                while new_user_id in new_user_ids.values() or cursor.execute('SELECT 1 FROM Users WHERE user_id = ?', (new_user_id,)).fetchone():
+                    new_user_id = random_user_id()
+                new_user_ids[user_id] = new_user_id
+            # one statement per table and user, both find the rows by index (primary key, idx_messages_user_message)
+            changes = [(new_user_id, user_id) for user_id, new_user_id in new_user_ids.items()]
+            cursor.executemany('UPDATE Users SET user_id = ?, name = NULL, notion_token = NULL, database_id = NULL WHERE user_id = ?', changes)
+            cursor.executemany('UPDATE Messages SET user_id = ?, message = NULL WHERE user_id = ?', changes)
+            conn.commit()
+        finally:
+            # without commit, the transaction is rolled back
+            conn.close()
+        return new_user_ids
+
+    def user_exists(self, user_id: int) -> bool:
+        conn = self.connect()
+        cursor = conn.cursor()
+        cursor.execute('SELECT EXISTS(SELECT 1 FROM Users WHERE user_id = ? LIMIT 1)', (user_id,))
+        exists = cursor.fetchone()[0]
+        conn.close()
+        return exists == 1
+
+    def insert_message(self, user_id: int, date: datetime, message: str, word_count: int, message_type: str, audio_length: float) -> int:
+        conn = self.connect()
+        cursor = conn.cursor()
+        cursor.execute(
+            'INSERT INTO Messages (user_id, date, message, word_count, message_type, audio_length) VALUES (?, ?, ?, ?, ?, ?)',
+            (user_id, date.strftime(DATE_FORMAT), message, word_count, message_type, audio_length)
+        )
+        message_id = cursor.lastrowid
+        conn.commit()
+        conn.close()
+        return message_id
+
+    def get_message(self, message_id: int) -> Optional[tuple]:
+        conn = self.connect()
+        cursor = conn.cursor()
+        cursor.execute('SELECT * FROM Messages WHERE message_id = ?', (message_id,))
+        message_data = cursor.fetchone()
+        conn.close()
+        return message_data
+
+    def get_all_messages(self) -> list:
+        conn = self.connect()
+        cursor = conn.cursor()
+        cursor.execute('SELECT * FROM Messages ORDER BY message_id')
+        message_data = cursor.fetchall()
+        conn.close()
+        return message_data
+
+    def get_messages_by_user(self, user_id: int) -> list:
+        conn = self.connect()
+        cursor = conn.cursor()
+        cursor.execute('SELECT * FROM Messages WHERE user_id = ? ORDER BY message_id', (user_id,))
+        message_data = cursor.fetchall()
+        conn.close()
+        return message_data
+
+    def get_message_stats_by_user(self, user_id: int) -> list:
+        conn = self.connect()
+        cursor = conn.cursor()
+        cursor.execute('SELECT date, word_count, audio_length FROM Messages WHERE user_id = ? ORDER BY message_id', (user_id,))
+        message_data = cursor.fetchall()
+        conn.close()
+        return message_data
+
+    def get_last_message_dates(self, user_ids: list) -> dict:
+        conn = self.connect()
+        cursor = conn.cursor()
+        dates = {}
+        for start in range(0, len(user_ids), QUERY_CHUNK_SIZE):
+            chunk = user_ids[start:start + QUERY_CHUNK_SIZE]
+            cursor.execute(
+                f'SELECT user_id, date FROM Messages WHERE message_id IN '
+                f'(SELECT MAX(message_id) FROM Messages WHERE user_id IN ({", ".join("?" * len(chunk))}) GROUP BY user_id)',
+                chunk
+            )
+            dates.update(cursor.fetchall())
+        conn.close()
+        return dates
+
+
+class PostgresStorage(Storage):
+    """
+    Storage in a PostgreSQL database, with a pool of `min_size` to `max_size` connections.
+    Needs `psycopg` and `psycopg_pool`. Every operation runs in one transaction.
+    """
+
+    def __init__(self, dsn: str, min_size: int = 1, max_size: int = 10) -> None:
+        try:
+            from psycopg_pool import ConnectionPool
+        except ImportError as e:
+            raise ImportError("The postgres backend needs psycopg and psycopg_pool: pip install 'psycopg[binary]' psycopg_pool") from e
+        self.pool = ConnectionPool(dsn, min_size=min_size, max_size=max_size, open=True)
+
+    def create_tables(self) -> None:
+        with self.pool.connection() as conn:
+            conn.execute(f'CREATE TABLE IF NOT EXISTS Users ({", ".join(POSTGRES_USERS_FIELDS)})')
+            conn.execute(f'CREATE TABLE IF NOT EXISTS Messages ({", ".join(POSTGRES_MESSAGES_FIELDS)})')
+            conn.execute('CREATE INDEX IF NOT EXISTS idx_messages_user_message ON Messages (user_id, message_id)')
+            # replaced by the index above
+            conn.execute('DROP INDEX IF EXISTS idx_messages_user')
+
+    def insert_user(self, user_id: int, name: str, notion_token: str, database_id: str) -> None:
+        with self.pool.connection() as conn:
+            conn.execute('INSERT INTO Users (user_id, name, notion_token, database_id) VALUES (%s, %s, %s, %s)', (user_id, name, notion_token, database_id))
+
+    def get_user(self, user_id: int) -> Optional[tuple]:
+        with self.pool.connection() as conn:
+            return conn.execute('SELECT * FROM Users WHERE user_id = %s', (user_id,)).fetchone()
+
+    def get_all_users(self) -> list:
+        with self.pool.connection() as conn:
+            return conn.execute('SELECT * FROM Users ORDER BY user_id').fetchall()
+
+    def get_user_ids(self, after: Optional[int], limit: int) -> list:
+        with self.pool.connection() as conn:
+            if after is None:
+                rows = conn.execute('SELECT user_id FROM Users ORDER BY user_id LIMIT %s', (limit,)).fetchall()
+            else:
+                rows = conn.execute('SELECT user_id FROM Users WHERE user_id > %s ORDER BY user_id LIMIT %s', (after, limit)).fetchall()
+        return [row[0] for row in rows]
+
+    def count_users(self) -> int:
+        with self.pool.connection() as conn:
+            return conn.execute('SELECT COUNT(*) FROM Users').fetchone()[0]
+
+    def update_user(self, user_id: int, name: str, notion_token: str, database_id: str) -> None:
+        with self.pool.connection() as conn:
+            conn.execute('UPDATE Users SET name = %s, notion_token = %s, database_id = %s WHERE user_id = %s', (name, notion_token, database_id, user_id))
+
+    def delete_user(self, user_id: int) -> None:
+        with self.pool.connection() as conn:
+            conn.execute('DELETE FROM Users WHERE user_id = %s', (user_id,))
+            conn.execute('DELETE FROM Messages WHERE user_id = %s', (user_id,))
+
+    def anonymize_users(self, user_ids: list) -> dict:
+        with self.pool.connection() as conn:
+            existing = [row[0] for row in conn.execute('SELECT user_id FROM Users WHERE user_id = ANY(%s) FOR UPDATE', (list(user_ids),)).fetchall()]
+            new_user_ids = {}
+            for user_id in existing:
+                new_user_id = random_user_id()
+                while new_user_id in new_user_ids.values() or conn.execute('SELECT 1 FROM Users WHERE user_id = %s', (new_user_id,)).fetchone():
+                    new_user_id = random_user_id()
+                new_user_ids[user_id] = new_user_id
+            # a user_id taken by a concurrent transaction meanwhile violates the primary key and rolls back everything
+            changes = [(new_user_id, user_id) for user_id, new_user_id in new_user_ids.items()]
+            with conn.cursor() as cursor:
+                cursor.executemany('UPDATE Users SET user_id = %s, name = NULL, notion_token = NULL, database_id = NULL WHERE user_id = %s', changes)
+                cursor.executemany('UPDATE Messages SET user_id = %s, message = NULL WHERE user_id = %s', changes)
+        return new_user_ids
+
+    def user_exists(self, user_id: int) -> bool:
+        with self.pool.connection() as conn:
+            return conn.execute('SELECT EXISTS(SELECT 1 FROM Users WHERE user_id = %s)', (user_id,)).fetchone()[0]
+
+    def insert_message(self, user_id: int, date: datetime, message: str, word_count: int, message_type: str, audio_length: float) -> int:
+        with self.pool.connection() as conn:
+            return conn.execute(
+                'INSERT INTO Messages (user_id, date, message, word_count, message_type, audio_length) VALUES (%s, %s, %s, %s, %s, %s) RETURNING message_id',
+                (user_id, date.strftime(DATE_FORMAT), message, word_count, message_type, audio_length)
+            ).fetchone()[0]
+
+    def get_message(self, message_id: int) -> Optional[tuple]:
+        with self.pool.connection() as conn:
+            return conn.execute('SELECT * FROM Messages WHERE message_id = %s', (message_id,)).fetchone()
+
+    def get_all_messages(self) -> list:
+        with self.pool.connection() as conn:
+            return conn.execute('SELECT * FROM Messages ORDER BY message_id').fetchall()
+
+    def get_messages_by_user(self, user_id: int) -> list:
+        with self.pool.connection() as conn:
+            return conn.execute('SELECT * FROM Messages WHERE user_id = %s ORDER BY message_id', (user_id,)).fetchall()
+
+    def get_message_stats_by_user(self, user_id: int) -> list:
+        with self.pool.connection() as conn:
+            return conn.execute('SELECT date, word_count, audio_length FROM Messages WHERE user_id = %s ORDER BY message_id', (user_id,)).fetchall()
+
+    def get_last_message_dates(self, user_ids: list) -> dict:
+        with self.pool.connection() as conn:
+            rows = conn.execute(
+                'SELECT DISTINCT ON (user_id) user_id, date FROM Messages WHERE user_id = ANY(%s) ORDER BY user_id, message_id DESC', (list(user_ids),)
+            ).fetchall()
+        return dict(rows)
+
+    def close(self) -> None:
+        self.pool.close()
+
+
+_storages = {}  # config -> Storage, so there is one pool per process
+
+
+def create_storage(config: dict) -> Storage:
+    """Create the storage backend of a config as returned by `utils.get_storage_config`."""
+    if config['backend'] == 'sqlite':
+        return SQLiteStorage(config['path'])
+    if config['backend'] == 'postgres':
+        return PostgresStorage(config['dsn'], config.get('min_size', 1), config.get('max_size', 10))
+    raise ValueError(f"Unknown database backend: {config['backend']}")
+
+
+def get_storage() -> Storage:
+    """Return the storage backend selected in the config."""
+    config = utils.get_storage_config()
+    key = tuple(sorted(config.items()))
+    if key not in _storages:
+        _storages[key] = create_storage(config)
+    return _storages[key]
+
+
+def close_storages() -> None:
+    """Close the pools of all storage backends, e.g. on shutdown."""
+    for storage in _storages.values():
+        storage.close()
+    _storages.clear()
@@ -1,25 +1,32 @@
+import asyncio
+import functools
 from datetime import datetime, timedelta
-from typing import Literal, Optional
+from pathlib import Path
+from typing import Literal, Optional, Tuple
 import logging
 import random
+import time
 
-from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
-from telegram.ext import filters, MessageHandler, ApplicationBuilder, ContextTypes, CommandHandler, ConversationHandler, CallbackQueryHandler
+from telegram import Chat, Update, InlineKeyboardButton, InlineKeyboardMarkup
+from telegram.ext import filters, MessageHandler, Application, ApplicationBuilder, CallbackContext, ContextTypes, CommandHandler, ConversationHandler, CallbackQueryHandler
 
 
 import verbal_diary_bot as vdb
 
-from verbal_diary_bot import utils, notion, transcribe
+from verbal_diary_bot import utils, transcribe, metrics, sharding, shutdown, audio_store, transcript_archive, semantic_search, deregistration
+from verbal_diary_bot.status_message import StatusMessage
 
 logger = logging.getLogger(__name__)
 
 async def audio(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Handle audio messages. These are audio files sent to the chat. This is a wrapper."""
-    await audio_or_voice(update, context, 'audio')
+    with metrics.timer('voice_message', type='audio'), shutdown.jobs.track():
+        await audio_or_voice(update, context, 'audio')
     
 async def voice(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Handle voice messages. These are voice messages sent to the chat. This is wrapper."""
-    await audio_or_voice(update, context, 'voice')
+    with metrics.timer('voice_message', type='voice'), shutdown.jobs.track():
+        await audio_or_voice(update, context, 'voice')
 
 async def audio_or_voice(update: Update, context: ContextTypes.DEFAULT_TYPE, audio_or_voice: Literal['audio', 'voice']):   
     """
@@ -40,18 +47,22 @@ async def audio_or_voice(update: Update, context: ContextTypes.DEFAULT_TYPE, aud
         If audio_or_voice is not 'audio' or 'voice'.
     RuntimeError
         If an error occurs in the transcription process.
-    e
-        If an error occurs in the Notion append process.
     """
+    # a voice message delivered again (after a restart or a polling retry) is not downloaded and transcribed twice
+    if vdb.database_operations.is_message_processed(update.effective_chat.id, update.message.message_id):
+        logger.info(f"Skipping update {update.update_id}, message {update.message.message_id} was processed already.")
+        metrics.increment('duplicate_updates_total')
+        return
+
+    # all replies about this voice message go into one status message, edited as the stages finish
+    status = StatusMessage(context.bot, update.effective_chat.id, started=time.monotonic())
+
     # Create the user object
     user_id = update.effective_user.id
     user_name = update.effective_user.username
-    user = vdb.user.User(user_id, user_name)
-    last_online = user.last_online()
-    
-    # chose which API to use (OpenAI/Hugginface)
-    # transcribe_from_file = transcribe.transcribe_from_file_huggingface 
-    transcribe_from_file = transcribe.transcribe_from_file_openai 
+    with metrics.timer('db_read'):
+        user = vdb.user.User(user_id, user_name)
+        last_online = user.last_online()
 
     # Getting the voice message
     if audio_or_voice == 'audio':
@@ -65,76 +76,141 @@ async def audio_or_voice(update: Update, context: ContextTypes.DEFAULT_TYPE, aud
     file_id = message.file_id
 
     # Downloading the file
-    new_file = await context.bot.get_file(file_id)
+    with metrics.timer('telegram_download'):
+        new_file = await context.bot.get_file(file_id)
     file_path = new_file.file_path
 
-    # Save the audio file locally (Optional)
-    if audio_or_voice == 'audio':
-        print(message.mime_type, "\n\n")
-        save_path = utils.get_voice_save_path() / f"{file_id}.m4a"
-    else:
-        save_path = utils.get_voice_save_path() / f"{file_id}.ogg"
-    # create folder if not exists
-    save_path.parent.mkdir(parents=True, exist_ok=True)
-    print(save_path.exists())
+    # Save the audio file in the audio store, under the hash of its content
+    store = audio_store.get_store()
+    temp_path = store.new_temp_path('.m4a' if audio_or_voice == 'audio' else '.ogg')
+    with metrics.timer('telegram_download'):
+        await new_file.download_to_drive(temp_path)
+        save_path = await asyncio.to_thread(store.add, temp_path)
+
+    # from here on the voice message is a job that is resumed after a restart, if it is interrupted
+    message_date = update.message.date
+    audio_length = message.duration
+    job_id = vdb.database_operations.insert_voice_job(user_id, update.effective_chat.id, file_id, audio_or_voice, str(save_path), audio_length, message_date, update.message.message_id, update.update_id)
+    if job_id is None:
+        # the same message is being processed by another delivery, the audio file is left to the janitor
+        metrics.increment('duplicate_updates_total')
+        return
+    status.set_stage(u"\u2705 Audio message received, transcribing \u2026")
+    try:
+        await process_voice_job(context, job_id, file_id, user, update.effective_chat.id, save_path, audio_length, message_date, status=status)
+
+        # send user stats
+        await user_stats(update, context, last_online, status)
+    finally:
+        # updates are handled one after the other, so the handler does not wait for the (delayed) status
+        # message to be sent, but the application does before it stops
+        context.application.create_task(status.wait())
+    
     
     
-    await new_file.download_to_drive(save_path)
+async def process_voice_job(context: ContextTypes.DEFAULT_TYPE, job_id: int, file_id: str, user, chat_id: int, save_path: Path, audio_length: float, message_date: datetime, transcription: Optional[str] = None, status: Optional[StatusMessage] = None):
+    """
+    Transcribe a downloaded voice message (unless the transcription is given), show it to the user in
+    the `status` message, queue it for Notion and store it in the database. Then the voice job is done.
+    The caller makes sure the status message is sent in the end (`status.wait()`).
+    """
+    if status is None:
+        status = StatusMessage(context.bot, chat_id)
 
-    await context.bot.send_message(chat_id=update.effective_chat.id, text=u"\u2705 Audio message received and downloaded.")
+    # chose which API to use (OpenAI/Hugginface)
+    # transcribe_from_file = transcribe.transcribe_from_file_huggingface 
+    transcribe_from_file = transcribe.transcribe_from_file_openai 
 
     # --- Transcribe the audio file ---
-    transcription = await transcribe_from_file(save_path, context, update.effective_chat.id)
-    
-    # Check for error
-    if 'error' in transcription.keys():
-        await context.bot.send_message(chat_id=update.effective_chat.id, text=f"Error: {transcription}")  
-        raise RuntimeError(f"Error in function {transcribe_from_file}: {transcription}")     
-        
+    if transcription is None:
+        with metrics.timer('transcription'):
+            transcription = await transcribe_from_file(save_path, context, chat_id)
         
+        # Check for error
+        if 'error' in transcription.keys():
+            metrics.increment('stage_errors_total', stage='transcription', error='TranscriptionError')
+            vdb.database_operations.delete_voice_job(job_id)
+            status.set_stage(f"\u274C Error: {transcription}")
+            raise RuntimeError(f"Error in function {transcribe_from_file}: {transcription}")     
+        # the transcription is paid for, keep it in case of a shutdown
+        vdb.database_operations.set_voice_job_transcription(job_id, transcription['text'])
     else:
-        # check for empty string
-        text = transcription['text'] if transcription['text'] != "" else " "
-        # check for too long string
-        if len(text) > 4096:  # telegram message char limit
-            for x in range(0, len(text), 4096):
-                await context.bot.send_message(chat_id=update.effective_chat.id, text=text[x:x+4096])
-        else:
-            await context.bot.send_message(chat_id=update.effective_chat.id, text=text)
+        transcription = {'text': transcription}
+        
+    # check for empty string
+    text = transcription['text'] if transcription['text'] != "" else " "
+    # a transcript too long for the status message is sent as a file
+    with metrics.timer('telegram_reply'):
+        await status.set_transcript(text, message_date)
+    status.set_stage(u"\u23F3 Appending to Notion \u2026")
+
+    # keep the transcription in the archive, written in a thread to not block the event loop
+    shard = context.bot_data.get('shard')
+    archive = transcript_archive.get_archive(0 if shard is None else shard[0])
+    await asyncio.to_thread(archive.append, file_id, user.user_id, message_date, transcription['text'])
 
-    # save transcription to file
-    transcription_save_path = save_path.parent / f"{file_id}.txt"
-    transcription_save_path.write_text(transcription['text'])
-    
     # --- append to Notion page ---
-    try:
-        response = notion.append_transcription(
-            user.get_notion_token(), 
-            user.get_database_id(), 
-            utils.get_notion_page_properties(), 
-            transcription
-        )
-        await context.bot.send_message(chat_id=update.effective_chat.id, text=u"\u2705 Transcription appended to Notion.")
-    except Exception as e:
-        await context.bot.send_message(chat_id=update.effective_chat.id, text=f"Notion Error: {e}")
-        raise e
+    # the writer batches the transcriptions of a user, the confirmation is sent once it is written
+    # it is stored in the outbox first, so it is not lost if Notion is not reachable
+    notion_writer = context.bot_data['notion_writer']
+    with metrics.timer('db_write'):
+        written = notion_writer.submit(user.user_id, user.get_database_id(), transcription)
+    context.application.create_task(confirm_notion_append(written, status))
     
-    
-    # get message date from update
-    message_date = update.message.date
     # add user's message to the database
     word_count = len(text.split())
-    audio_length = message.duration if audio_or_voice == 'audio' else message.duration
-    user.add_message(text, word_count, 'audio', audio_length, message_date)
-    
-    # send user stats
-    await user_stats(update, context, last_online)
-    
+    with metrics.timer('db_write'):
+        message_id = user.add_message(text, word_count, 'audio', audio_length, message_date)
+        vdb.database_operations.delete_voice_job(job_id)
+
+    # make the message searchable with /ask, the OpenAI embedder sends a request
+    try:
+        await asyncio.to_thread(semantic_search.index_message, user.user_id, message_id, transcription['text'])
+    except Exception as e:
+        # the backfill adds it later
+        logger.error(f"Could not add message {message_id} to the search index: {e!r}")
+
+
+async def resume_voice_jobs(application: Application, shard: Optional[Tuple[int, int]] = None):
+    """Finish the voice jobs that were interrupted by the last shutdown (only those of the `shard`, with several workers)."""
+    context = CallbackContext(application)
+    for job_id, user_id, chat_id, file_id, message_type, save_path, audio_length, date, transcription in vdb.database_operations.get_voice_jobs():
+        if not sharding.in_shard(user_id, shard):
+            continue
+        save_path = Path(save_path)
+        with shutdown.jobs.track():
+            if transcription is None and not save_path.exists():
+                logger.error(f"Dropping voice job {job_id}, the audio file {save_path} does not exist anymore.")
+                vdb.database_operations.delete_voice_job(job_id)
+                await context.bot.send_message(chat_id=chat_id, text="Sorry, a voice message you sent before the bot restarted got lost. Please send it again.")
+                continue
+            logger.info(f"Resuming voice job {job_id} of user {user_id}.")
+            status = StatusMessage(context.bot, chat_id)
+            status.set_stage("The bot was restarted, processing your last voice message now.")
+            try:
+                message_date = datetime.strptime(date, '%Y-%m-%d %H:%M:%S %z')
+                await process_voice_job(context, job_id, file_id, vdb.user.User(user_id), chat_id, save_path, audio_length, message_date, transcription, status)
+            except Exception as e:
+                logger.error(f"Resuming voice job {job_id} failed: {e!r}")
+            await status.wait()
+
+
+async def confirm_notion_append(written: asyncio.Future, status: StatusMessage):
+    """Show in the status message whether the transcription was appended to Notion, once the writer has flushed it."""
+    try:
+        await written
+    except Exception as e:
+        logger.error(f"Notion Error: {e!r}")
+        status.set_stage(f"Notion Error: {e}\nThe transcription is kept and will be appended to Notion later. Check /sync_status.")
+    else:
+        status.set_stage(u"\u2705 Transcription appended to Notion.")
+    await status.wait()
     
     
-async def user_stats(update: Update, context: ContextTypes.DEFAULT_TYPE, last_online: Optional[datetime]=None):
+async def user_stats(update: Update, context: ContextTypes.DEFAULT_TYPE, last_online: Optional[datetime]=None, status: Optional[StatusMessage]=None):
     """
         Send user statistics if they have not been provided already within the last 24 h.
+        They are added to the `status` message if it is given and there is room left.
     """
     user_id = update.effective_user.id
     user = vdb.user.User(user_id)
@@ -144,7 +220,9 @@ async def user_stats(update: Update, context: ContextTypes.DEFAULT_TYPE, last_on
     now = datetime.now(last_online.tzinfo)
     elapsed_time = now - last_online
     if elapsed_time > timedelta(hours=12):
-        await context.bot.send_message(chat_id=update.effective_chat.id, text=user.get_user_info())
+        info = user.get_user_info()
+        if status is None or not status.add_note(info):
+            await context.bot.send_message(chat_id=update.effective_chat.id, text=info)
         
 
 def is_user_registered(func):
@@ -163,6 +241,22 @@ def is_user_registered(func):
     return 
 
 
+def is_admin(func):
+    """
+    Only call the handler for admins, i.e. the users in `allowed_chat_ids` of the telegram config,
+    in their private chat with the bot. Everyone else gets a short refusal. Only the user id counts:
+    user names (`allowed_chat_names`) can change hands, and in a group the chat is shared.
+    """
+    @functools.wraps(func)
+    async def wrapper(update: Update, context: ContextTypes.DEFAULT_TYPE):
+        allowed_chat_ids, _ = utils.get_allowed_chat_ids()
+        if update.effective_chat.type == Chat.PRIVATE and update.effective_user.id in allowed_chat_ids:
+            return await func(update, context)
+        logger.warning(f"User {update.effective_user.id} tried to use the admin command {func.__name__}.")
+        await context.bot.send_message(chat_id=update.effective_chat.id, text="Sorry, this command is only available to admins.")
+    return wrapper
+
+
 
 
 
@@ -279,9 +373,9 @@ This means you can also access your diary entries digitally, alter them, add to
 Well, I am a Telegram Bot running on some Google Cloud server, trying to make sense of what you brabble. The latest speech2text recognition AI models help me with that. For this I currently user WhisperAI from OpenAI.
 If you want to know more, just check out more about me here: 
 <a href="https://github.com/joshuawe/telegram-journal-bot">Verbal Diary Assistant - Project Page</a>"""
-    message3 = """Before we start, I would like to let you know about my privacy policy. All your data is used confidentially. No data is shared with third parties. No audio data is stored. You can delete all you user data at any time by using the <ins>/deregister</ins> command.
+    message3 = """Before we start, I would like to let you know about my privacy policy. All your data is used confidentially. No data is shared with third parties. {retention} You can delete all you user data at any time by using the <ins>/deregister</ins> command. Only transcriptions made by older versions of this bot, which were not linked to a user, cannot be deleted this way.
 
-Do you agree to the privacy policy? Answer with 'yes' or 'no'."""
+Do you agree to the privacy policy? Answer with 'yes' or 'no'.""".format(retention=audio_store.describe_retention(utils.get_audio_store_config().get('keep_days', 0)))
     await update.message.reply_text(message1, parse_mode='HTML')
     await update.message.reply_text(message2, parse_mode='HTML', disable_web_page_preview=True)
     await update.message.reply_text(message3, parse_mode='HTML')
@@ -393,10 +487,10 @@ async def final_confirmation(update: Update, context: ContextTypes.DEFAULT_TYPE)
     query = update.callback_query
     await query.answer()
     if query.data == 'final_yes':
-        # Perform deregistration logic here
-        vdb.user.anonymize_user_from_database(update.effective_user.id)
-        print('User deleted!')  # Replace this with actual deregistration code
-        await query.edit_message_text(text=u"\u2705" + " You have been deregistered.")
+        # the user is anonymized in the background, the confirmation does not wait for it
+        await deregistration.request_deregistration(context.application, update.effective_user.id)
+        logger.info(f"User {update.effective_user.id} deregistered.")
+        await query.edit_message_text(text=u"\u2705" + " You have been deregistered. Your data is being removed.")
         return ConversationHandler.END
     else:
         return CANCEL
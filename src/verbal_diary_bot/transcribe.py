@@ -1,4 +1,5 @@
 """This script does transcription of audio files via Huggingface API."""
+import asyncio
 import logging
 import json
 from pathlib import Path
@@ -8,7 +9,7 @@ import requests
 from telegram.ext import ContextTypes
 
 
-from . import utils, openai_api
+from . import utils, openai_api, metrics
 
 logger = logging.getLogger(__name__)
 
@@ -37,6 +38,7 @@ async def transcribe_from_file_huggingface(filepath: Path, context: ContextTypes
         if 'error' in response.keys() and 'estimated_time' in response.keys():
             logger.error(f"Error in transcribe_from_file. The Hugginface Inference API request returned: {response}")
             await context.bot.send_message(chat_id=chat_id, text=f"Error: {response} \n\n**Retrying ({n_try}/{RETRIES})**")
+            metrics.increment('retries_total', service='huggingface', reason='loading')
             # wait for estimated time
             time.sleep(response['estimated_time'] * 0.5)
             n_try += 1
@@ -50,8 +52,9 @@ async def transcribe_from_file_huggingface(filepath: Path, context: ContextTypes
 async def transcribe_from_file_openai(file_path: Path, *args):
     try:
         print("Transcribing with OpenAI API. transcribe_from_file_openai")
-        open_client = openai_api.OpenAiCLient(utils.get_openai_token())
-        transcription = open_client.transcribe(file_path)
+        open_client = openai_api.OpenAiCLient(utils.get_openai_token(), utils.get_openai_base_url())
+        # the OpenAI client is synchronous, run it in a thread so other updates can be handled meanwhile
+        transcription = await asyncio.to_thread(open_client.transcribe, file_path)
         response = {'text': transcription.text}
     except Exception as e:
         print(e)
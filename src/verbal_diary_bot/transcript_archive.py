@@ -0,0 +1,261 @@
+"""
+This script keeps the transcriptions in a compressed, append-only archive instead of one `.txt` file per message.
+
+The archive is a directory of segment files, `segment-<writer>-<number>.log`. A record is appended
+to the current segment of its writer as
+
+    length (4 bytes) | CRC-32 (4 bytes) | zlib compressed JSON {file_id, user_id, date, text}
+
+and a new segment is started once the current one is larger than `segment_size`. Every bot worker
+is its own writer, so several processes never append to the same file. The TranscriptIndex table
+maps a file_id to the segment, offset and length of its record, so `get` reads a single record, and
+`replay` reads the segments sequentially. A record that was only partially written (the bot was
+killed) fails the CRC check and ends the replay of its segment; the writer continues in a new segment.
+
+The transcriptions of a user who deregisters are overwritten in place (`purge_user`) with deleted
+records of the same length, found by the user_id in the TranscriptIndex table. So the offsets of
+the other records stay valid, and the other writers can keep appending meanwhile. Records migrated
+from older versions have no user_id (it was not stored), so they are never purged.
+
+The `.txt` files written by older versions are packed into the archive with
+
+    python -m verbal_diary_bot.transcript_archive migrate /path/to/voice_messages [--delete]
+"""
+import argparse
+import json
+import logging
+import os
+import re
+import struct
+import threading
+import zlib
+from datetime import datetime
+from pathlib import Path
+from typing import Iterator, List, Optional, Tuple
+
+from . import database_operations as db
+from . import utils
+from .storage import DATE_FORMAT
+
+logger = logging.getLogger(__name__)
+
+SEGMENT_SIZE = 64 * 1024 * 1024  # bytes after which a new segment is started
+HEADER = struct.Struct('>II')  # length and CRC-32 of the compressed record
+SEGMENT_PATTERN = re.compile(r'segment-(\w+)-(\d+)\.log')
+
+
+def encode_record(file_id: str, user_id: Optional[int], date: str, text: str) -> bytes:
+    payload = zlib.compress(json.dumps({'file_id': file_id, 'user_id': user_id, 'date': date, 'text': text}).encode())
+    return HEADER.pack(len(payload), zlib.crc32(payload)) + payload
+
+
+def encode_deleted_record(length: int) -> bytes:
+    """A deleted record of `length` bytes (header included), {'deleted': True} padded with zeros, which zlib ignores."""
+    payload = zlib.compress(b'{"deleted": true}')
+    if HEADER.size + len(payload) > length:
+        raise ValueError(f"A record of {length} bytes is too short to be replaced")
+    payload += bytes(length - HEADER.size - len(payload))
+    return HEADER.pack(len(payload), zlib.crc32(payload)) + payload
+
+
+def decode_record(data: bytes) -> dict:
+    """Decode a record (header and payload). Raises ValueError if it is damaged."""
+    if len(data) < HEADER.size:
+        raise ValueError("Truncated record header")
+    length, crc = HEADER.unpack_from(data)
+    payload = data[HEADER.size:HEADER.size + length]
+    if len(payload) != length or zlib.crc32(payload) != crc:
+        raise ValueError("Truncated or damaged record")
+    return json.loads(zlib.decompress(payload))
+
+
+def read_segment(path: Path) -> Iterator[Tuple[int, int, dict]]:
+    """Yield (offset, length, record) of the records of a segment, up to the first damaged one."""
+    with open(path, 'rb', buffering=1024 * 1024) as file:
+        offset = 0
+        while True:
+            header = file.read(HEADER.size)
+            if not header:
+                return
+            data = header + file.read(HEADER.unpack(header)[0] if len(header) == HEADER.size else 0)
+            try:
+                record = decode_record(data)
+            except (ValueError, zlib.error) as e:
+                logger.warning(f"Damaged record in {path.name} at offset {offset}, skipping the rest of the segment: {e}")
+                return
+            yield offset, len(data), record
+            offset += len(data)
+
+
+class TranscriptArchive:
+    """
+    Transcript archive in the directory `path`. Appending is thread-safe, but blocking:
+    run it in a thread from the event loop (`asyncio.to_thread`).
+    """
+
+    def __init__(self, path: Path, writer: str = '0', segment_size: int = SEGMENT_SIZE) -> None:
+        self.path = Path(path)
+        self.writer = str(writer)
+        self.segment_size = segment_size
+        self._lock = threading.Lock()
+        self._file = None
+        self._segment = None
+        db.create_transcript_index_table()
+
+    def segments(self) -> List[Path]:
+        """Return the segment files, of every writer, in the order they were started by their writer."""
+        segments = []
+        for path in self.path.glob('segment-*.log'):
+            match = SEGMENT_PATTERN.fullmatch(path.name)
+            if match is not None:
+                segments.append((match.group(1), int(match.group(2)), path))
+        return [path for _, _, path in sorted(segments)]
+
+    def _open_segment(self) -> None:
+        """Continue the last segment of the writer if it is intact and not full, or start a new one."""
+        self.path.mkdir(parents=True, exist_ok=True)
+        own = [path for path in self.segments() if SEGMENT_PATTERN.fullmatch(path.name).group(1) == self.writer]
+        number = 1
+        if own:
+            last = own[-1]
+            number = int(SEGMENT_PATTERN.fullmatch(last.name).group(2))
+            size = last.stat().st_size
+            intact = sum(length for _, length, _ in read_segment(last)) == size
+            if intact and size < self.segment_size:
+                self._segment, self._file = last, open(last, 'ab')
+                return
+            number += 1
+        self._segment = self.path / f'segment-{self.writer}-{number:06d}.log'
+        self._file = open(self._segment, 'ab')
+
+    def append_many(self, records: List[Tuple[str, Optional[int], str, str]]) -> None:
+        """Append records (file_id, user_id, date, text) and index them. The data is on disk when it returns."""
+        with self._lock:
+            if self._file is None or self._file.tell() >= self.segment_size:
+                if self._file is not None:
+                    self._file.close()
+                self._open_segment()
+            entries = []
+            for file_id, user_id, date, text in records:
+                data = encode_record(file_id, user_id, date, text)
+                entries.append((file_id, self._segment.name, self._file.tell(), len(data), user_id or 0))
+                self._file.write(data)
+            self._file.flush()
+            os.fsync(self._file.fileno())
+            db.insert_transcript_index_entries(entries)
+
+    def append(self, file_id: str, user_id: Optional[int], date: datetime, text: str) -> None:
+        self.append_many([(file_id, user_id, date.strftime(DATE_FORMAT), text)])
+
+    def get(self, file_id: str) -> Optional[dict]:
+        """Return the record of a file ({file_id, user_id, date, text}), or None if it is not archived."""
+        entry = db.get_transcript_index_entry(file_id)
+        if entry is None:
+            return None
+        segment, offset, length = entry
+        with open(self.path / segment, 'rb') as file:
+            file.seek(offset)
+            return decode_record(file.read(length))
+
+    def replay(self) -> Iterator[dict]:
+        """Yield all records, segment by segment, without the deleted ones."""
+        for segment in self.segments():
+            for _, _, record in read_segment(segment):
+                if not record.get('deleted'):
+                    yield record
+
+    def _index_users(self) -> None:
+        """Add the user_id to the index entries of older versions, which did not store it."""
+        entries = db.get_transcript_index_entries_by_user(None)
+        user_ids = []
+        for file_id, segment, offset, length in entries:
+            with open(self.path / segment, 'rb') as file:
+                file.seek(offset)
+                try:
+                    user_id = decode_record(file.read(length)).get('user_id')
+                except ValueError:
+                    user_id = None
+            user_ids.append((user_id or 0, file_id))
+        db.set_transcript_index_users(user_ids)
+
+    def purge_user(self, user_id: int) -> List[str]:
+        """
+        Delete the transcriptions of a user: overwrite their records in place and remove them from the
+        index. It is blocking, run it in a thread. Returns the file_ids of the deleted transcriptions.
+        """
+        self._index_users()
+        entries = db.get_transcript_index_entries_by_user(user_id)
+        by_segment = {}
+        for file_id, segment, offset, length in entries:
+            by_segment.setdefault(segment, []).append((offset, length))
+        for segment, records in by_segment.items():
+            # a separate file object, the writer of the segment keeps appending to its end
+            with open(self.path / segment, 'r+b') as file:
+                for offset, length in records:
+                    file.seek(offset)
+                    file.write(encode_deleted_record(length))
+                file.flush()
+                os.fsync(file.fileno())
+        file_ids = [entry[0] for entry in entries]
+        db.delete_transcript_index_entries(file_ids)
+        return file_ids
+
+    def close(self) -> None:
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+
+
+_archives = {}  # (path, writer) -> TranscriptArchive, so a writer keeps its segment open
+
+
+def get_archive(writer: str = '0') -> TranscriptArchive:
+    """Return the archive in the configured directory, for the given writer (e.g. the bot worker)."""
+    key = (str(utils.get_transcript_archive_path()), str(writer))
+    if key not in _archives:
+        _archives[key] = TranscriptArchive(key[0], key[1])
+    return _archives[key]
+
+
+def close_archives() -> None:
+    for archive in _archives.values():
+        archive.close()
+    _archives.clear()
+
+
+def migrate(directory: Path, archive: TranscriptArchive, delete: bool = False, batch_size: int = 1000) -> int:
+    """
+    Pack the `<file_id>.txt` transcriptions of older versions into the archive. Files that are archived
+    already are skipped, so it can be run again. Returns the number of archived files.
+    """
+    files = sorted(Path(directory).glob('*.txt'))
+    archived = 0
+    for start in range(0, len(files), batch_size):
+        batch = []
+        for path in files[start:start + batch_size]:
+            if db.get_transcript_index_entry(path.stem) is not None:
+                continue
+            # the user is not known anymore, the date is when the file was written
+            date = datetime.fromtimestamp(path.stat().st_mtime).astimezone().strftime(DATE_FORMAT)
+            batch.append((path.stem, None, date, path.read_text()))
+        if batch:
+            archive.append_many(batch)
+            archived += len(batch)
+        if delete:
+            for path in files[start:start + batch_size]:
+                path.unlink()
+    return archived
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    migrate_parser = subparsers.add_parser('migrate', help="Pack the .txt transcriptions of a directory into the archive.")
+    migrate_parser.add_argument('directory', type=Path)
+    migrate_parser.add_argument('--delete', action='store_true', help="Delete the .txt files once they are archived.")
+    args = parser.parse_args()
+    archive = TranscriptArchive(utils.get_transcript_archive_path(), writer='migration')
+    count = migrate(args.directory, archive, args.delete)
+    archive.close()
+    print(f"Archived {count} transcription(s) in {archive.path}.")
@@ -5,6 +5,8 @@ from datetime import datetime
 from zoneinfo import ZoneInfo
 
 from . import database_operations as db
+from . import analytics
+from .storage import parse_date
 
 class User:
     """
@@ -47,7 +49,7 @@ class User:
             if (user_name is not None) or (notion_token is not None) or (notion_database_id is not None):
                 db.update_user(user_id, user_name, notion_token, notion_database_id)
         
-    def add_message(self, message: str, word_count: int, message_type: Literal['audio'], audio_length: float, date: Optional[datetime]=None,) -> None:
+    def add_message(self, message: str, word_count: int, message_type: Literal['audio'], audio_length: float, date: Optional[datetime]=None,) -> int:
         """
         Adds a message to the database.
 
@@ -61,23 +63,27 @@ class User:
             For now only 'audio' is supported.
         audio_length : float
             Lenght of audio in seconds.
+
+        Returns
+        -------
+        int
+            The message_id of the new message.
         """
         if date is None:
             date = datetime.now(ZoneInfo("Europe/Berlin"))
             
-        db.insert_message(self.user_id, date, message, word_count, message_type, audio_length)
-        return True
+        message_id = db.insert_message(self.user_id, date, message, word_count, message_type, audio_length)
+        analytics.invalidate(self.user_id)
+        return message_id
 
 
     def last_online(self) -> datetime:
         """Returns the date and time of the user's last message."""
-        user_messages = db.get_messages_by_user(self.user_id)
-        if len(user_messages) == 0:
+        # only the last message is read, through the index on (user_id, message_id)
+        last_message_date = db.get_last_message_dates([self.user_id]).get(self.user_id)
+        if last_message_date is None:
             return datetime.now(ZoneInfo("Europe/Berlin"))
-        last_message = user_messages[-1]
-        last_message_date = last_message[2]
-        last_message_date = datetime.strptime(last_message_date, '%Y-%m-%d %H:%M:%S %z')
-        return last_message_date
+        return parse_date(last_message_date)
     
     def first_online(self) -> datetime:
         """Returns the date and time of the user's first message."""
@@ -147,19 +153,20 @@ class User:
     
 def anonymize_user_from_database(user_id: str) -> str:
     """
-    Delete a user from the database.
+    Anonymize a user in the database and delete their other data, right away. The bot queues
+    deregistered users instead, see `deregistration`.
     
     Returns:
     --------
     str
-        User info and history.
+        Whether the user was anonymized.
     """
     # First check if user is even in the database
     if not db.user_exists(user_id):
         return "User does not exist in the database."
     
-    user = User(user_id)
-    user_history = user.get_user_info()
-    db.anonymize_user(user_id)
+    # it pulls in telegram and the search index, which most users of this module do not need
+    from . import deregistration
+    deregistration.anonymize_users([user_id])
     
-    return user_history
+    return "User anonymized."
@@ -23,6 +23,34 @@ def get_allowed_chat_ids():
     return user_ids, user_names
 
 
+def get_telegram_base_url():
+    """Return the Telegram Bot API URL from the config (e.g. a local Bot API server), or None for the official one."""
+    with open(TOKEN_PATH) as token_file:
+        base_url = json.load(token_file)['telegram'].get('base_url')
+    return base_url
+
+
+def get_telegram_base_file_url():
+    """Return the Telegram file download URL from the config, or None for the official one."""
+    with open(TOKEN_PATH) as token_file:
+        base_file_url = json.load(token_file)['telegram'].get('base_file_url')
+    return base_file_url
+
+
+def get_webhook_config():
+    """Return the webhook config of the bot, or None if it uses polling."""
+    with open(TOKEN_PATH) as token_file:
+        webhook_config = json.load(token_file)['telegram'].get('webhook')
+    return webhook_config
+
+
+def get_worker_count():
+    """Return the number of bot worker processes (1 if not configured)."""
+    with open(TOKEN_PATH) as token_file:
+        workers = json.load(token_file)['telegram'].get('workers', 1)
+    return workers
+
+
 def get_voice_save_path():
     with open(TOKEN_PATH) as token_file:
         voice_save_path = json.load(token_file)['save_paths']['voice_messages']
@@ -65,7 +93,77 @@ def get_openai_token():
     return token
 
 
+def get_openai_base_url():
+    """Return the OpenAI API base URL from the config, or None for the official API."""
+    with open(TOKEN_PATH) as token_file:
+        base_url = json.load(token_file)['openai'].get('base_url')
+    return base_url
+
+
 def get_db_path():
     with open(TOKEN_PATH) as token_file:
         db_path = json.load(token_file)['save_paths']['db_path']
-    return db_path
\ No newline at end of file
+    return db_path
+
+def get_storage_config():
+    """
+    Return the storage backend config: `{'backend': 'sqlite', 'path': ...}` by default, or with
+    `"backend": "postgres"` in the database config, the keys backend, dsn, min_size and max_size.
+    """
+    with open(TOKEN_PATH) as token_file:
+        config = json.load(token_file)
+    backend = config.get('database', {}).get('backend', 'sqlite')
+    if backend == 'sqlite':
+        return {'backend': backend, 'path': config['save_paths']['db_path']}
+    return {'backend': backend, **config['database'].get(backend, {})}
+
+def get_transcript_archive_path():
+    """Return the directory of the transcript archive, by default `transcripts` next to the database."""
+    with open(TOKEN_PATH) as token_file:
+        save_paths = json.load(token_file)['save_paths']
+    return Path(save_paths.get('transcripts', Path(save_paths['db_path']).parent / 'transcripts'))
+
+def get_semantic_search_config():
+    """
+    Return the semantic search config (keys: embedder, dimension, model, chat_model, path), with the
+    vector index in `vectors` next to the database by default.
+    """
+    with open(TOKEN_PATH) as token_file:
+        config = json.load(token_file)
+    search_config = dict(config.get('semantic_search', {}))
+    search_config.setdefault('path', str(Path(config['save_paths']['db_path']).parent / 'vectors'))
+    return search_config
+
+def get_notion_base_url():
+    """Return the Notion API base URL. Can be overwritten in the config, e.g. for testing."""
+    with open(TOKEN_PATH) as token_file:
+        base_url = json.load(token_file)['notion'].get('base_url', 'https://api.notion.com')
+    return base_url
+
+
+def get_metrics_config():
+    """Return the metrics endpoint config (keys: host, port), or None if metrics are not configured."""
+    with open(TOKEN_PATH) as token_file:
+        metrics_config = json.load(token_file).get('metrics')
+    return metrics_config
+
+
+def get_watchdog_config():
+    """Return the event loop watchdog config (keys: threshold, interval), or None if it is disabled."""
+    with open(TOKEN_PATH) as token_file:
+        watchdog_config = json.load(token_file).get('watchdog')
+    return watchdog_config
+
+
+def get_audio_store_config():
+    """Return the audio store config (keys: keep_days, max_bytes, interval), empty for the defaults."""
+    with open(TOKEN_PATH) as token_file:
+        audio_store_config = json.load(token_file).get('audio_store', {})
+    return audio_store_config
+
+
+def get_shutdown_deadline():
+    """Return the seconds a shutdown waits for in-flight voice messages before they are checkpointed."""
+    with open(TOKEN_PATH) as token_file:
+        deadline = json.load(token_file).get('shutdown', {}).get('deadline', 20)
+    return deadline
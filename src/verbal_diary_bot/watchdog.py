@@ -0,0 +1,123 @@
+"""
+This script detects stalls of the asyncio event loop.
+
+A heartbeat task on the loop wakes up every `interval` seconds and records how late it was
+(the event loop lag). A monitor thread checks the heartbeat: if the loop did not get to it for
+longer than `threshold` seconds, a callback is blocking the loop (e.g. `time.sleep`, a synchronous
+HTTP request or SQLite call). The monitor then captures the stack of the loop thread and logs it
+together with the handler it belongs to, i.e. the outermost frame of our own code.
+
+Enabled with `"watchdog": {"threshold": 0.25, "interval": 0.05}` in `configs.json`.
+"""
+import asyncio
+import logging
+import sys
+import sysconfig
+import threading
+import time
+import traceback
+from collections import deque
+from pathlib import Path
+
+from . import metrics
+
+logger = logging.getLogger(__name__)
+
+THRESHOLD = 0.25  # seconds the loop may be blocked before it is reported
+INTERVAL = 0.05  # seconds between two heartbeats
+
+PACKAGE_PATH = str(Path(__file__).resolve().parent)
+LIBRARY_PATHS = tuple({str(Path(sysconfig.get_paths()[key]).resolve()) for key in ('stdlib', 'platstdlib', 'purelib', 'platlib')})
+
+
+def is_own_code(filename: str) -> bool:
+    """Whether a frame belongs to the bot (or the code using it) rather than to Python or a library."""
+    filename = str(Path(filename).resolve())
+    if filename.startswith(PACKAGE_PATH):
+        return True
+    return not filename.startswith(LIBRARY_PATHS) and not filename.startswith('<')
+
+
+def get_handler_name(frames: list) -> str:
+    """
+    Return the name of the outermost function of our own code that runs in the current callback of
+    the event loop. `frames` is the stack of the loop thread, outermost frame first.
+    """
+    # skip whatever started the event loop, the callback is run by asyncio's Handle._run
+    start = 0
+    for i, frame in enumerate(frames):
+        if frame.name == '_run' and Path(frame.filename).parts[-2:] == ('asyncio', 'events.py'):
+            start = i + 1
+    for frame in frames[start:]:
+        if is_own_code(frame.filename):
+            return frame.name
+    return 'unknown'
+
+
+class LoopWatchdog:
+    """
+    Event loop stall detector. Call `start` once the event loop is running and `close` on shutdown.
+
+    The last stalls are kept in `stalls` as dicts with the keys duration, handler and stack.
+    """
+
+    def __init__(self, threshold: float = THRESHOLD, interval: float = INTERVAL) -> None:
+        self.threshold = threshold
+        self.interval = interval
+        self.stalls = deque(maxlen=100)
+        self._last_beat = None
+        self._loop_thread_id = None
+        self._task = None
+        self._thread = None
+        self._stopped = threading.Event()
+        self._reported_beat = None
+
+    def start(self) -> None:
+        self._loop_thread_id = threading.get_ident()
+        self._last_beat = time.monotonic()
+        self._stopped.clear()
+        self._task = asyncio.create_task(self._heartbeat())
+        self._thread = threading.Thread(target=self._monitor, name='loop-watchdog', daemon=True)
+        self._thread.start()
+
+    async def _heartbeat(self) -> None:
+        while True:
+            expected = time.monotonic() + self.interval
+            await asyncio.sleep(self.interval)
+            now = time.monotonic()
+            metrics.observe('event_loop_lag_seconds', max(0.0, now - expected))
+            self._last_beat = now
+
+    def _monitor(self) -> None:
+        while not self._stopped.wait(self.interval / 2):
+            last_beat = self._last_beat
+            blocked = time.monotonic() - last_beat - self.interval
+            if blocked > self.threshold and self._reported_beat != last_beat:
+                # report every stall once, while it is happening, so the stack shows the culprit
+                self._reported_beat = last_beat
+                self._report(blocked)
+
+    def _report(self, blocked: float) -> None:
+        frame = sys._current_frames().get(self._loop_thread_id)
+        if frame is None:
+            return
+        frames = traceback.extract_stack(frame)
+        handler = get_handler_name(frames)
+        stack = ''.join(traceback.format_list(frames))
+        self.stalls.append({'duration': blocked, 'handler': handler, 'stack': stack})
+        metrics.increment('event_loop_stalls_total', handler=handler)
+        logger.warning(f"Event loop blocked for more than {blocked:.2f}s in {handler}, at {frames[-1].filename}:{frames[-1].lineno} ({frames[-1].name}):\n{stack}")
+
+    async def close(self) -> None:
+        self._stopped.set()
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+
+metrics.describe('event_loop_lag_seconds', 'histogram', 'Delay of the event loop heartbeat.')
+metrics.describe('event_loop_stalls_total', 'counter', 'Number of times a callback blocked the event loop for longer than the threshold.')
@@ -0,0 +1,210 @@
+"""
+This script runs the bot with a webhook instead of polling `getUpdates`.
+
+Telegram POSTs every update to an embedded asyncio HTTP server, which checks the
+`X-Telegram-Bot-Api-Secret-Token` header, answers right away and puts the update into the
+application's update queue. The secret token is required: without it, anyone who finds the URL
+could send updates in the name of any user. A connection that sends nothing for `read_timeout`
+seconds is closed. Updates are then handled concurrently by `PerChatUpdateProcessor`:
+at most `max_concurrent_updates` at a time, and the updates of one chat strictly one after the other
+(so e.g. the registration conversation and the order of the transcriptions are not mixed up).
+
+Enabled with a `webhook` section in the telegram config:
+
+    "webhook": {"url": "https://example.com/telegram", "listen": "0.0.0.0", "port": 8443,
+                "path": "/telegram", "secret_token": "...", "max_concurrent_updates": 8, "read_timeout": 30}
+"""
+import asyncio
+import hmac
+import json
+import logging
+import signal
+from typing import Awaitable, Callable, Optional
+
+from telegram import Bot, Update
+from telegram.ext import Application, BaseUpdateProcessor
+
+logger = logging.getLogger(__name__)
+
+MAX_CONCURRENT_UPDATES = 8
+MAX_BODY_SIZE = 1_000_000  # bytes, updates are a few kB
+SECRET_HEADER = 'x-telegram-bot-api-secret-token'
+READ_TIMEOUT = 30  # seconds a connection may stay silent (also between keep-alive requests)
+
+
+class PerChatUpdateProcessor(BaseUpdateProcessor):
+    """Handles up to `max_concurrent_updates` updates at a time, but those of the same chat in order."""
+
+    def __init__(self, max_concurrent_updates: int = MAX_CONCURRENT_UPDATES) -> None:
+        super().__init__(max_concurrent_updates)
+        self._chat_locks = {}  # chat_id -> [asyncio.Lock, number of updates using it]
+
+    async def process_update(self, update, coroutine) -> None:
+        # the chat lock is taken before one of the `max_concurrent_updates` slots, so the updates
+        # waiting behind the same chat do not hold slots that the other chats could use
+        chat = update.effective_chat if isinstance(update, Update) else None
+        if chat is None:
+            await super().process_update(update, coroutine)
+            return
+        entry = self._chat_locks.setdefault(chat.id, [asyncio.Lock(), 0])
+        entry[1] += 1
+        try:
+            async with entry[0]:
+                await super().process_update(update, coroutine)
+        finally:
+            entry[1] -= 1
+            if entry[1] == 0:
+                del self._chat_locks[chat.id]
+
+    async def do_process_update(self, update, coroutine) -> None:
+        await coroutine
+
+    async def initialize(self) -> None:
+        pass
+
+    async def shutdown(self) -> None:
+        pass
+
+
+class WebhookServer:
+    """Minimal HTTP/1.1 server that passes the POSTed updates (as dicts) to `handle_update`."""
+
+    def __init__(self, handle_update: Callable[[dict], Awaitable], listen: str, port: int, path: str, secret_token: str, read_timeout: float = READ_TIMEOUT) -> None:
+        if not secret_token:
+            raise ValueError("The webhook needs a secret_token.")
+        self.handle_update = handle_update
+        self.listen = listen
+        self.port = port
+        self.path = path
+        self.secret_token = secret_token
+        self.read_timeout = read_timeout
+        self._server = None
+
+    @classmethod
+    def from_config(cls, handle_update: Callable[[dict], Awaitable], config: dict) -> 'WebhookServer':
+        """Create the server from the webhook config. Raises a ValueError if it has no `secret_token`."""
+        return cls(handle_update, config.get('listen', '127.0.0.1'), config.get('port', 8443), config.get('path', '/telegram'),
+                   config.get('secret_token'), config.get('read_timeout', READ_TIMEOUT))
+
+    async def start(self) -> None:
+        self._server = await asyncio.start_server(self._handle_connection, self.listen, self.port)
+        self.port = self._server.sockets[0].getsockname()[1]
+        logger.info(f"Listening for webhook updates on {self.listen}:{self.port}{self.path}")
+
+    async def stop(self) -> None:
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
+            self._server = None
+
+    async def _read(self, read: Awaitable) -> bytes:
+        return await asyncio.wait_for(read, self.read_timeout)
+
+    async def _handle_connection(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        try:
+            # keep-alive: Telegram sends several updates over one connection
+            while True:
+                request_line = await self._read(reader.readline())
+                if not request_line:
+                    break
+                method, path, _ = request_line.decode('latin-1').split(' ', 2)
+                headers = {}
+                while True:
+                    line = await self._read(reader.readline())
+                    if line in (b'\r\n', b'\n', b''):
+                        break
+                    name, _, value = line.decode('latin-1').partition(':')
+                    headers[name.strip().lower()] = value.strip()
+                length = int(headers.get('content-length', 0))
+                if length > MAX_BODY_SIZE:
+                    await self._respond(writer, 413, close=True)
+                    break
+                body = await self._read(reader.readexactly(length))
+                status = await self._handle_request(method, path, headers, body)
+                close = headers.get('connection', '').lower() == 'close'
+                await self._respond(writer, status, close=close)
+                if close:
+                    break
+        except (ValueError, asyncio.IncompleteReadError, ConnectionError, asyncio.TimeoutError) as e:
+            logger.debug(f"Webhook connection closed: {e!r}")
+        finally:
+            writer.close()
+
+    async def _handle_request(self, method: str, path: str, headers: dict, body: bytes) -> int:
+        if path.split('?')[0] != self.path:
+            return 404
+        if method != 'POST':
+            return 405
+        if not hmac.compare_digest(headers.get(SECRET_HEADER, ''), self.secret_token):
+            logger.warning("Received a webhook request with a wrong secret token.")
+            return 403
+        try:
+            update = json.loads(body)
+            if not isinstance(update, dict):
+                raise TypeError(f"the update is a {type(update).__name__}, not an object")
+            # answer right away, the update is only queued
+            await self.handle_update(update)
+        except (ValueError, TypeError, KeyError, AttributeError) as e:
+            logger.error(f"Received an invalid update: {e!r}")
+            return 400
+        return 200
+
+    @staticmethod
+    async def _respond(writer: asyncio.StreamWriter, status: int, close: bool = False) -> None:
+        reasons = {200: 'OK', 400: 'Bad Request', 403: 'Forbidden', 404: 'Not Found', 405: 'Method Not Allowed', 413: 'Payload Too Large'}
+        connection = 'close' if close else 'keep-alive'
+        writer.write(f"HTTP/1.1 {status} {reasons[status]}\r\nContent-Length: 0\r\nConnection: {connection}\r\n\r\n".encode())
+        await writer.drain()
+
+
+async def set_webhook(bot: Bot, config: dict) -> None:
+    """Register the webhook with Telegram, if the config has a `url`."""
+    if config.get('url') is not None:
+        await bot.set_webhook(config['url'], secret_token=config['secret_token'], allowed_updates=Update.ALL_TYPES, max_connections=config.get('max_concurrent_updates', MAX_CONCURRENT_UPDATES))
+
+
+def start_signal_handlers(stop: asyncio.Event) -> None:
+    """Set `stop` on SIGINT and SIGTERM."""
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop.set)
+
+
+async def serve_webhook(application: Application, config: dict, stop: Optional[asyncio.Event] = None) -> None:
+    """
+    Run the application with a webhook until `stop` is set (or SIGINT/SIGTERM are received).
+
+    Parameters
+    ----------
+    application : Application
+        The bot application, e.g. built with `concurrent_updates=PerChatUpdateProcessor(...)`.
+    config : dict
+        The webhook config (keys: url, listen, port, path, secret_token, read_timeout). The secret_token
+        is required. Without `url`, the webhook is not registered with Telegram (e.g. behind a proxy
+        that registered it already, or in tests).
+    stop : Optional[asyncio.Event], optional
+        Event to stop the bot, by default a new event that is set by SIGINT and SIGTERM.
+    """
+    async def put_update(data: dict) -> None:
+        await application.update_queue.put(Update.de_json(data, application.bot))
+
+    # refuse to start without a secret token, before anything else happens
+    server = WebhookServer.from_config(put_update, config)
+    if stop is None:
+        stop = asyncio.Event()
+        start_signal_handlers(stop)
+    await application.initialize()
+    if application.post_init is not None:
+        await application.post_init(application)
+    try:
+        await set_webhook(application.bot, config)
+        await server.start()
+        await application.start()
+        await stop.wait()
+    finally:
+        await server.stop()
+        if application.running:
+            await application.stop()
+        if application.post_shutdown is not None:
+            await application.post_shutdown(application)
+        await application.shutdown()
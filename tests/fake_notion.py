@@ -0,0 +1,283 @@
+"""
+A fake Notion API server for tests. It keeps databases, pages and blocks in memory, implements the
+endpoints used by the bot and enforces a rate limit per integration token like the real API does.
+"""
+import json
+import random
+import re
+import threading
+import time
+import uuid
+from collections import defaultdict
+from datetime import datetime, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+NOTION_MAX_CHILDREN = 100
+NOTION_MAX_TEXT = 2000
+NOTION_MAX_RICH_TEXT = 100
+NOTION_MAX_PAYLOAD = 500 * 1000
+
+
+def now_iso() -> str:
+    return datetime.now(timezone.utc).isoformat(timespec='milliseconds').replace('+00:00', 'Z')
+
+
+class FakeNotionServer:
+    """
+    In-memory Notion API.
+
+    Parameters
+    ----------
+    rate_limit : float, optional
+        Average number of requests per second allowed per token, by default None (unlimited).
+    burst : float, optional
+        Number of requests allowed at once, by default `rate_limit`.
+    retry_after : float, optional
+        Value of the `Retry-After` header of rate limited responses, by default 1.
+    latency : float, optional
+        Seconds each request takes, by default 0.
+    error_rate : float, optional
+        Fraction of requests answered with a 503 error, by default 0.
+    """
+
+    def __init__(self, rate_limit=None, burst=None, retry_after=1.0, latency=0.0, error_rate=0.0):
+        self.rate_limit = rate_limit
+        self.burst = burst or rate_limit
+        self.retry_after = retry_after
+        self.latency = latency
+        self.error_rate = error_rate
+        self.lock = threading.Lock()
+        self.pages = {}
+        self.children = defaultdict(list)
+        self.requests = []  # (method, path, status)
+        self.rate_limited = 0
+        self._buckets = {}  # token -> (tokens, last update)
+        self._server = ThreadingHTTPServer(('127.0.0.1', 0), self._make_handler())
+        self._server.daemon_threads = True
+        self._thread = None
+
+    @property
+    def base_url(self) -> str:
+        host, port = self._server.server_address
+        return f"http://{host}:{port}"
+
+    def start(self):
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    # ---- helpers for tests -------------------------------------------------
+
+    def add_page(self, database_id: str, title: str, text: str = '', last_edited_time: str = None) -> str:
+        """Insert a page (and optionally a paragraph) into a database and return its id."""
+        with self.lock:
+            page_id = self._add_page(database_id, title)
+            if last_edited_time is not None:
+                self.pages[page_id]['last_edited_time'] = last_edited_time
+            if text:
+                self.children[page_id].append(paragraph(text))
+        return page_id
+
+    def edit_page(self, page_id: str, text: str) -> None:
+        """Append a paragraph to a page, like a user editing it in Notion."""
+        with self.lock:
+            self.children[page_id].append(paragraph(text))
+            self.pages[page_id]['last_edited_time'] = now_iso()
+
+    def pages_in(self, database_id: str, archived=False) -> list:
+        return [p for p in self.pages.values() if p['parent']['database_id'] == database_id and p['archived'] == archived]
+
+    def count(self, method: str = None, path_pattern: str = None) -> int:
+        """Count the successful requests matching the given method and path regex."""
+        return sum(1 for m, p, s in self.requests if s < 300 and (method is None or m == method)
+                   and (path_pattern is None or re.fullmatch(path_pattern, p)))
+
+    # ---- request handling --------------------------------------------------
+
+    def _check_rate_limit(self, token: str) -> bool:
+        if self.rate_limit is None:
+            return True
+        now = time.monotonic()
+        tokens, updated = self._buckets.get(token, (self.burst, now))
+        tokens = min(self.burst, tokens + (now - updated) * self.rate_limit)
+        allowed = tokens >= 1
+        self._buckets[token] = (tokens - 1 if allowed else tokens, now)
+        return allowed
+
+    def _handle(self, method, path, token, body):
+        if self.latency:
+            time.sleep(self.latency)
+        with self.lock:
+            if not self._check_rate_limit(token):
+                self.rate_limited += 1
+                return 429, error(429, 'rate_limited', 'You have been rate limited.'), {'Retry-After': str(self.retry_after)}
+            if self.error_rate and random.random() < self.error_rate:
+                return 503, error(503, 'service_unavailable', 'Notion is unavailable.'), {}
+            return self._route(method, path, body) + ({},)
+
+    def _route(self, method, path, body):
+        match = re.fullmatch(r'/v1/databases/([^/]+)/query', path)
+        if match and method == 'POST':
+            return self._query(match.group(1), body)
+        if path == '/v1/pages' and method == 'POST':
+            return self._create_page(body)
+        match = re.fullmatch(r'/v1/pages/([^/]+)', path)
+        if match and method == 'PATCH':
+            return self._update_page(match.group(1), body)
+        match = re.fullmatch(r'/v1/blocks/([^/]+)/children', path.split('?')[0])
+        if match and method == 'PATCH':
+            return self._append(match.group(1), body)
+        if match and method == 'GET':
+            return self._list_children(match.group(1), path)
+        return 400, error(400, 'invalid_request_url', f'Invalid request URL {method} {path}.')
+
+    def _query(self, database_id, body):
+        pages = [p for p in self.pages_in(database_id) if matches(p, body.get('filter'))]
+        pages.sort(key=lambda p: p['last_edited_time'])
+        start = int(body.get('start_cursor') or 0)
+        size = min(int(body.get('page_size', 100)), 100)
+        chunk = pages[start:start + size]
+        has_more = start + size < len(pages)
+        return 200, {'object': 'list', 'results': chunk, 'has_more': has_more, 'next_cursor': str(start + size) if has_more else None}
+
+    def _create_page(self, body):
+        database_id = body['parent']['database_id']
+        title = body['properties']['Title']['title'][0]['text']['content']
+        page_id = self._add_page(database_id, title)
+        if body.get('children'):
+            self.children[page_id].extend(body['children'])
+        return 200, self.pages[page_id]
+
+    def _add_page(self, database_id, title):
+        page_id = str(uuid.uuid4())
+        timestamp = now_iso()
+        self.pages[page_id] = {
+            'object': 'page', 'id': page_id, 'created_time': timestamp, 'last_edited_time': timestamp, 'archived': False,
+            'parent': {'type': 'database_id', 'database_id': database_id},
+            'properties': {'Title': {'id': 'title', 'type': 'title', 'title': [{'type': 'text', 'text': {'content': title}, 'plain_text': title}]}},
+        }
+        return page_id
+
+    def _update_page(self, page_id, body):
+        page = self.pages.get(page_id)
+        if page is None:
+            return 404, error(404, 'object_not_found', f'Could not find page with ID: {page_id}.')
+        if 'archived' in body:
+            page['archived'] = body['archived']
+        page['last_edited_time'] = now_iso()
+        return 200, page
+
+    def _append(self, page_id, body):
+        page = self.pages.get(page_id)
+        if page is None:
+            return 404, error(404, 'object_not_found', f'Could not find block with ID: {page_id}.')
+        if page['archived']:
+            return 400, error(400, 'validation_error', "Can't edit block that is archived. You must unarchive the block before editing.")
+        children = body.get('children', [])
+        if len(children) > NOTION_MAX_CHILDREN:
+            return 400, error(400, 'validation_error', f'body failed validation: body.children.length should be ≤ `{NOTION_MAX_CHILDREN}`, instead was `{len(children)}`.')
+        if len(json.dumps(body).encode()) > NOTION_MAX_PAYLOAD:
+            return 413, error(413, 'payload_too_large', 'Request body too large.')
+        for block in children:
+            rich_text = block[block['type']]['rich_text']
+            if len(rich_text) > NOTION_MAX_RICH_TEXT:
+                return 400, error(400, 'validation_error', f'body failed validation: rich_text.length should be ≤ `{NOTION_MAX_RICH_TEXT}`.')
+            for item in rich_text:
+                if len(item['text']['content']) > NOTION_MAX_TEXT:
+                    return 400, error(400, 'validation_error', f'body failed validation: text.content.length should be ≤ `{NOTION_MAX_TEXT}`.')
+        self.children[page_id].extend(children)
+        page['last_edited_time'] = now_iso()
+        return 200, {'object': 'list', 'results': children, 'has_more': False, 'next_cursor': None}
+
+    def _list_children(self, page_id, path):
+        query = dict(part.split('=', 1) for part in path.split('?', 1)[1].split('&')) if '?' in path else {}
+        blocks = self.children.get(page_id, [])
+        start = int(query.get('start_cursor', 0))
+        size = min(int(query.get('page_size', 100)), 100)
+        has_more = start + size < len(blocks)
+        return 200, {'object': 'list', 'results': blocks[start:start + size], 'has_more': has_more, 'next_cursor': str(start + size) if has_more else None}
+
+    def _make_handler(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def _dispatch(self, method):
+                length = int(self.headers.get('Content-Length') or 0)
+                body = json.loads(self.rfile.read(length)) if length else {}
+                token = self.headers.get('Authorization', '')
+                status, payload, headers = server._handle(method, self.path, token, body)
+                with server.lock:
+                    server.requests.append((method, self.path.split('?')[0], status))
+                data = json.dumps(payload).encode()
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(data)))
+                for key, value in headers.items():
+                    self.send_header(key, value)
+                self.end_headers()
+                self.wfile.write(data)
+
+            def do_GET(self):
+                self._dispatch('GET')
+
+            def do_POST(self):
+                self._dispatch('POST')
+
+            def do_PATCH(self):
+                self._dispatch('PATCH')
+
+            def log_message(self, *args):
+                pass
+
+        return Handler
+
+
+def paragraph(text: str) -> dict:
+    return {'object': 'block', 'type': 'paragraph', 'paragraph': {'rich_text': [{'type': 'text', 'text': {'content': text}, 'plain_text': text}]}}
+
+
+def error(status: int, code: str, message: str) -> dict:
+    return {'object': 'error', 'status': status, 'code': code, 'message': message}
+
+
+def matches(page: dict, filter: dict) -> bool:
+    """Evaluate the subset of Notion's filter objects used by the bot."""
+    if not filter:
+        return True
+    if 'and' in filter:
+        return all(matches(page, f) for f in filter['and'])
+    if 'or' in filter:
+        return any(matches(page, f) for f in filter['or'])
+    if filter.get('timestamp') in ('last_edited_time', 'created_time'):
+        key = filter['timestamp']
+        condition = filter[key]
+        value = page[key]
+        if 'on_or_after' in condition:
+            return parse(value) >= parse(condition['on_or_after'])
+        if 'after' in condition:
+            return parse(value) > parse(condition['after'])
+        if 'before' in condition:
+            return parse(value) < parse(condition['before'])
+        return True
+    if 'title' in filter:
+        title = ''.join(t['text']['content'] for t in page['properties'][filter['property']]['title'])
+        condition = filter['title']
+        if 'equals' in condition:
+            return title == condition['equals']
+        if 'contains' in condition:
+            return condition['contains'] in title
+    return True
+
+
+def parse(timestamp: str) -> datetime:
+    return datetime.fromisoformat(timestamp.replace('Z', '+00:00'))
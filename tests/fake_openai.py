@@ -0,0 +1,59 @@
+"""
+A stub of the OpenAI transcription, chat and embeddings endpoints for tests and benchmarks.
+
+The transcription of an uploaded file is `Transcription of <file name>`, with the name of the file
+the bot downloaded from the fake Telegram server, so the reply of the bot can be matched to the
+voice message. A chat completion answers with the last user message (so a test can check the prompt),
+and the embedding of a text counts its words hashed into the requested number of dimensions.
+"""
+import json
+import re
+import zlib
+
+from fake_telegram import FakeHandler, FakeServer
+
+
+class _OpenAIHandler(FakeHandler):
+    def do_POST(self):
+        body = self.read_body()
+        if self.path.endswith('/chat/completions'):
+            self.server.owner.count('chat_completions')
+            request = json.loads(body)
+            content = f"Answer to: {request['messages'][-1]['content']}"
+            self.send_json(200, {
+                'id': 'chatcmpl-test', 'object': 'chat.completion', 'created': 0, 'model': request['model'],
+                'choices': [{'index': 0, 'finish_reason': 'stop', 'message': {'role': 'assistant', 'content': content}}],
+            })
+            return
+        if self.path.endswith('/embeddings'):
+            self.server.owner.count('embeddings')
+            request = json.loads(body)
+            texts = [request['input']] if isinstance(request['input'], str) else request['input']
+            dimensions = request.get('dimensions', 8)
+            data = []
+            for i, text in enumerate(texts):
+                vector = [0.0] * dimensions
+                for word in re.findall(r"\w+", text.lower()):
+                    vector[zlib.crc32(word.encode()) % dimensions] += 1.0
+                data.append({'object': 'embedding', 'index': i, 'embedding': vector})
+            self.send_json(200, {'object': 'list', 'data': data, 'model': request['model'], 'usage': {'prompt_tokens': 0, 'total_tokens': 0}})
+            return
+        if not self.path.endswith('/audio/transcriptions'):
+            self.send_json(404, {'error': {'message': 'Not Found'}})
+            return
+        self.server.owner.count('transcriptions')
+        if not self.simulate():
+            self.send_json(500, {'error': {'message': 'The server had an error while processing your request.', 'type': 'server_error'}})
+            return
+        # the transcription names the downloaded file (the fake Telegram server appends its name to
+        # the content), so the driver can match the reply
+        names = re.findall(rb'\nfile=([^\r\n]+)', body)
+        file_name = names[-1].decode() if names else 'unknown'
+        self.send_json(200, {'text': f'Transcription of {file_name}'})
+
+
+class FakeOpenAIServer(FakeServer):
+    """Stub of the OpenAI transcription, chat and embeddings endpoints."""
+
+    def __init__(self, latency: float = 0.0, error_rate: float = 0.0) -> None:
+        super().__init__(_OpenAIHandler, latency, error_rate)
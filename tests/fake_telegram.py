@@ -0,0 +1,289 @@
+"""
+A fake Telegram Bot API server for tests and benchmarks.
+
+It serves `getMe`, `getUpdates` (long polling), `getFile`, file downloads, `sendMessage`,
+`editMessageText` and `sendDocument`, and answers every other method with `True`. Updates are
+injected with `add_update` (or `send_voice`, `send_text`), the messages sent by the bot are collected
+per chat in `replies` (an edited message is replaced in place), the files in `documents`.
+
+For unit tests that do not need a server, `FakeBot` stands in for `telegram.Bot`.
+"""
+import email
+import email.policy
+import json
+import random
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from types import SimpleNamespace
+from urllib.parse import parse_qs
+
+from telegram.error import BadRequest, Forbidden
+
+
+class FakeServer:
+    """A ThreadingHTTPServer on a free local port, with a latency and an error rate."""
+
+    def __init__(self, handler_class, latency: float = 0.0, error_rate: float = 0.0) -> None:
+        self.latency = latency
+        self.error_rate = error_rate
+        self.calls = {}
+        self._calls_lock = threading.Lock()
+        self.httpd = ThreadingHTTPServer(('127.0.0.1', 0), handler_class)
+        self.httpd.daemon_threads = True
+        self.httpd.owner = self
+        self.base_url = f'http://127.0.0.1:{self.httpd.server_address[1]}'
+
+    def count(self, name: str) -> None:
+        with self._calls_lock:
+            self.calls[name] = self.calls.get(name, 0) + 1
+
+    def start(self):
+        threading.Thread(target=self.httpd.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self) -> None:
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+
+class FakeHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def send_json(self, status: int, data) -> None:
+        body = json.dumps(data).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def read_body(self) -> bytes:
+        return self.rfile.read(int(self.headers.get('Content-Length', 0)))
+
+    def simulate(self) -> bool:
+        """Sleep for the latency of the server. Returns False if this request should fail."""
+        server = self.server.owner
+        if server.latency:
+            time.sleep(server.latency)
+        return random.random() >= server.error_rate
+
+    def log_message(self, *args):
+        pass
+
+
+class _TelegramHandler(FakeHandler):
+    def do_GET(self):
+        match = re.fullmatch(r'/file/bot[^/]+/(.+)', self.path)
+        if match is None:
+            self.send_json(404, {'ok': False, 'error_code': 404, 'description': 'Not Found'})
+            return
+        self.server.owner.count('download')
+        if not self.simulate():
+            self.send_json(500, {'ok': False, 'error_code': 500, 'description': 'Internal Server Error'})
+            return
+        body = self.server.owner.audio_for(match.group(1))
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/octet-stream')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_POST(self):
+        match = re.fullmatch(r'/bot[^/]+/(\w+)', self.path)
+        if match is None:
+            self.send_json(404, {'ok': False, 'error_code': 404, 'description': 'Not Found'})
+            return
+        method = match.group(1)
+        server = self.server.owner
+        server.count(method)
+        body = self.read_body()
+        content_type = self.headers.get('Content-Type', '')
+        if content_type.startswith('application/json'):
+            params = json.loads(body or b'{}')
+        elif content_type.startswith('multipart/form-data'):
+            params = self.parse_multipart(content_type, body)
+        else:
+            params = {key: values[0] for key, values in parse_qs(body.decode()).items()}
+        if method != 'getUpdates' and not self.simulate():
+            self.send_json(500, {'ok': False, 'error_code': 500, 'description': 'Internal Server Error'})
+            return
+        self.send_json(200, {'ok': True, 'result': server.handle(method, params)})
+
+    @staticmethod
+    def parse_multipart(content_type: str, body: bytes) -> dict:
+        """The fields of a form, files as (file name, content)."""
+        message = email.message_from_bytes(f'Content-Type: {content_type}\r\n\r\n'.encode() + body, policy=email.policy.HTTP)
+        params = {}
+        for part in message.iter_parts():
+            content = part.get_payload(decode=True)
+            name = part.get_param('name', header='content-disposition')
+            params[name] = (part.get_filename(), content) if part.get_filename() else content.decode()
+        return params
+
+
+class FakeTelegramServer(FakeServer):
+    """Fake Telegram Bot API. Voice messages are injected with `send_voice`, replies are collected per chat."""
+
+    def __init__(self, latency: float = 0.0, error_rate: float = 0.0, audio_size: int = 20_000) -> None:
+        super().__init__(_TelegramHandler, latency, error_rate)
+        self.audio = bytes(random.getrandbits(8) for _ in range(audio_size))
+        self.updates = []
+        self.replies = {}  # chat_id -> list of (time, text)
+        self.documents = {}  # chat_id -> list of (file name, content)
+        self._sent = {}  # message_id -> (chat_id, index in replies)
+        self.condition = threading.Condition()
+        self._message_id = 0
+        self.confirmed = 0  # update_id up to which the updates were fetched
+
+    def make_message(self, user_id: int, **content) -> dict:
+        """Return a private chat message of a user, e.g. `make_message(1, text='hi')`."""
+        with self.condition:
+            self._message_id += 1
+            message_id = self._message_id
+        return {
+            'message_id': message_id,
+            'date': int(time.time()),
+            'chat': {'id': user_id, 'type': 'private'},
+            'from': {'id': user_id, 'is_bot': False, 'first_name': 'Load', 'username': f'load_{user_id}'},
+            **content,
+        }
+
+    def add_update(self, update: dict) -> dict:
+        """Make an update available to `getUpdates`. The update_id is set if it is missing."""
+        with self.condition:
+            update.setdefault('update_id', len(self.updates) + 1)
+            self.updates.append(update)
+            self.condition.notify_all()
+        return update
+
+    def send_text(self, user_id: int, text: str) -> dict:
+        return self.add_update({'message': self.make_message(user_id, text=text)})
+
+    def audio_for(self, file_path: str) -> bytes:
+        """The content of a file: the random audio, followed by the file name so every file is different."""
+        return self.audio + f'\nfile={file_path.rsplit("/", 1)[-1]}'.encode()
+
+    def send_voice(self, user_id: int, file_id: str) -> dict:
+        voice = {'file_id': file_id, 'file_unique_id': file_id, 'duration': 10, 'mime_type': 'audio/ogg', 'file_size': len(self.audio_for(f'{file_id}.ogg'))}
+        return self.add_update({'message': self.make_message(user_id, voice=voice)})
+
+    def wait_for_reply(self, chat_id: int, start: int, predicate, timeout: float):
+        """Wait for a reply in a chat, from the `start`-th one on, that matches the predicate."""
+        deadline = time.monotonic() + timeout
+        with self.condition:
+            while True:
+                for index, (_, text) in enumerate(self.replies.get(chat_id, [])[start:], start):
+                    if predicate(text):
+                        return index
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return None
+                self.condition.wait(remaining)
+
+    def replies_in(self, chat_id: int) -> list:
+        with self.condition:
+            return list(self.replies.get(chat_id, []))
+
+    def handle(self, method: str, params: dict):
+        if method == 'getMe':
+            return {'id': 1, 'is_bot': True, 'first_name': 'VerbalDiaryBot', 'username': 'verbal_diary_bot'}
+        if method == 'getUpdates':
+            timeout = float(params.get('timeout') or 0)
+            deadline = time.monotonic() + timeout
+            with self.condition:
+                # like Telegram, an offset confirms all updates before it
+                self.confirmed = max(self.confirmed, int(params.get('offset') or 0))
+                while True:
+                    updates = [update for update in self.updates if update['update_id'] >= self.confirmed]
+                    remaining = deadline - time.monotonic()
+                    if updates or remaining <= 0:
+                        return updates[:int(params.get('limit') or 100)]
+                    self.condition.wait(remaining)
+        if method == 'getFile':
+            file_id = params['file_id']
+            return {'file_id': file_id, 'file_unique_id': file_id, 'file_size': len(self.audio_for(f'{file_id}.ogg')), 'file_path': f'voice/{file_id}.ogg'}
+        if method == 'sendMessage':
+            chat_id = int(params['chat_id'])
+            with self.condition:
+                self._message_id += 1
+                message_id = self._message_id
+                replies = self.replies.setdefault(chat_id, [])
+                self._sent[message_id] = (chat_id, len(replies))
+                replies.append((time.monotonic(), params['text']))
+                self.condition.notify_all()
+            return {'message_id': message_id, 'date': int(time.time()), 'chat': {'id': chat_id, 'type': 'private'}, 'text': params['text']}
+        if method == 'editMessageText':
+            with self.condition:
+                chat_id, index = self._sent[int(params['message_id'])]
+                self.replies[chat_id][index] = (time.monotonic(), params['text'])
+                self.condition.notify_all()
+            return {'message_id': int(params['message_id']), 'date': int(time.time()), 'chat': {'id': chat_id, 'type': 'private'}, 'text': params['text']}
+        if method == 'sendDocument':
+            chat_id = int(params['chat_id'])
+            with self.condition:
+                self._message_id += 1
+                self.documents.setdefault(chat_id, []).append(params['document'])
+                self.condition.notify_all()
+            return {'message_id': self._message_id, 'date': int(time.time()), 'chat': {'id': chat_id, 'type': 'private'}}
+        return True
+
+
+class FakeBot:
+    """
+    Stands in for `telegram.Bot` and records its requests in `calls`: ('send', chat_id, text),
+    ('edit', chat_id, text) and ('document', chat_id, filename, document).
+
+    `errors` maps a chat_id (None for any chat) to the errors its next requests raise. Messages to
+    the chats in `blocked` raise `Forbidden`, those to the chats in `missing` raise `BadRequest`.
+    `on_send` is called with the chat_id of every message that was sent.
+    """
+    token = '123456:fake-bot'
+
+    def __init__(self, errors=None, blocked=(), missing=(), on_send=None):
+        self.calls = []
+        self.errors = errors or {}
+        self.blocked = set(blocked)
+        self.missing = set(missing)
+        self.on_send = on_send
+
+    @property
+    def sent(self) -> list:
+        """The (chat_id, text) of the sent messages."""
+        return [(call[1], call[2]) for call in self.calls if call[0] == 'send']
+
+    @property
+    def edits(self) -> list:
+        """The texts of the edited messages."""
+        return [call[2] for call in self.calls if call[0] == 'edit']
+
+    def _check(self, chat_id) -> None:
+        for key in (chat_id, None):
+            if self.errors.get(key):
+                raise self.errors[key].pop(0)
+        if chat_id in self.blocked:
+            raise Forbidden("Forbidden: bot was blocked by the user")
+        if chat_id in self.missing:
+            raise BadRequest("Chat not found")
+
+    async def send_message(self, chat_id, text, **kwargs):
+        self._check(chat_id)
+        self.calls.append(('send', chat_id, text))
+        if self.on_send is not None:
+            self.on_send(chat_id)
+        return SimpleNamespace(message_id=len(self.calls), chat_id=chat_id)
+
+    async def edit_message_text(self, text, chat_id, message_id, **kwargs):
+        self._check(chat_id)
+        self.calls.append(('edit', chat_id, text))
+
+    async def send_document(self, chat_id, document, filename=None, **kwargs):
+        self._check(chat_id)
+        self.calls.append(('document', chat_id, filename, document))
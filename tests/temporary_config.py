@@ -0,0 +1,44 @@
+"""
+A temporary copy of configs.json for tests that need a database (and files) of their own.
+
+`use_temporary_config` points `utils` to a copy of the config in a temporary directory, with the
+database and the voice messages in that directory too, until the end of the test.
+"""
+import json
+import tempfile
+import unittest
+from pathlib import Path
+from unittest import mock
+
+from verbal_diary_bot import utils
+
+
+REPO_PATH = Path(__file__).resolve().parents[1]
+
+
+def write_config(path: Path, config: dict) -> None:
+    """(Over)write the temporary config in `path`, e.g. after changing it."""
+    (path / 'configs.json').write_text(json.dumps(config))
+
+
+def use_temporary_config(test_case: unittest.TestCase, **sections) -> tuple:
+    """
+    Use a temporary copy of configs.json until the end of the test. `sections` replace those of
+    the config, e.g. `openai={...}`.
+
+    Returns
+    -------
+    tuple
+        The temporary directory (a Path) and the config (a dict, see `write_config`).
+    """
+    tmp_dir = tempfile.TemporaryDirectory()
+    test_case.addCleanup(tmp_dir.cleanup)
+    path = Path(tmp_dir.name)
+    config = json.loads((REPO_PATH / 'configs.json').read_text())
+    config['save_paths'] = {'db_path': str(path / 'db.sqlite'), 'voice_messages': str(path / 'voice_messages')}
+    config.update(sections)
+    write_config(path, config)
+    patcher = mock.patch.object(utils, 'TOKEN_PATH', str(path / 'configs.json'))
+    patcher.start()
+    test_case.addCleanup(patcher.stop)
+    return path, config
@@ -0,0 +1,94 @@
+import random
+import unittest
+from collections import Counter
+from datetime import date, datetime, timedelta
+from zoneinfo import ZoneInfo
+
+import numpy as np
+
+import verbal_diary_bot as vdb
+from verbal_diary_bot import analytics
+from verbal_diary_bot import database_operations as dbops
+
+
+USER1 = {'user_id': 999, 'name': 'test_name', 'notion_token': 'test_notion_token', 'database_id': '843756384563489'}
+TODAY = date(2024, 3, 12)
+
+
+def columns(dates, word_counts=None, audio_lengths=None):
+    timestamps = np.array(dates, dtype='datetime64[s]')
+    word_counts = np.array(word_counts or [10] * len(dates))
+    audio_lengths = np.array(audio_lengths or [5.0] * len(dates))
+    return timestamps, word_counts, audio_lengths
+
+
+class TestAnalytics(unittest.TestCase):
+    def setUp(self) -> None:
+        analytics._cache.clear()
+        dbops.delete_user(USER1['user_id'])
+
+    def tearDown(self) -> None:
+        dbops.delete_user(USER1['user_id'])
+
+    def test_series(self):
+        # Monday 2024-03-04 to Monday 2024-03-11
+        stats = analytics.compute_stats(*columns(
+            ['2024-03-04T08:10', '2024-03-04T21:00', '2024-03-05T09:00', '2024-03-07T23:59', '2024-03-08T00:01', '2024-03-11T10:00'],
+            [10, 20, 30, 40, 50, 60], [1, 2, 3, 4, 5, 6],
+        ), TODAY)
+        assert (stats['messages'], stats['words'], stats['audio'], stats['active_days']) == (6, 210, 21.0, 5)
+        assert str(stats['days'][0]) == '2024-03-04' and str(stats['days'][-1]) == '2024-03-12'
+        assert stats['daily_messages'].tolist() == [2, 1, 0, 1, 1, 0, 0, 1, 0]
+        assert stats['daily_words'].tolist() == [30, 30, 0, 40, 50, 0, 0, 60, 0]
+        assert [str(week) for week in stats['weeks']] == ['2024-03-04', '2024-03-11']
+        assert stats['weekly_messages'].tolist() == [5, 1]
+        assert stats['weekly_audio'].tolist() == [15, 6]
+        assert stats['hourly_messages'][[0, 8, 9, 10, 21, 23]].tolist() == [1, 1, 1, 1, 1, 1]
+        assert stats['rolling_words'][:3].tolist() == [30, 30, 20]
+        assert stats['rolling_words'][-1] == np.mean([0, 40, 50, 0, 0, 60, 0])
+
+    def test_streaks(self):
+        dates = ['2024-03-01T10:00', '2024-03-02T10:00', '2024-03-03T10:00', '2024-03-05T10:00', '2024-03-10T10:00', '2024-03-11T10:00']
+        stats = analytics.compute_stats(*columns(dates), TODAY)
+        assert stats['longest_streak'] == 3
+        # today is not over yet, the streak of yesterday still counts
+        assert stats['current_streak'] == 2
+        stats = analytics.compute_stats(*columns(dates + ['2024-03-12T07:00']), TODAY)
+        assert stats['current_streak'] == 3
+        stats = analytics.compute_stats(*columns(dates), date(2024, 3, 13))
+        assert stats['current_streak'] == 0
+        assert analytics.compute_stats(*columns([]), TODAY) is None
+
+    def test_random_history(self):
+        # the vectorized series match a straightforward count
+        rng = random.Random(0)
+        start = datetime(2023, 1, 1)
+        dates = sorted(start + timedelta(seconds=rng.randrange(400 * 24 * 3600)) for _ in range(2000))
+        words = [rng.randint(1, 300) for _ in dates]
+        stats = analytics.compute_stats(*columns([d.isoformat() for d in dates], words), TODAY)
+        per_day = Counter(d.date() for d in dates)
+        assert stats['daily_messages'].tolist() == [per_day[(start + timedelta(days=i)).date()] for i in range(len(stats['days']))]
+        words_per_week = Counter()
+        for d, count in zip(dates, words):
+            words_per_week[d.date() - timedelta(days=d.weekday())] += count
+        assert stats['weekly_words'].tolist() == [words_per_week[week.astype(datetime)] for week in stats['weeks']]
+        assert stats['hourly_messages'].tolist() == [sum(d.hour == hour for d in dates) for hour in range(24)]
+
+    def test_cache(self):
+        user = vdb.user.User(USER1['user_id'], USER1['name'], USER1['notion_token'], USER1['database_id'])
+        assert analytics.get_stats(USER1['user_id'], TODAY) is None
+        user.add_message('first', 1, 'audio', 3.0, datetime(2024, 3, 11, 9, 30, tzinfo=ZoneInfo("Europe/Berlin")))
+        stats = analytics.get_stats(USER1['user_id'], TODAY)
+        assert stats['messages'] == 1 and stats['hourly_messages'][9] == 1
+        assert analytics.get_stats(USER1['user_id'], TODAY) is stats
+        # a new message invalidates the cached statistics
+        user.add_message('second message', 2, 'audio', 4.0, datetime(2024, 3, 12, 9, 30, tzinfo=ZoneInfo("Europe/Berlin")))
+        stats = analytics.get_stats(USER1['user_id'], TODAY)
+        assert stats['messages'] == 2 and stats['current_streak'] == 2
+        # and so does a new day
+        assert analytics.get_stats(USER1['user_id'], TODAY + timedelta(days=1)) is not stats
+        assert "Messages: 2 on 2 day(s)" in analytics.format_stats(stats)
+
+    def test_render_chart(self):
+        stats = analytics.compute_stats(*columns(['2024-03-04T08:10', '2024-03-11T10:00']), TODAY)
+        assert analytics.render_chart(stats).startswith(b'\x89PNG')
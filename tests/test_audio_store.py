@@ -0,0 +1,109 @@
+import asyncio
+import os
+import tempfile
+import time
+import unittest
+from datetime import datetime
+from pathlib import Path
+
+from verbal_diary_bot import audio_store
+from verbal_diary_bot import database_operations as dbops
+from verbal_diary_bot.audio_store import AudioJanitor, AudioStore
+
+
+DAY = 24 * 60 * 60
+
+
+class TestAudioStore(unittest.TestCase):
+    def setUp(self) -> None:
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.store = AudioStore(Path(self.tmp_dir.name) / 'voice_messages')
+        dbops.create_checkpoint_tables()
+        self.job_ids = []
+
+    def tearDown(self) -> None:
+        for job_id in self.job_ids:
+            dbops.delete_voice_job(job_id)
+        self.tmp_dir.cleanup()
+
+    def add(self, content: bytes, suffix: str = '.ogg', age: float = 0) -> Path:
+        temp_path = self.store.new_temp_path(suffix)
+        temp_path.write_bytes(content)
+        path = self.store.add(temp_path)
+        if age:
+            os.utime(path, (time.time() - age, time.time() - age))
+        return path
+
+    def stored(self) -> set:
+        return {path for _, _, path in self.store.files()}
+
+    def test_add(self):
+        path = self.add(b'voice message')
+        duplicate = self.add(b'voice message')
+        other = self.add(b'another voice message', '.m4a')
+        # the same content is stored once, under its hash in sharded directories
+        assert path == duplicate != other
+        digest = audio_store.hash_file(path)
+        assert path == self.store.root / digest[:2] / digest[2:4] / f'{digest}.ogg'
+        assert other.suffix == '.m4a'
+        assert self.stored() == {path, other}
+        assert list(self.store.tmp.iterdir()) == []
+
+    def test_delete_after_transcription(self):
+        processing = self.add(b'being transcribed', age=DAY)
+        transcribed = self.add(b'transcribed', age=DAY)
+        new = self.add(b'just downloaded')
+        self.job_ids.append(dbops.insert_voice_job(999, 999, 'file_id', 'voice', str(processing), 3.0, datetime.now()))
+        janitor = AudioJanitor(self.store, keep_days=0)
+        assert janitor.clean() == 1
+        assert self.stored() == {processing, new}
+        # once the voice job is done, its file goes too
+        dbops.delete_voice_job(self.job_ids.pop())
+        assert janitor.clean() == 1
+        assert self.stored() == {new}
+
+    def test_keep_days_and_size_cap(self):
+        old = self.add(b'old' * 100, age=10 * DAY)
+        older = self.add(b'older' * 100, age=5 * DAY)
+        recent = self.add(b'recent' * 100, age=DAY)
+        newest = self.add(b'newest' * 100, age=DAY / 2)
+        # legacy audio files from before the store are cleaned up as well, their transcriptions are kept
+        legacy = self.store.root / 'AwACAgIAAxkBAAI.ogg'
+        legacy.write_bytes(b'legacy')
+        legacy.with_suffix('.txt').write_text('transcription')
+        for path in (legacy, legacy.with_suffix('.txt')):
+            os.utime(path, (time.time() - 30 * DAY, time.time() - 30 * DAY))
+        assert AudioJanitor(self.store, keep_days=7).clean() == 2
+        assert self.stored() == {older, recent, newest}
+        assert legacy.with_suffix('.txt').exists()
+        # over the cap, the oldest files are deleted first
+        assert AudioJanitor(self.store, keep_days=7, max_bytes=1300).clean() == 1
+        assert self.stored() == {recent, newest}
+        assert old not in self.stored()
+
+    def test_interrupted_downloads(self):
+        stale = self.store.new_temp_path('.ogg')
+        stale.write_bytes(b'partial')
+        os.utime(stale, (time.time() - DAY, time.time() - DAY))
+        downloading = self.store.new_temp_path('.ogg')
+        downloading.write_bytes(b'partial')
+        assert AudioJanitor(self.store).clean() == 1
+        assert list(self.store.tmp.iterdir()) == [downloading]
+
+    def test_janitor_task(self):
+        path = self.add(b'transcribed', age=DAY)
+
+        async def run():
+            janitor = AudioJanitor(self.store, interval=0.05)
+            janitor.start()
+            deadline = time.monotonic() + 5
+            while path.exists() and time.monotonic() < deadline:
+                await asyncio.sleep(0.01)
+            await janitor.close()
+
+        asyncio.run(run())
+        assert not path.exists()
+
+    def test_describe_retention(self):
+        assert audio_store.describe_retention(0) == "Audio messages are deleted as soon as they are transcribed."
+        assert audio_store.describe_retention(7) == "Audio messages are deleted after 7 days."
@@ -0,0 +1,119 @@
+import asyncio
+import unittest
+from datetime import datetime, timedelta
+
+from telegram.error import BadRequest, RetryAfter
+
+from verbal_diary_bot import ratelimit
+from verbal_diary_bot import database_operations as dbops
+from verbal_diary_bot.broadcast import Broadcast
+from verbal_diary_bot.ratelimit import TokenBucket
+from verbal_diary_bot.reminders import ReminderScheduler
+
+from fake_telegram import FakeBot
+from temporary_config import use_temporary_config
+
+
+ADMIN_CHAT_ID = 1
+USER_IDS = list(range(1000, 1250))
+BLOCKED = {1003, 1100}
+MISSING = {1200}
+
+
+class TestBroadcast(unittest.TestCase):
+    def setUp(self) -> None:
+        # a database of its own, the broadcast goes to all users
+        use_temporary_config(self)
+        dbops.create_tables()
+        dbops.create_broadcast_table()
+        for user_id in reversed(USER_IDS):
+            dbops.insert_user(user_id, f'user{user_id}', None, None)
+
+    def bot(self, errors=None, on_send=None):
+        return FakeBot(errors, blocked=BLOCKED, missing=MISSING, on_send=on_send)
+
+    def new_broadcast(self, text='Hello everyone'):
+        return dbops.insert_broadcast(text, ADMIN_CHAT_ID, dbops.count_users(), datetime.now())
+
+    def received(self, bot):
+        return [chat_id for chat_id, _ in bot.sent if chat_id != ADMIN_CHAT_ID]
+
+    def test_broadcast(self):
+        broadcast_id = self.new_broadcast('Hello\neveryone')
+        bot = self.bot({1010: [RetryAfter(timedelta(seconds=0.1))], 1020: [BadRequest("Chat not found")]})
+        counts = asyncio.run(Broadcast(bot, broadcast_id, bucket=TokenBucket(10_000, 10_000)).run())
+        expected = [user_id for user_id in USER_IDS if user_id not in BLOCKED | MISSING | {1020}]
+        # everyone gets the message once, in order, after the flood wait too
+        assert self.received(bot) == expected
+        assert {text for chat_id, text in bot.sent if chat_id != ADMIN_CHAT_ID} == {'Hello\neveryone'}
+        assert counts == {'sent': len(expected), 'failed': 2, 'blocked': 2}
+        row = dbops.get_broadcast(broadcast_id)
+        assert row[3:9] == ('done', USER_IDS[-1], len(USER_IDS), len(expected), 2, 2)
+        # the progress message is sent first and updated at the end
+        assert bot.sent[0][0] == ADMIN_CHAT_ID
+        assert bot.edits[-1].startswith(f"Broadcast {broadcast_id} (done): 250/250 users")
+
+    def test_resume(self):
+        broadcast_id = self.new_broadcast()
+
+        async def interrupted():
+            # the bot is stopped after 150 messages
+            task = asyncio.create_task(Broadcast(bot, broadcast_id, bucket=TokenBucket(10_000, 10_000)).run())
+            bot.on_send = lambda chat_id: len(bot.sent) == 151 and task.cancel()
+            with self.assertRaises(asyncio.CancelledError):
+                await task
+
+        bot = self.bot()
+        asyncio.run(interrupted())
+        first = self.received(bot)
+        row = dbops.get_broadcast(broadcast_id)
+        assert row[3] == 'running' and row[4] == first[-1]
+        assert dbops.get_running_broadcasts()[0][0] == broadcast_id
+        bot = self.bot()
+        counts = asyncio.run(Broadcast(bot, broadcast_id, bucket=TokenBucket(10_000, 10_000)).run())
+        # nobody gets the message twice
+        assert first + self.received(bot) == [user_id for user_id in USER_IDS if user_id not in BLOCKED | MISSING]
+        assert counts['sent'] == len(USER_IDS) - 3
+        assert dbops.get_running_broadcasts() == []
+
+    def test_cancel(self):
+        broadcast_id = self.new_broadcast()
+        bot = self.bot(on_send=lambda chat_id: chat_id == 1050 and dbops.set_broadcast_status(broadcast_id, 'cancelled'))
+        asyncio.run(Broadcast(bot, broadcast_id, bucket=TokenBucket(10_000, 10_000), page_size=100).run())
+        # the current page is finished
+        assert self.received(bot)[-1] == 1099
+        assert dbops.get_broadcast(broadcast_id)[3] == 'cancelled'
+
+    def test_shared_bucket(self):
+        ratelimit._buckets.clear()
+        self.addCleanup(ratelimit._buckets.clear)
+        # with several workers, each one gets its part of the bot's rate
+        bucket = ratelimit.get_telegram_bucket(FakeBot.token, workers=2)
+        assert bucket.rate == ratelimit.TELEGRAM_RATE / 2
+        bot = self.bot({1000: [RetryAfter(timedelta(seconds=30))]})
+        broadcast = Broadcast(bot, self.new_broadcast())
+        assert broadcast.bucket is bucket
+
+        async def run():
+            task = asyncio.create_task(broadcast.run())
+            await asyncio.sleep(0.2)
+            task.cancel()
+            await asyncio.gather(task, return_exceptions=True)
+        asyncio.run(run())
+        # Telegram's flood wait in the broadcast pauses the reminders as well
+        scheduler = ReminderScheduler(shard=(0, 2))
+        with self.assertRaises(asyncio.TimeoutError):
+            asyncio.run(asyncio.wait_for(scheduler.send(bot, 1001, 1), 0.2))
+        assert scheduler.bucket is bucket and self.received(bot) == []
+
+    def test_rate_limit(self):
+        broadcast_id = self.new_broadcast()
+
+        async def run():
+            loop = asyncio.get_running_loop()
+            start = loop.time()
+            await Broadcast(self.bot(), broadcast_id, bucket=TokenBucket(100, 100)).run()
+            return loop.time() - start
+
+        # a burst of 100 messages, then 100 per second
+        assert asyncio.run(run()) >= (len(USER_IDS) - 100) / 100 - 0.1
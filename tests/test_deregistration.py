@@ -0,0 +1,98 @@
+import asyncio
+import unittest
+from datetime import datetime
+from types import SimpleNamespace
+from unittest import mock
+from zoneinfo import ZoneInfo
+
+import verbal_diary_bot as vdb
+from verbal_diary_bot import deregistration, semantic_search, storage, transcript_archive
+from verbal_diary_bot import database_operations as dbops
+
+from temporary_config import use_temporary_config
+
+
+USER_ID = 999
+OTHER_USER_ID = 998
+DATE = datetime(2024, 3, 1, 21, 30, 5, tzinfo=ZoneInfo("Europe/Berlin"))
+
+
+class TestDeregistration(unittest.TestCase):
+    def setUp(self) -> None:
+        # a database and files of their own
+        self.path, _ = use_temporary_config(self)
+        self.addCleanup(transcript_archive.close_archives)
+        dbops.create_tables()
+        dbops.create_checkpoint_tables()
+        dbops.create_reminder_table()
+        dbops.create_deregistration_table()
+        dbops.create_outbox_table()
+        dbops.create_notion_mirror_tables()
+        self.archive = transcript_archive.get_archive()
+        for user_id in (USER_ID, OTHER_USER_ID):
+            user = vdb.user.User(user_id, f'name_{user_id}', 'secret', 'database')
+            for i in range(3):
+                text = f'entry {i} of user {user_id}'
+                message_id = user.add_message(text, 5, 'audio', 10.0, DATE)
+                self.archive.append(f'file-{user_id}-{i}', user_id, DATE, text)
+                semantic_search.index_message(user_id, message_id, text)
+            dbops.set_reminder_preferences(user_id, True, '20:30', 'Europe/Berlin', 1)
+            dbops.insert_outbox_entry(user_id, f'database-{user_id}', 'Week 9', 'Friday', f'pending entry of user {user_id}')
+            dbops.upsert_notion_pages([(f'page-{user_id}', user_id, f'database-{user_id}', 'Week 9', f'entry 0 of user {user_id}', '2024-03-01', '2024-03-01')])
+            dbops.set_notion_sync_cursor(user_id, f'database-{user_id}', '2024-03-01')
+
+    def test_anonymize(self):
+        # an unfinished voice job, and a transcription of an older version
+        audio = self.path / 'voice_messages' / 'ab' / 'cd' / 'abcd.ogg'
+        audio.parent.mkdir(parents=True)
+        audio.write_bytes(b'audio')
+        dbops.insert_voice_job(USER_ID, USER_ID, 'file-999-3', 'voice', str(audio), 10.0, DATE)
+        legacy = self.path / 'voice_messages' / 'legacy.txt'
+        legacy.write_text('entry of an unknown user')
+        dbops.insert_deregistration(USER_ID, DATE)
+        dbops.insert_deregistration(12345, DATE)
+        sizes = [segment.stat().st_size for segment in self.archive.segments()]
+        assert deregistration.process_queue(batch_size=1) == 2
+        assert dbops.get_deregistrations() == []
+
+        assert not dbops.user_exists(USER_ID)
+        anonymous = [user for user in dbops.get_all_users() if user[0] not in (USER_ID, OTHER_USER_ID)]
+        assert len(anonymous) == 1 and anonymous[0][1:] == (None, None, None)
+        assert [message[3] for message in dbops.get_messages_by_user(anonymous[0][0])] == [None] * 3
+        assert dbops.get_reminder_preferences(USER_ID) is None
+        assert dbops.get_voice_jobs() == [] and not audio.exists()
+        # the transcriptions of older versions cannot be attributed to a user
+        assert legacy.exists()
+        # nothing of their diary is left in the Notion outbox and mirror
+        assert dbops.get_outbox_status(USER_ID)[0] == 0
+        assert dbops.search_notion_pages(USER_ID, "entry") == []
+        assert dbops.get_notion_sync_cursor(USER_ID, f'database-{USER_ID}') is None
+        assert [entry[1] for entry in dbops.get_outbox_entries()] == [OTHER_USER_ID]
+        assert dbops.search_notion_pages(OTHER_USER_ID, "entry") == [(f'page-{OTHER_USER_ID}', 'Week 9')]
+        assert semantic_search.search(USER_ID, "entry") == []
+        # the transcriptions are overwritten in place, those of the other user are kept
+        assert self.archive.get('file-999-0') is None
+        assert [segment.stat().st_size for segment in self.archive.segments()] == sizes
+        assert [record['file_id'] for record in self.archive.replay()] == [f'file-{OTHER_USER_ID}-{i}' for i in range(3)]
+        assert self.archive.get(f'file-{OTHER_USER_ID}-1')['text'] == f'entry 1 of user {OTHER_USER_ID}'
+        assert dbops.get_user(OTHER_USER_ID)[1] == f'name_{OTHER_USER_ID}'
+        assert len(dbops.get_messages_by_user(OTHER_USER_ID)) == 3
+
+    def test_request(self):
+        async def run():
+            scheduler = SimpleNamespace(removed=[], remove=lambda user_id: scheduler.removed.append(user_id))
+            application = SimpleNamespace(bot_data={'reminders': scheduler})
+            await deregistration.request_deregistration(application, USER_ID)
+            # the user is queued right away, and anonymized in the background
+            assert scheduler.removed == [USER_ID]
+            await deregistration.finish_deregistrations(application)
+            assert not dbops.user_exists(USER_ID) and dbops.get_deregistrations() == []
+            assert application.bot_data['deregistrations'] == set()
+        asyncio.run(run())
+
+    def test_surrogate_collision(self):
+        taken = dbops.get_user(OTHER_USER_ID)[0]
+        with mock.patch.object(storage, 'random_user_id', side_effect=[taken, 9991000000000001]):
+            assert dbops.anonymize_users([USER_ID, 12345]) == {USER_ID: 9991000000000001}
+        assert dbops.get_user(OTHER_USER_ID)[1] == f'name_{OTHER_USER_ID}'
+        assert [message[1] for message in dbops.get_messages_by_user(9991000000000001)] == [9991000000000001] * 3
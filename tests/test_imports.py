@@ -0,0 +1,36 @@
+import json
+import os
+import subprocess
+import sys
+import unittest
+from pathlib import Path
+
+
+REPO_PATH = Path(__file__).resolve().parents[1]
+SCRIPT = """
+import json, sys
+import {module}
+print(json.dumps(sorted(name for name in ('telegram', 'openai', 'notion_client', 'numpy', 'matplotlib') if name in sys.modules)))
+"""
+
+
+def heavy_imports(module: str) -> list:
+    """The heavy packages that importing the module in a fresh process loads."""
+    env = dict(os.environ, PYTHONPATH=str(REPO_PATH / 'src'))
+    output = subprocess.run([sys.executable, '-c', SCRIPT.format(module=module)], env=env, capture_output=True, text=True, check=True).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+
+class TestImports(unittest.TestCase):
+    def test_lazy_package(self):
+        assert heavy_imports('verbal_diary_bot') == []
+        assert heavy_imports('verbal_diary_bot.database_operations') == []
+        # openai is only imported for a client
+        assert 'openai' not in heavy_imports('verbal_diary_bot.main_bot')
+
+    def test_submodules(self):
+        import verbal_diary_bot as vdb
+        assert vdb.utils.TOKEN_PATH and 'user' in dir(vdb)
+        from verbal_diary_bot import notion2
+        with self.assertRaises(AttributeError):
+            vdb.does_not_exist
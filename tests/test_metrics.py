@@ -0,0 +1,67 @@
+import asyncio
+import unittest
+import urllib.request
+
+from verbal_diary_bot import metrics, notion, notion_async, ratelimit
+
+from fake_notion import FakeNotionServer
+
+
+class TestMetrics(unittest.TestCase):
+    def setUp(self) -> None:
+        metrics.reset()
+
+    def test_timer(self):
+        with metrics.timer('transcription'):
+            pass
+        with self.assertRaises(ValueError):
+            with metrics.timer('transcription'):
+                raise ValueError('failed')
+        assert metrics.get_count('stage_duration_seconds', stage='transcription') == 2
+        assert metrics.get_count('stage_errors_total', stage='transcription', error='ValueError') == 1
+
+    def test_render(self):
+        metrics.observe('stage_duration_seconds', 0.2, stage='notion_append')
+        metrics.increment('retries_total', service='notion', reason='429')
+        text = metrics.render()
+        assert '# TYPE vdb_stage_duration_seconds histogram' in text
+        assert 'vdb_stage_duration_seconds_bucket{stage="notion_append",le="0.1"} 0' in text
+        assert 'vdb_stage_duration_seconds_bucket{stage="notion_append",le="0.25"} 1' in text
+        assert 'vdb_stage_duration_seconds_bucket{stage="notion_append",le="+Inf"} 1' in text
+        assert 'vdb_stage_duration_seconds_count{stage="notion_append"} 1' in text
+        assert 'vdb_retries_total{reason="429",service="notion"} 1' in text
+
+    def test_http_endpoint(self):
+        metrics.increment('retries_total', service='openai', reason='RateLimitError')
+        server = metrics.start_http_server(0)
+        try:
+            with urllib.request.urlopen(f'http://127.0.0.1:{server.server_address[1]}/metrics') as response:
+                assert response.headers['Content-Type'].startswith('text/plain')
+                assert 'vdb_retries_total{reason="RateLimitError",service="openai"} 1' in response.read().decode()
+        finally:
+            server.shutdown()
+            server.server_close()
+
+    def test_notion_stages_and_retries(self):
+        notion._weekly_page_cache.clear()
+        notion_async._page_locks.clear()
+        ratelimit._buckets.clear()
+
+        async def run(server):
+            await notion_async.append_transcription('test_notion_token', '843756384563489', ['Title', 'Description'], {'text': 'hello'}, base_url=server.base_url)
+            await notion_async.close_clients()
+
+        # a burst above the server's limit gets rate limited and retried
+        with FakeNotionServer(rate_limit=5, burst=1, retry_after=0.2) as server:
+            asyncio.run(run(server))
+        assert metrics.get_count('stage_duration_seconds', stage='notion_lookup') == 1
+        assert metrics.get_count('stage_duration_seconds', stage='notion_create') == 1
+        assert metrics.get_count('stage_duration_seconds', stage='notion_append') == 1
+        assert metrics.get_count('retries_total', service='notion', reason='429') >= 1
+        notion._weekly_page_cache.clear()
+        notion_async._page_locks.clear()
+        ratelimit._buckets.clear()
+
+    def tearDown(self) -> None:
+        metrics.reset()
+        return super().tearDown()
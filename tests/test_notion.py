@@ -0,0 +1,78 @@
+import unittest
+from unittest import mock
+
+import httpx
+from notion_client import APIResponseError, APIErrorCode
+
+from verbal_diary_bot import notion
+
+
+DATABASE_ID = 'test_database_id'
+PAGE_PROPERTIES = ['Title', 'Description']
+
+
+def make_page(page_id: str, title: str) -> dict:
+    return {'id': page_id, 'properties': {'Title': {'title': [{'text': {'content': title}}]}}}
+
+
+class TestWeeklyPageLookup(unittest.TestCase):
+    def setUp(self) -> None:
+        notion._weekly_page_cache.clear()
+        patcher = mock.patch.object(notion, 'Client')
+        self.client = patcher.start().return_value
+        self.addCleanup(patcher.stop)
+        self.client.databases.query.return_value = {'results': [], 'has_more': False, 'next_cursor': None}
+        self.client.pages.create.return_value = {'id': 'new_page'}
+
+    def append(self, text='test transcription'):
+        return notion.append_transcription('token', DATABASE_ID, PAGE_PROPERTIES, {'text': text})
+
+    def test_query_is_filtered_by_title(self):
+        title = notion.create_page_title()
+        self.client.databases.query.return_value = {'results': [make_page('week_page', title)], 'has_more': False, 'next_cursor': None}
+        self.append()
+        query = self.client.databases.query.call_args.kwargs
+        assert query['filter'] == {'property': 'Title', 'title': {'equals': title}}
+        assert self.client.blocks.children.append.call_args.kwargs['block_id'] == 'week_page'
+        self.client.pages.create.assert_not_called()
+
+    def test_query_follows_pagination(self):
+        self.client.databases.query.side_effect = [
+            {'results': [make_page(str(i), f'page {i}') for i in range(100)], 'has_more': True, 'next_cursor': 'cursor1'},
+            {'results': [make_page('100', 'page 100')], 'has_more': False, 'next_cursor': None},
+        ]
+        pages = notion.Notion('token', DATABASE_ID, PAGE_PROPERTIES).get_pages_from_database(DATABASE_ID)
+        assert len(pages) == 101
+        assert self.client.databases.query.call_args_list[1].kwargs['start_cursor'] == 'cursor1'
+
+    def test_cached_append_is_a_single_call(self):
+        # first append has to look up and create the weekly page
+        self.append()
+        self.client.pages.create.assert_called_once()
+        self.client.databases.query.reset_mock()
+        self.client.blocks.children.append.reset_mock()
+        # the second append only appends the blocks
+        self.append()
+        self.client.databases.query.assert_not_called()
+        self.client.pages.create.assert_called_once()
+        self.client.blocks.children.append.assert_called_once()
+
+    def test_archived_page_is_invalidated(self):
+        self.append()
+        notion.Notion('token', DATABASE_ID, PAGE_PROPERTIES).archive_page('new_page')
+        assert notion._weekly_page_cache == {}
+
+    def test_stale_cache_is_recovered(self):
+        title = notion.create_page_title()
+        notion._weekly_page_cache[(DATABASE_ID, title)] = 'archived_page'
+        response = httpx.Response(404, request=httpx.Request('PATCH', 'https://api.notion.com'))
+        error = APIResponseError(response, 'Could not find block', APIErrorCode.ObjectNotFound)
+        self.client.blocks.children.append.side_effect = [error, {'results': []}]
+        self.append()
+        block_ids = [call.kwargs['block_id'] for call in self.client.blocks.children.append.call_args_list]
+        assert block_ids == ['archived_page', 'new_page']
+        assert notion._weekly_page_cache[(DATABASE_ID, title)] == 'new_page'
+
+    def tearDown(self) -> None:
+        notion._weekly_page_cache.clear()
+        return super().tearDown()
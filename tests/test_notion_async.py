@@ -0,0 +1,103 @@
+import asyncio
+import time
+import unittest
+
+from notion_client.errors import HTTPResponseError
+
+from verbal_diary_bot import notion, notion_async, ratelimit
+
+from fake_notion import FakeNotionServer, error
+
+
+DATABASE_ID = 'test_database_id'
+PAGE_PROPERTIES = ['Title', 'Description']
+
+
+class TestTokenBucket(unittest.TestCase):
+    def test_rate(self):
+        async def run():
+            bucket = ratelimit.TokenBucket(rate=20, capacity=1)
+            start = time.monotonic()
+            for _ in range(11):
+                await bucket.acquire()
+            return time.monotonic() - start
+        # the first token is available immediately, the other ten take 1/20 s each
+        assert 0.45 < asyncio.run(run()) < 1.0
+
+    def test_block_for(self):
+        async def run():
+            bucket = ratelimit.TokenBucket(rate=100, capacity=10)
+            bucket.block_for(0.3)
+            start = time.monotonic()
+            await bucket.acquire()
+            return time.monotonic() - start
+        assert asyncio.run(run()) >= 0.29
+
+
+class TestAsyncNotion(unittest.TestCase):
+    def setUp(self) -> None:
+        notion._weekly_page_cache.clear()
+        notion_async._page_locks.clear()
+        ratelimit._buckets.clear()
+
+    def append_many(self, server: FakeNotionServer, n: int, token: str = 'token'):
+        async def run():
+            try:
+                await asyncio.gather(*[
+                    notion_async.append_transcription(token, DATABASE_ID, PAGE_PROPERTIES, {'text': f'message {i}'}, base_url=server.base_url)
+                    for i in range(n)
+                ])
+            finally:
+                await notion_async.close_clients()
+        asyncio.run(run())
+
+    def test_stays_below_rate_limit(self):
+        with FakeNotionServer(rate_limit=notion_async.NOTION_RATE_LIMIT) as server:
+            self.append_many(server, 6)
+            assert server.rate_limited == 0
+            # exactly one weekly page, created once and found in the cache afterwards
+            assert len(server.pages_in(DATABASE_ID)) == 1
+            assert server.count('PATCH', r'/v1/blocks/.*/children') == 6
+
+    def test_retry_after_is_honored(self):
+        # limiter allows much more than the server, so the server answers with 429 and Retry-After
+        ratelimit.get_bucket('notion:token', rate=100, capacity=20)
+        with FakeNotionServer(rate_limit=4, retry_after=0.5) as server:
+            start = time.monotonic()
+            self.append_many(server, 10)
+            elapsed = time.monotonic() - start
+            assert server.rate_limited > 0
+            assert server.count('PATCH', r'/v1/blocks/.*/children') == 10
+            assert elapsed >= 0.5
+
+    def test_failed_write_is_not_repeated(self):
+        with FakeNotionServer() as server:
+            append = server._append
+
+            def applied_then_failed(page_id, body):
+                # Notion applied the write, but the response is lost behind a gateway error
+                append(page_id, body)
+                return 502, error(502, 'internal_server_error', 'Bad gateway.')
+            server._append = applied_then_failed
+            with self.assertRaises(HTTPResponseError):
+                self.append_many(server, 1)
+            page_id = server.pages_in(DATABASE_ID)[0]['id']
+            # the entry is appended once, the retry is left to the outbox
+            assert [status for method, _, status in server.requests if method == 'PATCH'] == [502]
+            assert len(server.children[page_id]) == 2  # heading and text
+
+    def test_archived_page_is_recreated(self):
+        with FakeNotionServer() as server:
+            self.append_many(server, 1)
+            page_id = server.pages_in(DATABASE_ID)[0]['id']
+            server.pages[page_id]['archived'] = True
+            self.append_many(server, 1)
+            pages = server.pages_in(DATABASE_ID)
+            assert len(pages) == 1 and pages[0]['id'] != page_id
+            assert len(server.children[pages[0]['id']]) == 2
+
+    def tearDown(self) -> None:
+        notion._weekly_page_cache.clear()
+        notion_async._page_locks.clear()
+        ratelimit._buckets.clear()
+        return super().tearDown()
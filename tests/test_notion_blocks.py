@@ -0,0 +1,101 @@
+import asyncio
+import json
+import math
+import unittest
+
+from hypothesis import given, settings, strategies as st
+
+from verbal_diary_bot import notion, notion_async, ratelimit
+
+from fake_notion import FakeNotionServer
+
+
+DATABASE_ID = 'test_database_id'
+PAGE_PROPERTIES = ['Title', 'Description']
+NOTION = notion.Notion('token', DATABASE_ID, PAGE_PROPERTIES)
+
+WORDS = ['Ich', 'bin', 'gerade', 'mit', 'dem', 'Hund', 'draußen.', 'Wie', 'geht', "es", 'dir?', 'Aha!', '🙂',
+         'Donaudampfschifffahrtsgesellschaftskapitänsmütze', '\n', 'x' * 2500]
+
+
+@st.composite
+def transcripts(draw, min_words=1, max_words=2000, min_repeat=1, max_repeat=200):
+    """Texts of up to a few million characters, built from words, sentence ends and very long words."""
+    words = draw(st.lists(st.sampled_from(WORDS), min_size=min_words, max_size=max_words))
+    separators = draw(st.lists(st.sampled_from([' ', '  ', '. ', '\n\n', '']), min_size=len(words), max_size=len(words)))
+    text = ''.join(w + s for w, s in zip(words, separators))
+    return text * draw(st.integers(min_repeat, max_repeat))
+
+
+def contents(blocks):
+    return [item['text']['content'] for block in blocks for item in block['paragraph']['rich_text']]
+
+
+class TestBlockPacker(unittest.TestCase):
+    @settings(max_examples=30, deadline=None)
+    @given(st.text(max_size=5000) | transcripts(max_repeat=5))
+    def test_split_text(self, text):
+        pieces = notion.split_text(text)
+        assert ''.join(pieces) == text
+        assert all(len(piece) <= notion.NOTION_PAR_LIM for piece in pieces)
+        # a piece is only cut inside a word if that word does not fit into a piece
+        for piece, following in zip(pieces, pieces[1:]):
+            if not piece[-1].isspace() and not following[0].isspace():
+                assert not any(c.isspace() for c in piece[1:])
+
+    @settings(max_examples=15, deadline=None)
+    @given(transcripts(min_words=100, min_repeat=20, max_repeat=1000))
+    def test_blocks_within_limits(self, text):
+        blocks = NOTION.create_transcription_block('heading', text)
+        assert ''.join(contents(blocks[1:])) == text
+        for block in blocks[1:]:
+            rich_text = block['paragraph']['rich_text']
+            assert 1 <= len(rich_text) <= notion.NOTION_RICH_TEXT_LIM
+            assert all(len(item['text']['content']) <= notion.NOTION_PAR_LIM for item in rich_text)
+        chunks = notion.chunk_blocks(blocks)
+        assert [b for chunk in chunks for b in chunk] == blocks
+        size = sum(len(json.dumps(b, ensure_ascii=False).encode()) for b in blocks)
+        for chunk in chunks:
+            assert len(chunk) <= notion.NOTION_CHILDREN_LIM
+            assert len(json.dumps({'children': chunk}, ensure_ascii=False).encode()) <= 500 * 1000
+        # every chunk but the last is at least half full, so the number of requests is close to optimal
+        assert len(chunks) <= 2 * math.ceil(size / notion.NOTION_PAYLOAD_LIM) + 1
+
+    def test_short_text_is_one_block(self):
+        blocks = NOTION.create_paragraph_blocks('Hallo Josh, wie geht es dir?')
+        assert len(blocks) == 1 and contents(blocks) == ['Hallo Josh, wie geht es dir?']
+
+    def test_sentence_boundaries(self):
+        sentence = 'Das ist ein Satz mit ein paar Worten. '
+        pieces = notion.split_text(sentence * 200)
+        assert all(piece.endswith('. ') for piece in pieces[:-1])
+
+
+class TestLongTranscriptAppend(unittest.TestCase):
+    def setUp(self) -> None:
+        notion._weekly_page_cache.clear()
+        notion_async._page_locks.clear()
+        ratelimit._buckets.clear()
+
+    def test_api_calls(self):
+        text = 'Ich bin gerade mit dem Hund draußen und erzähle dir von meinem Tag. ' * 30000  # ~2 million characters
+        with FakeNotionServer() as server:
+            async def run():
+                await notion_async.append_transcription('token', DATABASE_ID, PAGE_PROPERTIES, {'text': text}, base_url=server.base_url)
+                await notion_async.close_clients()
+            asyncio.run(run())
+            page = server.pages_in(DATABASE_ID)[0]
+            stored = server.children[page['id']]
+            assert ''.join(contents(stored[1:])) == text
+            appends = server.count('PATCH', r'/v1/blocks/.*/children')
+            # slicing into NOTION_PAR_LIM paragraphs would need >1000 blocks, i.e. at least 11 requests
+            assert appends == len(notion.chunk_blocks(NOTION.create_transcription_block('heading', text)))
+            assert appends <= 6
+            # query for the weekly page, create it, then the appends
+            assert len(server.requests) == appends + 2
+
+    def tearDown(self) -> None:
+        notion._weekly_page_cache.clear()
+        notion_async._page_locks.clear()
+        ratelimit._buckets.clear()
+        return super().tearDown()
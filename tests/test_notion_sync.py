@@ -0,0 +1,81 @@
+import asyncio
+import unittest
+
+from verbal_diary_bot import notion, notion_async, notion_sync, ratelimit
+from verbal_diary_bot import database_operations as dbops
+
+from fake_notion import FakeNotionServer
+
+
+USER1 = {'user_id': 999, 'name': 'test_name', 'notion_token': 'test_notion_token', 'database_id': '843756384563489'}
+QUERY = r'/v1/databases/.*/query'
+CHILDREN = r'/v1/blocks/.*/children'
+
+
+def delete_mirror():
+    conn = dbops.connect_db()
+    conn.execute('DELETE FROM NotionPages WHERE user_id = ?', (USER1['user_id'],))
+    conn.execute('DELETE FROM NotionSync WHERE user_id = ?', (USER1['user_id'],))
+    conn.commit()
+    conn.close()
+
+
+class TestNotionSync(unittest.TestCase):
+    def setUp(self) -> None:
+        notion._weekly_page_cache.clear()
+        ratelimit._buckets.clear()
+        # the sync is not what is tested for rate limits, so allow many requests
+        ratelimit.get_bucket(f"notion:{USER1['notion_token']}", rate=1000, capacity=1000)
+        dbops.create_notion_mirror_tables()
+        delete_mirror()
+        self.server = FakeNotionServer().start()
+        # more pages than fit into one query response
+        self.page_ids = [
+            self.server.add_page(USER1['database_id'], f'2024 Week {i:02d}', f'Entry number {i}', last_edited_time=f'2024-01-01T00:{i // 60:02d}:{i % 60:02d}.000Z')
+            for i in range(150)
+        ]
+
+    def sync(self):
+        async def run():
+            updated = await notion_sync.sync_user(USER1['user_id'], USER1['notion_token'], USER1['database_id'], base_url=self.server.base_url)
+            await notion_async.close_clients()
+            return updated
+        self.server.requests.clear()
+        return asyncio.run(run())
+
+    def test_initial_sync(self):
+        assert self.sync() == 150
+        # two query pages of 100 and 50 results, one children request per page
+        assert self.server.count('POST', QUERY) == 2
+        assert self.server.count('GET', CHILDREN) == 150
+        assert dbops.get_notion_sync_cursor(USER1['user_id'], USER1['database_id']) == '2024-01-01T00:02:29.000Z'
+
+    def test_incremental_sync(self):
+        self.sync()
+        # nothing changed: one query, only the pages at the cursor are returned, no content is downloaded
+        assert self.sync() == 0
+        assert self.server.count('POST', QUERY) == 1
+        assert self.server.count('GET', CHILDREN) == 0
+        # one page was edited in Notion
+        self.server.edit_page(self.page_ids[3], 'Added later')
+        assert self.sync() == 1
+        assert self.server.count('GET', CHILDREN) == 1
+        assert dbops.search_notion_pages(USER1['user_id'], 'Added later') == [(self.page_ids[3], '2024 Week 03')]
+
+    def test_local_lookups(self):
+        self.server.add_page(USER1['database_id'], '2024 Week 07', 'A duplicate weekly page')
+        title = notion.create_page_title()
+        this_week = self.server.add_page(USER1['database_id'], title)
+        self.sync()
+        assert dbops.find_duplicate_notion_pages(USER1['user_id']) == [('2024 Week 07', 2)]
+        assert dbops.find_notion_page_by_title(USER1['user_id'], USER1['database_id'], title) == this_week
+        # the weekly page cache is warmed by the sync
+        assert notion._weekly_page_cache[(USER1['database_id'], title)] == this_week
+        assert dbops.search_notion_pages(USER1['user_id'], '100%') == []
+
+    def tearDown(self) -> None:
+        self.server.stop()
+        delete_mirror()
+        notion._weekly_page_cache.clear()
+        ratelimit._buckets.clear()
+        return super().tearDown()
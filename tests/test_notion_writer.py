@@ -0,0 +1,157 @@
+import asyncio
+import json
+import unittest
+from unittest import mock
+
+from verbal_diary_bot import notion, notion_async, ratelimit
+from verbal_diary_bot import database_operations as dbops
+from verbal_diary_bot.notion_writer import NotionWriter
+
+from fake_notion import FakeNotionServer
+
+
+USER1 = {'user_id': 999, 'name': 'test_name', 'notion_token': 'test_notion_token', 'database_id': '843756384563489'}
+APPEND = r'/v1/blocks/.*/children'
+
+
+def delete_outbox_entries():
+    conn = dbops.connect_db()
+    conn.execute('DELETE FROM NotionOutbox WHERE user_id = ?', (USER1['user_id'],))
+    conn.commit()
+    conn.close()
+
+
+class TestNotionWriter(unittest.TestCase):
+    def setUp(self) -> None:
+        notion._weekly_page_cache.clear()
+        notion_async._page_locks.clear()
+        ratelimit._buckets.clear()
+        dbops.create_outbox_table()
+        delete_outbox_entries()
+        dbops.delete_user(USER1['user_id'])
+        dbops.insert_user(USER1['user_id'], USER1['name'], USER1['notion_token'], USER1['database_id'])
+        self.server = FakeNotionServer().start()
+
+    def run_writer(self, texts, window=0.1, close_early=False, shard=None):
+        async def run():
+            writer = NotionWriter(window=window, base_url=self.server.base_url, shard=shard)
+            writer.start()
+            futures = [writer.submit(USER1['user_id'], USER1['database_id'], {'text': text}) for text in texts]
+            if close_early:
+                await writer.close()
+            results = await asyncio.gather(*futures, return_exceptions=True)
+            await writer.close()
+            await notion_async.close_clients()
+            return results
+        return asyncio.run(run())
+
+    def page_texts(self):
+        page = self.server.pages_in(USER1['database_id'])[0]
+        blocks = self.server.children[page['id']]
+        return [item['text']['content'] for b in blocks if b['type'] == 'paragraph' for item in b['paragraph']['rich_text']]
+
+    def pending(self):
+        return dbops.get_outbox_status(USER1['user_id'])[0]
+
+    def test_burst_is_one_append(self):
+        texts = [f'message {i}' for i in range(10)]
+        self.run_writer(texts)
+        assert self.server.count('PATCH', APPEND) == 1
+        # order is preserved
+        assert self.page_texts() == texts
+        assert self.pending() == 0
+
+    def test_children_limit(self):
+        # each transcription is a heading and a paragraph, 120 blocks need two requests
+        texts = [f'message {i}' for i in range(60)]
+        self.run_writer(texts)
+        assert self.server.count('PATCH', APPEND) == 2
+        assert self.page_texts() == texts
+
+    def test_payload_limit(self):
+        texts = [('x' * 1999 + ' ') * 50 for _ in range(6)]
+        self.run_writer(texts)
+        appends = [r for r in self.server.requests if r[0] == 'PATCH']
+        assert all(status == 200 for _, _, status in appends)
+        assert len(appends) > 1
+
+    def test_close_flushes(self):
+        # the window is never reached, closing the writer has to write the outbox
+        texts = ['first', 'second']
+        self.run_writer(texts, window=60, close_early=True)
+        assert self.page_texts() == texts
+
+    @mock.patch.object(notion_async, 'RETRIES', 1)
+    def test_outage(self):
+        self.server.error_rate = 1.0
+        results = self.run_writer(['first', 'second'])
+        assert all(isinstance(result, Exception) for result in results)
+        # nothing is lost, the entries wait in the outbox
+        pending, last_error = dbops.get_outbox_status(USER1['user_id'])
+        assert pending == 2 and last_error is not None
+        # Notion is back, a new writer (e.g. after a restart) delivers them in order
+        self.server.error_rate = 0.0
+        self.run_writer(['third'], close_early=True)
+        assert self.page_texts() == ['first', 'second', 'third']
+        assert self.pending() == 0
+
+    @mock.patch.object(notion_async, 'RETRIES', 1)
+    def test_partial_failure_is_not_repeated(self):
+        # the first entry has two paragraph blocks, so the first request of 100 blocks ends
+        # after the heading of entry 49, and the second request fails
+        texts = [('x' * 1999 + ' ') * 101] + [f'message {i}' for i in range(1, 60)]
+        append = self.server._append
+        calls = []
+        def fail_second_append(page_id, body):
+            calls.append(page_id)
+            if len(calls) == 2:
+                return 503, {'object': 'error', 'status': 503, 'code': 'service_unavailable', 'message': 'Notion is unavailable.'}
+            return append(page_id, body)
+        self.server._append = fail_second_append
+        results = self.run_writer(texts)
+        # the entries of the first request are done, the others wait for a retry
+        assert not any(isinstance(result, Exception) for result in results[:49])
+        assert all(isinstance(result, Exception) for result in results[49:])
+        # closing the writer retried them, with a single request for the rest
+        assert len(calls) == 3 and self.pending() == 0
+        page = self.server.pages_in(USER1['database_id'])[0]
+        blocks = self.server.children[page['id']]
+        # every block is on the page exactly once
+        assert len(blocks) == 3 + 59 * 2 and sum(block['type'] != 'paragraph' for block in blocks) == 60
+        assert self.page_texts()[-59:] == texts[1:]
+
+    def test_deregistered_user_is_dropped(self):
+        # deregistering removes the Notion token
+        dbops.update_user(USER1['user_id'], None, None, None)
+        results = self.run_writer(['first'])
+        assert isinstance(results[0], Exception)
+        assert self.pending() == 0
+        assert self.server.requests == []
+
+    def test_other_shard_is_skipped(self):
+        # with several bot workers, the entries of a user are delivered by the worker of its shard
+        other_shard = ((USER1['user_id'] + 1) % 2, 2)
+        self.run_writer(['first'], window=60, close_early=True, shard=other_shard)
+        assert self.pending() == 1
+        assert self.server.requests == []
+        own_shard = (USER1['user_id'] % 2, 2)
+        self.run_writer([], shard=own_shard)
+        assert self.page_texts() == ['first']
+        assert self.pending() == 0
+
+    def test_chunk_blocks(self):
+        blocks = [{'paragraph': 'x' * 1000}] * 1000
+        chunks = notion.chunk_blocks(blocks)
+        assert sum(len(c) for c in chunks) == 1000
+        for chunk in chunks:
+            assert len(chunk) <= notion.NOTION_CHILDREN_LIM
+            assert len(json.dumps({'children': chunk})) <= notion.NOTION_PAYLOAD_LIM
+
+    def tearDown(self) -> None:
+        self.server.stop()
+        delete_outbox_entries()
+        dbops.delete_user(USER1['user_id'])
+        notion._weekly_page_cache.clear()
+        notion_async._page_locks.clear()
+        ratelimit._buckets.clear()
+        return super().tearDown()
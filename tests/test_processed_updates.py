@@ -0,0 +1,32 @@
+import unittest
+from datetime import datetime
+
+from verbal_diary_bot import database_operations as dbops
+
+from temporary_config import use_temporary_config
+
+
+USER_ID = 999
+OTHER_USER_ID = 998
+DATE = datetime(2024, 3, 1, 21, 30, 5)
+
+
+class TestProcessedUpdates(unittest.TestCase):
+    def setUp(self) -> None:
+        # a database of its own, the expiry deletes every entry
+        use_temporary_config(self)
+        dbops.create_checkpoint_tables()
+
+    def test_processed_updates(self):
+        assert not dbops.is_message_processed(USER_ID, 10)
+        job_id = dbops.insert_voice_job(USER_ID, USER_ID, 'file', 'voice', 'path', 1.0, DATE, 10, 100)
+        assert job_id is not None and dbops.is_message_processed(USER_ID, 10)
+        # the same message again, e.g. under another update_id, gets no job
+        assert dbops.insert_voice_job(USER_ID, USER_ID, 'file', 'voice', 'path', 1.0, DATE, 10, 101) is None
+        assert [job[0] for job in dbops.get_voice_jobs()] == [job_id]
+        # message_ids are counted per chat
+        assert not dbops.is_message_processed(OTHER_USER_ID, 10)
+        dbops.delete_voice_job(job_id)
+        assert dbops.expire_processed_updates(datetime.now().timestamp() - 60) == 0
+        assert dbops.expire_processed_updates(datetime.now().timestamp() + 60) == 1
+        assert not dbops.is_message_processed(USER_ID, 10)
@@ -0,0 +1,59 @@
+import asyncio
+import threading
+import time
+import unittest
+from types import SimpleNamespace
+from unittest import mock
+
+from verbal_diary_bot import profiler, utils
+from verbal_diary_bot.telegram_handlers import is_admin
+
+
+def busy_function(stop: threading.Event):
+    while not stop.is_set():
+        sum(range(1000))
+
+
+class TestProfiler(unittest.TestCase):
+    def test_profile(self):
+        stop = threading.Event()
+        thread = threading.Thread(target=busy_function, args=(stop,), name='busy')
+        thread.start()
+        try:
+            result = asyncio.run(profiler.profile(0.3, interval=0.01))
+        finally:
+            stop.set()
+            thread.join()
+        assert result.samples > 5
+        lines = result.collapsed().splitlines()
+        busy = [line for line in lines if line.startswith('busy;')]
+        assert busy and all('test_profiler:busy_function' in line for line in busy)
+        # every line ends with its number of samples
+        assert sum(int(line.rsplit(' ', 1)[1]) for line in lines) == sum(result.stacks.values())
+        assert 'test_profiler:busy_function' in result.summary()
+
+
+class TestAdmin(unittest.TestCase):
+    def call(self, user_id, username=None, chat_id=None):
+        handler = mock.AsyncMock(__name__='handler')
+        chat = SimpleNamespace(id=chat_id or user_id, type='private' if chat_id is None else 'group')
+        update = SimpleNamespace(effective_chat=chat, effective_user=SimpleNamespace(id=user_id, username=username))
+        context = SimpleNamespace(bot=SimpleNamespace(send_message=mock.AsyncMock()))
+        asyncio.run(is_admin(handler)(update, context))
+        return handler.called, context.bot.send_message.called
+
+    def setUp(self) -> None:
+        patcher = mock.patch.object(utils, 'get_allowed_chat_ids', return_value=([42], ['admin']))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_admin(self):
+        assert self.call(42) == (True, False)
+
+    def test_not_admin(self):
+        assert self.call(-1, 'not_an_admin_for_sure') == (False, True)
+        # neither the user name nor the chat makes someone an admin
+        assert self.call(-1, 'admin') == (False, True)
+        assert self.call(-1, chat_id=42) == (False, True)
+        # and admins only in their private chat with the bot
+        assert self.call(42, chat_id=-100) == (False, True)
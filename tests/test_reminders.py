@@ -0,0 +1,142 @@
+import asyncio
+import unittest
+from datetime import datetime, timedelta
+from types import SimpleNamespace
+from zoneinfo import ZoneInfo
+
+from telegram.error import Forbidden, RetryAfter
+
+import verbal_diary_bot as vdb
+from verbal_diary_bot import reminders
+from verbal_diary_bot import database_operations as dbops
+from verbal_diary_bot.ratelimit import TokenBucket
+from verbal_diary_bot.reminders import ReminderScheduler
+
+from fake_telegram import FakeBot
+
+
+USER1 = {'user_id': 999, 'name': 'test_name', 'notion_token': 'test_notion_token', 'database_id': '843756384563489'}
+USER2 = {'user_id': 998, 'name': 'test_name2', 'notion_token': 'test_notion_token2', 'database_id': '843756384564389'}
+BERLIN = ZoneInfo("Europe/Berlin")
+# 2024-03-12 20:00 in Berlin
+DUE = datetime(2024, 3, 12, 20, 0, tzinfo=BERLIN).timestamp()
+
+
+def sent_to(bot) -> list:
+    return [chat_id for chat_id, _ in bot.sent]
+
+
+class TestNextDue(unittest.TestCase):
+    def test_next_due(self):
+        after = datetime(2024, 3, 12, 19, 0, tzinfo=BERLIN).timestamp()
+        assert reminders.next_due('20:00', 'Europe/Berlin', after) == DUE
+        # exactly at the due time, the next one is the following day
+        assert reminders.next_due('20:00', 'Europe/Berlin', DUE) == DUE + reminders.DAY
+        assert reminders.next_due('20:00', 'America/New_York', after) == datetime(2024, 3, 12, 20, 0, tzinfo=ZoneInfo("America/New_York")).timestamp()
+
+    def test_daylight_saving_time(self):
+        # the clocks in Berlin went forward on 2024-03-31, that day has 23 hours
+        after = datetime(2024, 3, 30, 21, 0, tzinfo=BERLIN).timestamp()
+        due = reminders.next_due('20:00', 'Europe/Berlin', after)
+        assert datetime.fromtimestamp(due, BERLIN) == datetime(2024, 3, 31, 20, 0, tzinfo=BERLIN)
+        assert due - after == 22 * 60 * 60
+
+    def test_parse_preferences(self):
+        assert reminders.parse_preferences(['8:05']) == ('08:05', 'Europe/Berlin', 1)
+        assert reminders.parse_preferences(['21:30', 'America/New_York', '3']) == ('21:30', 'America/New_York', 3)
+        for args in ([], ['25:00'], ['20:00', 'Mars/Olympus'], ['20:00', 'UTC', 'two'], ['20:00', 'UTC', '0']):
+            with self.assertRaises(ValueError):
+                reminders.parse_preferences(args)
+
+
+class TestReminderScheduler(unittest.TestCase):
+    def setUp(self) -> None:
+        dbops.create_reminder_table()
+        self.tearDown()
+        for user in (USER1, USER2):
+            vdb.user.User(user['user_id'], user['name'], user['notion_token'], user['database_id'])
+            dbops.set_reminder_preferences(user['user_id'], True, '20:00', 'Europe/Berlin', 1)
+
+    def tearDown(self) -> None:
+        for user in (USER1, USER2):
+            dbops.delete_user(user['user_id'])
+            dbops.delete_reminder_preferences(user['user_id'])
+
+    def load(self, **kwargs) -> ReminderScheduler:
+        scheduler = ReminderScheduler(bucket=TokenBucket(1000, 1000), **kwargs)
+        scheduler.load(now=DUE - 60)
+        return scheduler
+
+    def tick(self, scheduler, bot, now):
+        return asyncio.run(scheduler.tick(SimpleNamespace(bot=bot), now=now))
+
+    def test_remind_inactive_users(self):
+        # the first user wrote today, the second one two days ago
+        vdb.user.User(USER1['user_id']).add_message('today', 1, 'audio', 1.0, datetime(2024, 3, 12, 9, 0, tzinfo=BERLIN))
+        vdb.user.User(USER2['user_id']).add_message('old', 1, 'audio', 1.0, datetime(2024, 3, 10, 9, 0, tzinfo=BERLIN))
+        scheduler = self.load()
+        bot = FakeBot()
+        # nothing is due yet
+        assert self.tick(scheduler, bot, DUE - 1) == 0
+        assert self.tick(scheduler, bot, DUE + 1) == 1
+        assert sent_to(bot) == [USER2['user_id']]
+        assert dbops.get_reminder_preferences(USER2['user_id'])[4] is not None
+        # both are due again the next day
+        assert sorted(scheduler.due.values()) == [DUE + reminders.DAY] * 2
+        assert self.tick(scheduler, bot, DUE + 2) == 0
+
+    def test_inactive_days(self):
+        dbops.set_reminder_preferences(USER2['user_id'], True, '20:00', 'Europe/Berlin', 3)
+        vdb.user.User(USER2['user_id']).add_message('old', 1, 'audio', 1.0, datetime(2024, 3, 10, 9, 0, tzinfo=BERLIN))
+        scheduler = self.load()
+        bot = FakeBot()
+        self.tick(scheduler, bot, DUE + 1)
+        # the user without messages is reminded, the other one wrote less than 3 days ago
+        assert sent_to(bot) == [USER1['user_id']]
+        self.tick(scheduler, bot, DUE + reminders.DAY + 1)
+        assert sorted(sent_to(bot)) == [USER2['user_id'], USER1['user_id'], USER1['user_id']]
+        # the next reminder of a 3-day preference comes 3 days later
+        for day in range(2, 5):
+            self.tick(scheduler, bot, DUE + day * reminders.DAY + 1)
+        assert sent_to(bot).count(USER2['user_id']) == 2
+
+    def test_restart(self):
+        scheduler = self.load()
+        self.tick(scheduler, FakeBot(), DUE + 1)
+        # a restart shortly after the reminder does not send it again
+        scheduler = ReminderScheduler(bucket=TokenBucket(1000, 1000))
+        scheduler.load(now=DUE + 120)
+        assert sorted(scheduler.due.values()) == [DUE + reminders.DAY] * 2
+        # but sends it if it was missed
+        dbops.set_reminders_sent([USER1['user_id'], USER2['user_id']], DUE - reminders.DAY)
+        scheduler = ReminderScheduler(bucket=TokenBucket(1000, 1000))
+        scheduler.load(now=DUE + 120)
+        assert sorted(scheduler.due.values()) == [DUE] * 2
+
+    def test_changed_preferences(self):
+        scheduler = self.load()
+        scheduler.schedule(USER1['user_id'], '21:00', 'Europe/Berlin', 1, after=DUE - 60)
+        scheduler.remove(USER2['user_id'])
+        bot = FakeBot()
+        assert self.tick(scheduler, bot, DUE + 1) == 0
+        assert self.tick(scheduler, bot, DUE + 3601) == 1
+        assert sent_to(bot) == [USER1['user_id']]
+        assert len(scheduler) == 1
+
+    def test_batches(self):
+        scheduler = self.load(max_batch=1)
+        bot = FakeBot()
+        assert self.tick(scheduler, bot, DUE + 1) == 1
+        assert self.tick(scheduler, bot, DUE + 2) == 1
+        assert sorted(sent_to(bot)) == [USER2['user_id'], USER1['user_id']]
+
+    def test_telegram_errors(self):
+        scheduler = self.load()
+        # the back-off of Telegram is respected and the message is sent again
+        bot = FakeBot({None: [RetryAfter(timedelta(seconds=0.1))]})
+        assert self.tick(scheduler, bot, DUE + 1) == 2
+        # a user who blocked the bot is not reminded anymore
+        bot = FakeBot({None: [Forbidden("Forbidden: bot was blocked by the user")]})
+        assert self.tick(scheduler, bot, DUE + reminders.DAY + 1) == 1
+        assert len(scheduler) == 1
+        assert [reminder[0] for reminder in dbops.get_enabled_reminders() if reminder[0] in (USER1['user_id'], USER2['user_id'])] == [sent_to(bot)[0]]
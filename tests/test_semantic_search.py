@@ -0,0 +1,148 @@
+import asyncio
+import tempfile
+import unittest
+from datetime import datetime
+from pathlib import Path
+from types import SimpleNamespace
+from unittest import mock
+from zoneinfo import ZoneInfo
+
+import numpy as np
+
+import verbal_diary_bot as vdb
+from verbal_diary_bot import main_bot, semantic_search
+from verbal_diary_bot import database_operations as dbops
+from verbal_diary_bot.semantic_search import HashingEmbedder, OpenAIEmbedder, VectorIndex
+
+from fake_openai import FakeOpenAIServer
+from fake_telegram import FakeBot
+from temporary_config import use_temporary_config, write_config
+
+
+USER_ID = 999
+BERLIN = ZoneInfo("Europe/Berlin")
+ENTRIES = [
+    (datetime(2024, 3, 1, 21, 0, tzinfo=BERLIN), "Today my boss praised the project at my job, work was great."),
+    (datetime(2024, 3, 2, 20, 0, tzinfo=BERLIN), "We went hiking in the mountains and had a picnic by the lake."),
+    (datetime(2024, 3, 3, 22, 0, tzinfo=BERLIN), "I cooked pasta for dinner with friends."),
+    (datetime(2024, 3, 5, 21, 30, tzinfo=BERLIN), "Thinking about changing jobs, the work at the office is boring."),
+]
+
+
+class TestHashingEmbedder(unittest.TestCase):
+    def test_embed(self):
+        embedder = HashingEmbedder(256)
+        vectors = embedder.embed([text for _, text in ENTRIES] + ["", "the and of"])
+        assert vectors.shape == (6, 256) and vectors.dtype == np.float32
+        assert np.allclose(np.linalg.norm(vectors[:4], axis=1), 1)
+        # no words (or only stop words), no direction
+        assert not vectors[4].any() and not vectors[5].any()
+        # stable across processes
+        assert np.array_equal(embedder.embed([ENTRIES[0][1]]), vectors[:1])
+        query = embedder.embed(["when did I last talk about my job?"])[0]
+        scores = vectors[:4] @ query
+        assert set(np.argsort(-scores)[:2]) == {0, 3}
+
+
+class TestVectorIndex(unittest.TestCase):
+    def setUp(self) -> None:
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.index = VectorIndex(Path(self.tmp_dir.name), HashingEmbedder(256))
+
+    def tearDown(self) -> None:
+        self.tmp_dir.cleanup()
+
+    def test_search(self):
+        assert self.index.search(USER_ID, "job") == []
+        self.index.add(USER_ID, [10, 11], [ENTRIES[0][1], ENTRIES[1][1]])
+        self.index.add(USER_ID, [12, 13], [ENTRIES[2][1], ENTRIES[3][1]])
+        self.index.add(USER_ID + 1, [14], ["My job at the office"])
+        assert [message_id for message_id, _ in self.index.search(USER_ID, "hiking at the lake", k=2)] == [11]
+        results = self.index.search(USER_ID, "work job office", k=2)
+        assert [message_id for message_id, _ in results] == [13, 10] and results[0][1] > results[1][1]
+        # messages without anything in common are no matches
+        assert self.index.search(USER_ID, "xylophone") == []
+        message_ids, vectors = self.index.load(USER_ID)
+        assert message_ids.tolist() == [10, 11, 12, 13] and isinstance(vectors, np.memmap)
+        self.index.delete(USER_ID)
+        assert self.index.search(USER_ID, "hiking") == []
+        assert self.index.indexed_ids(USER_ID + 1) == {14}
+
+    def test_interrupted_append(self):
+        self.index.add(USER_ID, [10], [ENTRIES[0][1]])
+        vectors_path, ids_path = self.index.files(USER_ID)
+        # a crash after writing the vector, and part of the next one
+        with open(vectors_path, 'ab') as file:
+            file.write(b'\0' * (4 * 256 + 10))
+        assert self.index.load(USER_ID)[0].tolist() == [10]
+        self.index.add(USER_ID, [11], [ENTRIES[1][1]])
+        assert self.index.load(USER_ID)[0].tolist() == [10, 11]
+        assert self.index.search(USER_ID, "hiking mountains", k=1)[0][0] == 11
+
+
+class TestAsk(unittest.TestCase):
+    def setUp(self) -> None:
+        self.openai = FakeOpenAIServer().start()
+        self.path, self.config = use_temporary_config(self, openai={'token': 'sk-test', 'base_url': f'{self.openai.base_url}/v1'})
+        self.write_config()
+        dbops.create_tables()
+        dbops.create_reminder_table()
+        dbops.create_checkpoint_tables()
+        dbops.create_outbox_table()
+        dbops.create_notion_mirror_tables()
+        self.user = vdb.user.User(USER_ID, 'test_name')
+        self.message_ids = []
+        for date, text in ENTRIES:
+            self.message_ids.append(self.user.add_message(text, len(text.split()), 'audio', 10.0, date))
+
+    def tearDown(self) -> None:
+        self.openai.stop()
+
+    def write_config(self, **search_config):
+        self.config['semantic_search'] = search_config
+        write_config(self.path, self.config)
+
+    def test_backfill_and_answer(self):
+        assert semantic_search.answer(USER_ID, "when did I last talk about my job?") is None
+        assert semantic_search.backfill() == 4
+        assert semantic_search.backfill() == 0
+        results = semantic_search.search(USER_ID, "when did I last talk about my job?", k=2)
+        assert {message[0] for _, message in results} == {self.message_ids[0], self.message_ids[3]}
+        answer = semantic_search.answer(USER_ID, "when did I last talk about my job?")
+        # the chat model gets the matching entries in chronological order, with their dates
+        assert answer.startswith("Answer to: Diary entries:\n[2024-03-01 21:00] Today my boss")
+        assert "[2024-03-05 21:30] Thinking about changing jobs" in answer
+        assert answer.endswith("Question: when did I last talk about my job?")
+        assert self.openai.calls['chat_completions'] == 1
+        # deregistered users cannot be searched anymore
+        vdb.user.anonymize_user_from_database(USER_ID)
+        assert semantic_search.search(USER_ID, "job") == []
+
+    def test_index_message(self):
+        message_id = self.user.add_message("Finally got the new job offer!", 6, 'audio', 5.0)
+        semantic_search.index_message(USER_ID, message_id, "Finally got the new job offer!")
+        assert semantic_search.search(USER_ID, "job offer")[0][1][0] == message_id
+
+    def test_openai_embedder(self):
+        self.write_config(embedder='openai', dimension=16)
+        index = semantic_search.get_index()
+        assert isinstance(index.embedder, OpenAIEmbedder) and index.path.name == 'openai-text-embedding-3-small-16'
+        assert semantic_search.backfill() == 4
+        assert self.openai.calls['embeddings'] == 1
+        assert semantic_search.search(USER_ID, "pasta dinner", k=1)[0][1][0] == self.message_ids[2]
+
+    def ask(self, question):
+        bot = FakeBot()
+        update = SimpleNamespace(effective_chat=SimpleNamespace(id=USER_ID), effective_user=SimpleNamespace(id=USER_ID))
+        asyncio.run(main_bot.ask(update, SimpleNamespace(bot=bot, args=question.split())))
+        return [text for _, text in bot.sent]
+
+    def test_ask_errors(self):
+        semantic_search.backfill()
+        # the chat model is down, the matching entries are sent instead
+        with mock.patch.object(semantic_search.openai_api.OpenAiCLient, 'chat_completion', side_effect=ConnectionError("down")):
+            replies = self.ask("my job")
+        assert replies[0].startswith("Sorry, I could not answer that right now.") and "Today my boss" in replies[0]
+        # the search fails as well, e.g. the OpenAI embedder is down
+        with mock.patch.object(semantic_search, 'search', side_effect=ConnectionError("down")):
+            assert self.ask("my job") == ["Sorry, I could not search your diary right now. Please try again later."]
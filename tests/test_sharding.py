@@ -0,0 +1,72 @@
+import asyncio
+import os
+import time
+import unittest
+
+from telegram.ext import ApplicationBuilder, MessageHandler, filters
+
+from verbal_diary_bot import sharding
+from verbal_diary_bot import database_operations as dbops
+
+from fake_telegram import FakeTelegramServer
+
+
+TOKEN = '123456:sharding-test'
+
+
+async def reply(update, context):
+    await context.bot.send_message(chat_id=update.effective_chat.id, text=f"{os.getpid()} {context.bot_data['shard'][0]} {update.message.text}")
+
+
+def build_test_application(token, base_url):
+    """Application of a worker, called in the worker process."""
+    application = ApplicationBuilder().token(token).base_url(base_url).build()
+    application.add_handler(MessageHandler(filters.TEXT, reply))
+    return application
+
+
+class TestSharding(unittest.TestCase):
+    def test_get_user_id(self):
+        message = {'message_id': 1, 'chat': {'id': -5}, 'from': {'id': 42}}
+        assert sharding.get_user_id({'update_id': 1, 'message': message}) == 42
+        assert sharding.get_user_id({'update_id': 1, 'callback_query': {'id': '1', 'from': {'id': 43}, 'message': message}}) == 43
+        assert sharding.get_user_id({'update_id': 1, 'channel_post': {'message_id': 1, 'chat': {'id': -7}}}) == -7
+        assert sharding.get_user_id({'update_id': 1}) is None
+        assert sharding.in_shard(42, (42 % 3, 3)) and not sharding.in_shard(43, (42 % 3, 3))
+        assert sharding.in_shard(43, None)
+
+    def test_workers(self):
+        workers, users, messages = 3, 6, 4
+        with FakeTelegramServer() as telegram:
+            async def run():
+                stop = asyncio.Event()
+                task = asyncio.create_task(sharding.serve_sharded(
+                    workers, build_application=build_test_application,
+                    build_kwargs={'token': TOKEN, 'base_url': f'{telegram.base_url}/bot'}, stop=stop,
+                ))
+                for i in range(messages):
+                    for user_id in range(users):
+                        telegram.send_text(user_id, f'message {i}')
+                deadline = time.monotonic() + 60
+                while sum(len(replies) for replies in telegram.replies.values()) < users * messages:
+                    assert time.monotonic() < deadline, 'not all updates were handled'
+                    await asyncio.sleep(0.1)
+                stop.set()
+                await task
+            asyncio.run(run())
+
+            pids = set()
+            for user_id in range(users):
+                replies = [text.split(' ', 2) for _, text in telegram.replies[user_id]]
+                # one worker per user, the one of its shard, and the messages in order
+                assert len({pid for pid, _, _ in replies}) == 1
+                assert all(int(shard) == user_id % workers for _, shard, _ in replies)
+                assert [text for _, _, text in replies] == [f'message {i}' for i in range(messages)]
+                pids.add(replies[0][0])
+            assert len(pids) == workers
+
+    def test_wal(self):
+        dbops.enable_wal()
+        conn = dbops.connect_db()
+        assert conn.execute('PRAGMA journal_mode').fetchone()[0] == 'wal'
+        conn.close()
@@ -0,0 +1,158 @@
+import json
+import os
+import signal
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import time
+import unittest
+from pathlib import Path
+
+from fake_notion import FakeNotionServer
+from fake_openai import FakeOpenAIServer
+from fake_telegram import FakeTelegramServer
+
+
+REPO_PATH = Path(__file__).resolve().parents[1]
+USER_ID = 999
+
+
+class TestGracefulShutdown(unittest.TestCase):
+    """Runs the real bot in a subprocess against the fake servers and sends it SIGTERM mid-pipeline."""
+
+    def setUp(self) -> None:
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.path = Path(self.tmp_dir.name)
+        self.telegram = FakeTelegramServer().start()
+        self.openai = FakeOpenAIServer(latency=2.0).start()
+        self.notion = FakeNotionServer().start()
+        self.bot = None
+
+    def write_config(self, deadline):
+        config = json.loads((REPO_PATH / 'configs.json').read_text())
+        config['telegram'].update({'token': '123456:shutdown-test', 'base_url': f'{self.telegram.base_url}/bot', 'base_file_url': f'{self.telegram.base_url}/file/bot'})
+        config.pop('metrics', None)
+        config.pop('watchdog', None)
+        config['telegram'].pop('webhook', None)
+        config['telegram'].pop('workers', None)
+        config['save_paths'] = {'voice_messages': str(self.path / 'voice_messages'), 'db_path': str(self.path / 'db.sqlite')}
+        config['openai'] = {'token': 'sk-test', 'base_url': f'{self.openai.base_url}/v1'}
+        config['notion']['base_url'] = self.notion.base_url
+        config['shutdown'] = {'deadline': deadline}
+        (self.path / 'configs.json').write_text(json.dumps(config))
+        if not (self.path / 'db.sqlite').exists():
+            conn = sqlite3.connect(self.path / 'db.sqlite')
+            conn.execute(f'CREATE TABLE Users ({", ".join(config["database"]["Users_fields"])})')
+            conn.execute(f'CREATE TABLE Messages ({", ".join(config["database"]["Messages_fields"])})')
+            conn.execute('INSERT INTO Users VALUES (?, ?, ?, ?)', (USER_ID, 'test_name', 'test_notion_token', '843756384563489'))
+            conn.commit()
+            conn.close()
+
+    def start_bot(self, deadline):
+        self.write_config(deadline)
+        env = dict(os.environ, PYTHONPATH=str(REPO_PATH / 'src'))
+        self.log = open(self.path / 'bot.log', 'ab')
+        self.bot = subprocess.Popen([sys.executable, '-m', 'verbal_diary_bot.main_bot'], cwd=self.path, env=env, stdout=self.log, stderr=subprocess.STDOUT)
+
+    def stop_bot(self, timeout=60):
+        self.bot.send_signal(signal.SIGTERM)
+        self.bot.wait(timeout)
+        self.log.close()
+        return self.bot.returncode
+
+    def wait_until(self, condition, timeout=30):
+        deadline = time.monotonic() + timeout
+        while not condition():
+            assert self.bot.poll() is None, (self.path / 'bot.log').read_text()
+            assert time.monotonic() < deadline, (self.path / 'bot.log').read_text()
+            time.sleep(0.05)
+
+    def replies(self):
+        return [text for _, text in self.telegram.replies_in(USER_ID)]
+
+    def replied(self, transcript):
+        # the transcript is shown in the status message of the voice message
+        return any(transcript in text for text in self.replies())
+
+    def notion_blocks(self):
+        return sum(len(self.notion.children[page['id']]) for page in self.notion.pages_in('843756384563489'))
+
+    def query(self, sql):
+        conn = sqlite3.connect(self.path / 'db.sqlite')
+        rows = conn.execute(sql).fetchall()
+        conn.close()
+        return rows
+
+    def send_two_voice_messages(self):
+        self.telegram.send_voice(USER_ID, 'first')
+        self.telegram.send_voice(USER_ID, 'second')
+        # the first one is being transcribed, the second one waits in the queue
+        self.wait_until(lambda: self.openai.calls.get('transcriptions', 0) == 1)
+
+    def test_drain(self):
+        self.start_bot(deadline=30)
+        self.send_two_voice_messages()
+        assert self.stop_bot() == 0
+        # both voice messages were handled before the bot stopped
+        assert self.replied('Transcription of first.ogg') and self.replied('Transcription of second.ogg')
+        assert len(self.query('SELECT * FROM Messages')) == 2
+        assert len(self.query('SELECT * FROM TranscriptIndex')) == 2
+        assert self.query('SELECT * FROM VoiceJobs') == []
+        assert self.query('SELECT * FROM PendingUpdates') == []
+        # the outbox was flushed to Notion
+        assert self.query('SELECT * FROM NotionOutbox') == []
+        assert len(self.notion.pages_in('843756384563489')) == 1
+
+    def test_checkpoint(self):
+        self.start_bot(deadline=0.5)
+        self.send_two_voice_messages()
+        assert self.stop_bot() == 0
+        # the deadline is too short: the running job and the queued update are checkpointed
+        assert not self.replied('Transcription of first.ogg')
+        assert len(self.query('SELECT * FROM VoiceJobs')) == 1
+        assert len(self.query('SELECT * FROM PendingUpdates')) == 1
+        assert self.query('SELECT * FROM Messages') == []
+
+        # after the restart, both are finished, in the order they were sent
+        self.openai.latency = 0
+        self.start_bot(deadline=30)
+        self.wait_until(lambda: self.replied('Transcription of first.ogg') and self.replied('Transcription of second.ogg'))
+        assert self.stop_bot() == 0
+        replies = self.replies()
+        first = next(i for i, text in enumerate(replies) if 'Transcription of first.ogg' in text)
+        second = next(i for i, text in enumerate(replies) if 'Transcription of second.ogg' in text)
+        assert first < second
+        assert self.query('SELECT message FROM Messages ORDER BY message_id') == [('Transcription of first.ogg',), ('Transcription of second.ogg',)]
+        assert self.query('SELECT * FROM VoiceJobs') == []
+        assert self.query('SELECT * FROM PendingUpdates') == []
+
+    def test_replayed_updates(self):
+        self.start_bot(deadline=30)
+        self.openai.latency = 0
+        updates = [self.telegram.send_voice(USER_ID, 'first'), self.telegram.send_voice(USER_ID, 'second')]
+        self.wait_until(lambda: self.replied('Transcription of first.ogg') and self.replied('Transcription of second.ogg'))
+        assert self.stop_bot() == 0
+        appended = self.notion_blocks()
+
+        # after the restart, the same messages are delivered again, one of them twice in the batch
+        self.start_bot(deadline=30)
+        for update in updates + updates[:1]:
+            self.telegram.add_update({'update_id': len(self.telegram.updates) + 1, 'message': update['message']})
+        self.wait_until(lambda: self.telegram.confirmed > len(self.telegram.updates))
+        assert self.stop_bot() == 0
+        assert self.openai.calls['transcriptions'] == 2
+        assert self.notion_blocks() == appended > 0
+        assert len(self.query('SELECT * FROM Messages')) == 2
+        assert len(self.query('SELECT * FROM ProcessedUpdates')) == 2
+        assert 'Skipping update' in (self.path / 'bot.log').read_text()
+
+    def tearDown(self) -> None:
+        if self.bot is not None and self.bot.poll() is None:
+            self.bot.kill()
+            self.bot.wait()
+        self.telegram.stop()
+        self.openai.stop()
+        self.notion.stop()
+        self.tmp_dir.cleanup()
+        return super().tearDown()
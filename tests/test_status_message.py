@@ -0,0 +1,70 @@
+import asyncio
+import time
+import unittest
+
+from telegram.error import BadRequest, NetworkError
+
+from verbal_diary_bot.status_message import StatusMessage, TRANSCRIPT_PREVIEW
+
+from fake_telegram import FakeBot
+
+
+CHAT_ID = 999
+
+
+class TestStatusMessage(unittest.TestCase):
+    def test_coalesce(self):
+        async def run():
+            bot = FakeBot()
+            status = StatusMessage(bot, CHAT_ID, min_interval=0.2)
+            status.set_stage("received")
+            await asyncio.sleep(0.05)
+            # a quick transcription replaces the "received" stage before anything is sent
+            await status.set_transcript("hello world")
+            status.set_stage("appending")
+            await status.wait()
+            assert bot.calls == [('send', CHAT_ID, "hello world\n\nappending")]
+            status.set_stage("appended")
+            status.add_note("stats")
+            started = time.monotonic()
+            await status.wait()
+            # the edit waited for the minimum interval
+            assert time.monotonic() - started > 0.1
+            assert bot.calls[1:] == [('edit', CHAT_ID, "hello world\n\nappended\n\nstats")]
+            # nothing changed, nothing is sent
+            status.set_stage("appended")
+            await status.wait()
+            assert len(bot.calls) == 2
+        asyncio.run(run())
+
+    def test_long_transcript(self):
+        async def run():
+            bot = FakeBot()
+            status = StatusMessage(bot, CHAT_ID, min_interval=0)
+            text = "word " * 2000
+            await status.set_transcript(text)
+            await status.wait()
+            assert [call[0] for call in bot.calls] == ['document', 'send']
+            assert bot.calls[0][3] == text.encode()
+            assert bot.calls[1][2].startswith(text[:TRANSCRIPT_PREVIEW]) and bot.calls[0][2] in bot.calls[1][2]
+            # a note that does not fit is not added
+            assert not status.add_note("x" * 4096)
+        asyncio.run(run())
+
+    def test_errors(self):
+        async def run():
+            bot = FakeBot()
+            status = StatusMessage(bot, CHAT_ID, min_interval=0)
+            status.set_stage("received")
+            await status.wait()
+            # the next edits fail
+            bot.errors[CHAT_ID] = [BadRequest("Message is not modified"), NetworkError("timeout")]
+            status.set_stage("received ")
+            await status.wait()
+            # the edit is treated as sent
+            assert status.sent_text == "received "
+            # a failed edit is retried once by `wait`
+            status.set_stage("done")
+            await status.wait()
+            assert status.sent_text == "done" and bot.calls == [('send', CHAT_ID, "received"), ('edit', CHAT_ID, "done")]
+        asyncio.run(run())
@@ -0,0 +1,143 @@
+import os
+import tempfile
+import unittest
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from pathlib import Path
+from zoneinfo import ZoneInfo
+
+from verbal_diary_bot import storage, utils
+from verbal_diary_bot.storage import SQLiteStorage, PostgresStorage
+
+
+USER1 = {'user_id': 999, 'name': 'test_name', 'notion_token': 'test_notion_token', 'database_id': '843756384563489'}
+USER2 = {'user_id': 998, 'name': 'test_name2', 'notion_token': 'test_notion_token2', 'database_id': '003756384564389'}
+# a real Telegram id does not fit into 32 bits
+BIG_USER_ID = 7_123_456_789
+DATE = datetime(2024, 3, 1, 21, 30, 5, tzinfo=ZoneInfo("Europe/Berlin"))
+# the PostgreSQL tests run in their own schema, set TEST_POSTGRES_DSN for another server
+POSTGRES_DSN = os.environ.get('TEST_POSTGRES_DSN', 'postgresql://postgres@localhost:5432/postgres')
+POSTGRES_SCHEMA = 'verbal_diary_bot_test'
+
+
+class StorageConformance:
+    """Tests every storage backend has to pass. `make_storage` returns a backend with empty tables."""
+
+    def make_storage(self) -> storage.Storage:
+        raise NotImplementedError
+
+    def setUp(self) -> None:
+        self.storage = self.make_storage()
+        self.storage.create_tables()
+        # creating them again does nothing
+        self.storage.create_tables()
+
+    def tearDown(self) -> None:
+        self.storage.close()
+
+    def insert_users(self):
+        for user in (USER1, USER2):
+            self.storage.insert_user(user['user_id'], user['name'], user['notion_token'], user['database_id'])
+
+    def test_users(self):
+        assert self.storage.get_user(USER1['user_id']) is None
+        assert not self.storage.user_exists(USER1['user_id'])
+        self.insert_users()
+        assert self.storage.user_exists(USER1['user_id'])
+        assert self.storage.get_user(USER1['user_id']) == (USER1['user_id'], USER1['name'], USER1['notion_token'], USER1['database_id'])
+        assert [user[0] for user in self.storage.get_all_users()] == [USER2['user_id'], USER1['user_id']]
+        self.storage.update_user(USER1['user_id'], USER2['name'], USER2['notion_token'], USER2['database_id'])
+        assert self.storage.get_user(USER1['user_id']) == (USER1['user_id'], USER2['name'], USER2['notion_token'], USER2['database_id'])
+        self.storage.insert_user(BIG_USER_ID, 'big', None, None)
+        assert self.storage.get_user(BIG_USER_ID) == (BIG_USER_ID, 'big', None, None)
+        assert self.storage.count_users() == 3
+        # pages of user_ids in ascending order
+        assert self.storage.get_user_ids(None, 2) == [USER2['user_id'], USER1['user_id']]
+        assert self.storage.get_user_ids(USER1['user_id'], 2) == [BIG_USER_ID]
+        assert self.storage.get_user_ids(BIG_USER_ID, 2) == []
+
+    def test_messages(self):
+        self.insert_users()
+        first = self.storage.insert_message(USER1['user_id'], DATE, 'first message', 2, 'voice', 1.5)
+        second = self.storage.insert_message(USER2['user_id'], DATE + timedelta(minutes=2), 'other user', 2, 'audio', 12.25)
+        third = self.storage.insert_message(USER1['user_id'], DATE + timedelta(days=1), 'second message', 2, 'voice', 3.0)
+        assert first < second < third
+        assert self.storage.get_message(first) == (first, USER1['user_id'], '2024-03-01 21:30:05 +0100', 'first message', 2, 'voice', 1.5)
+        assert self.storage.get_message(third + 1000) is None
+        assert [message[0] for message in self.storage.get_messages_by_user(USER1['user_id'])] == [first, third]
+        assert [message[0] for message in self.storage.get_all_messages()] == [first, second, third]
+        assert self.storage.get_messages_by_user(BIG_USER_ID) == []
+        assert self.storage.get_message_stats_by_user(USER1['user_id']) == [('2024-03-01 21:30:05 +0100', 2, 1.5), ('2024-03-02 21:30:05 +0100', 2, 3.0)]
+        assert self.storage.get_last_message_dates([USER1['user_id'], USER2['user_id'], BIG_USER_ID]) == {USER1['user_id']: '2024-03-02 21:30:05 +0100', USER2['user_id']: '2024-03-01 21:32:05 +0100'}
+        assert self.storage.get_last_message_dates([]) == {}
+
+    def test_delete_user(self):
+        self.insert_users()
+        self.storage.insert_message(USER1['user_id'], DATE, 'message', 1, 'voice', 1.0)
+        other = self.storage.insert_message(USER2['user_id'], DATE, 'message', 1, 'voice', 1.0)
+        self.storage.delete_user(USER1['user_id'])
+        assert not self.storage.user_exists(USER1['user_id'])
+        assert self.storage.get_messages_by_user(USER1['user_id']) == []
+        assert [message[0] for message in self.storage.get_all_messages()] == [other]
+        assert self.storage.user_exists(USER2['user_id'])
+
+    def test_anonymize_user(self):
+        self.insert_users()
+        message_id = self.storage.insert_message(USER1['user_id'], DATE, 'secret', 1, 'voice', 4.0)
+        self.storage.anonymize_user(USER1['user_id'])
+        assert not self.storage.user_exists(USER1['user_id'])
+        assert self.storage.get_messages_by_user(USER1['user_id']) == []
+        anonymous = [user for user in self.storage.get_all_users() if user[0] != USER2['user_id']]
+        assert len(anonymous) == 1 and anonymous[0][1:] == (None, None, None)
+        assert str(anonymous[0][0]).startswith('999')
+        # the statistics of the message are kept, the text is not
+        assert self.storage.get_message(message_id)[1:] == (anonymous[0][0], '2024-03-01 21:30:05 +0100', None, 1, 'voice', 4.0)
+
+    def test_concurrent_writers(self):
+        self.insert_users()
+        with ThreadPoolExecutor(8) as executor:
+            message_ids = list(executor.map(
+                lambda i: self.storage.insert_message(USER1['user_id'], DATE, f'message {i}', 2, 'voice', 1.0), range(64)
+            ))
+        assert len(set(message_ids)) == 64
+        assert sorted(message[3] for message in self.storage.get_messages_by_user(USER1['user_id'])) == sorted(f'message {i}' for i in range(64))
+
+
+class TestSQLiteStorage(StorageConformance, unittest.TestCase):
+    def make_storage(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp_dir.cleanup)
+        return SQLiteStorage(str(Path(self.tmp_dir.name) / 'db.sqlite'))
+
+
+class TestPostgresStorage(StorageConformance, unittest.TestCase):
+    @classmethod
+    def setUpClass(cls) -> None:
+        try:
+            import psycopg
+            cls.admin = psycopg.connect(POSTGRES_DSN, autocommit=True, connect_timeout=2)
+        except Exception as e:
+            raise unittest.SkipTest(f"PostgreSQL is not available: {e}")
+
+    @classmethod
+    def tearDownClass(cls) -> None:
+        cls.admin.execute(f'DROP SCHEMA IF EXISTS {POSTGRES_SCHEMA} CASCADE')
+        cls.admin.close()
+
+    def make_storage(self):
+        self.admin.execute(f'DROP SCHEMA IF EXISTS {POSTGRES_SCHEMA} CASCADE')
+        self.admin.execute(f'CREATE SCHEMA {POSTGRES_SCHEMA}')
+        separator = '&' if '?' in POSTGRES_DSN else '?'
+        return PostgresStorage(f'{POSTGRES_DSN}{separator}options=-csearch_path%3D{POSTGRES_SCHEMA}', max_size=4)
+
+
+class TestGetStorage(unittest.TestCase):
+    def test_configured_backend(self):
+        backend = storage.get_storage()
+        assert isinstance(backend, SQLiteStorage) and backend.path == utils.get_db_path()
+        # one instance (and so one connection pool) per config
+        assert storage.get_storage() is backend
+
+    def test_unknown_backend(self):
+        with self.assertRaises(ValueError):
+            storage.create_storage({'backend': 'mysql'})
@@ -0,0 +1,106 @@
+import tempfile
+import unittest
+from datetime import datetime
+from pathlib import Path
+from zoneinfo import ZoneInfo
+
+from verbal_diary_bot import transcript_archive
+from verbal_diary_bot import database_operations as dbops
+from verbal_diary_bot.transcript_archive import TranscriptArchive
+
+
+DATE = datetime(2024, 3, 1, 21, 30, 5, tzinfo=ZoneInfo("Europe/Berlin"))
+TEXT = 'Today I went to the park and thought about what to do next week. ' * 20
+
+
+def delete_index_entries():
+    conn = dbops.connect_db()
+    conn.execute("DELETE FROM TranscriptIndex WHERE file_id LIKE 'test-archive-%'")
+    conn.commit()
+    conn.close()
+
+
+class TestTranscriptArchive(unittest.TestCase):
+    def setUp(self) -> None:
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.path = Path(self.tmp_dir.name) / 'transcripts'
+        self.archive = TranscriptArchive(self.path, segment_size=256)
+        delete_index_entries()
+
+    def tearDown(self) -> None:
+        self.archive.close()
+        delete_index_entries()
+        self.tmp_dir.cleanup()
+
+    def append(self, count, archive=None):
+        for i in range(count):
+            (archive or self.archive).append(f'test-archive-{i}', 999, DATE, f'{i}: {TEXT}')
+
+    def test_append_and_get(self):
+        self.append(20)
+        record = self.archive.get('test-archive-7')
+        assert record == {'file_id': 'test-archive-7', 'user_id': 999, 'date': '2024-03-01 21:30:05 +0100', 'text': f'7: {TEXT}'}
+        assert self.archive.get('test-archive-unknown') is None
+        # the records are compressed and spread over segments
+        segments = self.archive.segments()
+        assert len(segments) > 1
+        assert sum(segment.stat().st_size for segment in segments) < 20 * len(TEXT) / 5
+
+    def test_replay(self):
+        self.append(20)
+        assert [record['file_id'] for record in self.archive.replay()] == [f'test-archive-{i}' for i in range(20)]
+
+    def test_reopen(self):
+        self.append(1)
+        self.archive.close()
+        # the next process continues the last segment
+        archive = TranscriptArchive(self.path, segment_size=256)
+        archive.append('test-archive-1', 999, DATE, 'second')
+        archive.close()
+        assert len(self.archive.segments()) == 1
+        # a partially written record ends the replay of its segment, the writer starts a new one
+        with open(self.archive.segments()[0], 'ab') as file:
+            file.write(transcript_archive.encode_record('test-archive-2', 999, 'date', 'lost')[:10])
+        archive = TranscriptArchive(self.path, segment_size=256)
+        archive.append('test-archive-3', 999, DATE, 'third')
+        archive.close()
+        assert len(self.archive.segments()) == 2
+        assert [record['text'] for record in self.archive.replay()] == [f'0: {TEXT}', 'second', 'third']
+        assert self.archive.get('test-archive-3')['text'] == 'third'
+
+    def test_writers(self):
+        other = TranscriptArchive(self.path, writer='1', segment_size=256)
+        self.append(1)
+        other.append('test-archive-1', 998, DATE, 'from another worker')
+        other.close()
+        assert [segment.name for segment in self.archive.segments()] == ['segment-0-000001.log', 'segment-1-000001.log']
+        assert self.archive.get('test-archive-1')['user_id'] == 998
+
+    def test_migrate(self):
+        voice_messages = Path(self.tmp_dir.name) / 'voice_messages'
+        voice_messages.mkdir()
+        for i in range(5):
+            (voice_messages / f'test-archive-{i}.txt').write_text(f'transcription {i}')
+        (voice_messages / 'test-archive-0.ogg').write_bytes(b'audio')
+        assert transcript_archive.migrate(voice_messages, self.archive, batch_size=2) == 5
+        # running it again does not archive them twice
+        assert transcript_archive.migrate(voice_messages, self.archive, delete=True) == 0
+        assert [path.name for path in voice_messages.iterdir()] == ['test-archive-0.ogg']
+        assert [record['text'] for record in self.archive.replay()] == [f'transcription {i}' for i in range(5)]
+        assert self.archive.get('test-archive-3')['user_id'] is None
+
+    def test_purge_user(self):
+        self.append(4)
+        self.archive.append('test-archive-other', 998, DATE, 'kept')
+        # entries of older versions have no user_id yet
+        conn = dbops.connect_db()
+        conn.execute("UPDATE TranscriptIndex SET user_id = NULL WHERE file_id IN ('test-archive-1', 'test-archive-other')")
+        conn.commit()
+        conn.close()
+        assert sorted(self.archive.purge_user(999)) == [f'test-archive-{i}' for i in range(4)]
+        assert self.archive.get('test-archive-1') is None
+        assert [record['text'] for record in self.archive.replay()] == ['kept']
+        # the segments stay intact, the writer continues them
+        self.append(1)
+        assert [record['text'] for record in self.archive.replay()] == ['kept', f'0: {TEXT}']
+        assert self.archive.purge_user(999) == ['test-archive-0'] and self.archive.purge_user(999) == []
@@ -0,0 +1,48 @@
+import asyncio
+import time
+import unittest
+
+from verbal_diary_bot import metrics
+from verbal_diary_bot.watchdog import LoopWatchdog
+
+
+async def blocking_handler():
+    # like a synchronous API call inside a handler
+    time.sleep(0.3)
+
+
+async def friendly_handler():
+    await asyncio.sleep(0.3)
+
+
+class TestWatchdog(unittest.TestCase):
+    def setUp(self) -> None:
+        metrics.reset()
+
+    def run_with_watchdog(self, handler):
+        async def run():
+            watchdog = LoopWatchdog(threshold=0.1, interval=0.02)
+            watchdog.start()
+            await asyncio.sleep(0.05)
+            await asyncio.create_task(handler())
+            await asyncio.sleep(0.05)
+            await watchdog.close()
+            return watchdog
+        return asyncio.run(run())
+
+    def test_stall_is_reported(self):
+        watchdog = self.run_with_watchdog(blocking_handler)
+        assert len(watchdog.stalls) == 1
+        stall = watchdog.stalls[0]
+        assert stall['handler'] == 'blocking_handler'
+        assert 'time.sleep(0.3)' in stall['stack']
+        assert metrics.get_count('event_loop_stalls_total', handler='blocking_handler') == 1
+        assert metrics.get_count('event_loop_lag_seconds') > 0
+
+    def test_no_stall(self):
+        watchdog = self.run_with_watchdog(friendly_handler)
+        assert len(watchdog.stalls) == 0
+
+    def tearDown(self) -> None:
+        metrics.reset()
+        return super().tearDown()
@@ -0,0 +1,169 @@
+import asyncio
+import http.client
+import json
+import socket
+import time
+import unittest
+
+from telegram.ext import ApplicationBuilder, MessageHandler, filters
+
+from verbal_diary_bot.webhook import PerChatUpdateProcessor, WebhookServer, serve_webhook
+
+from fake_telegram import FakeTelegramServer
+
+
+TOKEN = '123456:webhook-test'
+SECRET = 'secret-token'
+HANDLING_TIME = 0.2  # seconds a handler waits for (fake) I/O
+
+
+async def reply(update, context):
+    await asyncio.sleep(HANDLING_TIME)
+    await context.bot.send_message(chat_id=update.effective_chat.id, text=f'done {update.message.text}')
+
+
+def get_free_port() -> int:
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+class TestWebhook(unittest.TestCase):
+    def setUp(self) -> None:
+        self.telegram = FakeTelegramServer().start()
+        # recorded updates: one message each from 8 chats, and a second message of the first chat
+        self.updates = [{'update_id': i + 1, 'message': self.telegram.make_message(1000 + i, text=f'message {i}')} for i in range(8)]
+        self.updates.append({'update_id': 9, 'message': self.telegram.make_message(1000, text='message 8')})
+
+    def build(self, concurrent_updates=None):
+        builder = ApplicationBuilder().token(TOKEN).base_url(f'{self.telegram.base_url}/bot')
+        if concurrent_updates is not None:
+            builder = builder.concurrent_updates(PerChatUpdateProcessor(concurrent_updates))
+        application = builder.build()
+        application.add_handler(MessageHandler(filters.TEXT, reply))
+        return application
+
+    def wait_for_replies(self, timeout=10):
+        deadline = time.monotonic() + timeout
+        while sum(len(replies) for replies in self.telegram.replies.values()) < len(self.updates):
+            assert time.monotonic() < deadline, 'not all updates were handled'
+            time.sleep(0.01)
+
+    def latencies(self, sent):
+        # the replies of a chat arrive in the order of its messages
+        latencies = []
+        for update in self.updates:
+            chat_id = update['message']['chat']['id']
+            reply_time, text = self.telegram.replies[chat_id].pop(0)
+            assert text == f"done {update['message']['text']}"
+            latencies.append(reply_time - sent[update['update_id']])
+        return latencies
+
+    def post(self, port, update, secret=SECRET):
+        connection = http.client.HTTPConnection('127.0.0.1', port)
+        connection.request('POST', '/telegram', json.dumps(update), {'Content-Type': 'application/json', 'X-Telegram-Bot-Api-Secret-Token': secret})
+        status = connection.getresponse().status
+        connection.close()
+        return status
+
+    def run_webhook(self, concurrent_updates=8):
+        config = {'listen': '127.0.0.1', 'port': get_free_port(), 'path': '/telegram', 'secret_token': SECRET}
+        sent = {}
+
+        async def run():
+            stop = asyncio.Event()
+            task = asyncio.create_task(serve_webhook(self.build(concurrent_updates=concurrent_updates), config, stop))
+            await asyncio.sleep(0.5)
+            # a wrong secret token is rejected
+            assert await asyncio.to_thread(self.post, config['port'], self.updates[0], 'wrong') == 403
+            for update in self.updates:
+                sent[update['update_id']] = time.monotonic()
+                assert await asyncio.to_thread(self.post, config['port'], update) == 200
+            await asyncio.to_thread(self.wait_for_replies)
+            stop.set()
+            await task
+        asyncio.run(run())
+        return self.latencies(sent)
+
+    def run_polling(self):
+        sent = {}
+
+        async def run():
+            application = self.build()
+            await application.initialize()
+            await application.updater.start_polling(poll_interval=0, timeout=1)
+            await application.start()
+            for update in self.updates:
+                sent[update['update_id']] = time.monotonic()
+                self.telegram.add_update(update)
+            await asyncio.to_thread(self.wait_for_replies)
+            await application.updater.stop()
+            await application.stop()
+            await application.shutdown()
+        asyncio.run(run())
+        return self.latencies(sent)
+
+    def test_webhook_latency(self):
+        polling = self.run_polling()
+        webhook = self.run_webhook()
+        # polling handles one update after the other
+        assert max(polling) >= len(self.updates) * HANDLING_TIME
+        # the webhook handles the chats concurrently, only the second message of chat 1000 has to wait
+        assert max(webhook) < 3 * HANDLING_TIME + 0.5
+
+    def test_burst_of_one_chat(self):
+        # chat 1000 sends more messages than there are slots, then chat 1001 sends one
+        self.updates = [{'update_id': i + 1, 'message': self.telegram.make_message(1000, text=f'message {i}')} for i in range(6)]
+        self.updates.append({'update_id': 7, 'message': self.telegram.make_message(1001, text='message 6')})
+        latencies = self.run_webhook(concurrent_updates=2)
+        # the burst is handled one message after the other, but does not hold up the other chat
+        assert latencies[5] >= 6 * HANDLING_TIME
+        assert latencies[6] < 2 * HANDLING_TIME + 0.2
+
+    def test_secret_token_required(self):
+        config = {'listen': '127.0.0.1', 'port': get_free_port(), 'path': '/telegram'}
+        with self.assertRaises(ValueError):
+            asyncio.run(serve_webhook(self.build(), config, asyncio.Event()))
+        with self.assertRaises(ValueError):
+            WebhookServer.from_config(None, dict(config, secret_token=''))
+
+    def test_invalid_updates(self):
+        config = {'listen': '127.0.0.1', 'port': get_free_port(), 'path': '/telegram', 'secret_token': SECRET}
+
+        async def run():
+            stop = asyncio.Event()
+            task = asyncio.create_task(serve_webhook(self.build(), config, stop))
+            await asyncio.sleep(0.5)
+            # valid JSON, but not an update
+            for body in ([], 'x', 5, {'message': 3}):
+                assert await asyncio.to_thread(self.post, config['port'], body) == 400
+            # the server still handles the updates
+            assert await asyncio.to_thread(self.post, config['port'], self.updates[0]) == 200
+            self.updates = self.updates[:1]
+            await asyncio.to_thread(self.wait_for_replies)
+            stop.set()
+            await task
+        asyncio.run(run())
+
+    def test_read_timeout(self):
+        async def run():
+            updates = []
+            async def handle_update(data):
+                updates.append(data)
+            server = WebhookServer(handle_update, '127.0.0.1', 0, '/telegram', SECRET, read_timeout=0.2)
+            await server.start()
+            try:
+                # a client that stops in the middle of the headers is disconnected
+                reader, writer = await asyncio.open_connection('127.0.0.1', server.port)
+                writer.write(b'POST /telegram HTTP/1.1\r\nContent-Length: 2\r\n')
+                await writer.drain()
+                assert await asyncio.wait_for(reader.read(), 2) == b''
+                writer.close()
+                assert updates == []
+            finally:
+                await server.stop()
+        asyncio.run(run())
+
+    def tearDown(self) -> None:
+        self.telegram.stop()
+        return super().tearDown()